@@ -24,4 +24,5 @@ sqlite3 adjustments.sqlite "DELETE FROM splits WHERE effective_date < $start_dat
 sqlite3 adjustments.sqlite "VACUUM"
 
 sqlite3 assets-7.sqlite "DELETE FROM equity_supplementary_mappings WHERE start_date < $start_date_ns"
+sqlite3 assets-7.sqlite "DELETE FROM fundamentals WHERE start_date < $start_date_ns"
 sqlite3 assets-7.sqlite "VACUUM"
@@ -0,0 +1,83 @@
+"""Benchmark of SQLiteDailyBarReader.load_raw_arrays on a synthetic prices database.
+
+Compares the former implementation (one query, pivot and reindex per field)
+with the single query scattered into preallocated arrays, on a window of
+20k sids x 252 sessions of OHLCV.
+
+Usage: python sandbox/benchmark_load_raw_arrays.py [n_sids] [n_sessions]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from exchange_calendars import get_calendar
+
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarWriter, SQLiteDailyBarReader, date_keys
+
+FIELDS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def load_raw_arrays_per_field(reader, fields, start_dt, end_dt, sids):
+    """The former load_raw_arrays: one query, pivot and reindex per field."""
+    start_day = reader._date_key(start_dt)
+    end_day = reader._date_key(end_dt)
+    sessions = reader.trading_calendar.sessions_in_range(start_dt, end_dt)
+    raw_arrays = []
+    with reader._pool.connection() as conn:
+        for field in fields:
+            query = "SELECT date, sid, %s FROM prices WHERE sid in (%s) and date >= ? AND date <= ?;" \
+                    % (field, ",".join(map(str, sids)))
+            df = pd.read_sql_query(query, conn, params=(start_day, end_day))
+            result = df.pivot(index='date', columns='sid', values=field)
+            result = result.reindex(index=date_keys(sessions, reader.schema_version), columns=sids)
+            raw_arrays.append(result.values)
+    return raw_arrays
+
+
+def measure(func, *args):
+    """Time of a call and peak of the memory allocated, measured in a second call since tracemalloc slows it down."""
+    start_time = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start_time
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(n_sids=20000, n_sessions=252):
+    calendar = get_calendar('XNYS', start=pd.Timestamp('2000-01-01'))
+    sessions = calendar.sessions_in_range('2019-01-02', '2022-12-30')[:n_sessions]
+    sids = np.arange(1, n_sids + 1)
+
+    index = pd.MultiIndex.from_product([sessions, sids], names=['date', 'sid'])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.random((len(index), len(FIELDS))) * 100, index=index, columns=FIELDS)
+    # 5% of missing bars
+    data = data[rng.random(len(data)) > 0.05]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'prices.sqlite')
+        SQLiteDailyBarWriter(filename, calendar).write(data)
+        reader = SQLiteDailyBarReader(filename)
+        args = (FIELDS, sessions[0], sessions[-1], list(sids))
+        # warm up the page cache
+        reader.load_raw_arrays(*args)
+
+        old, old_time, old_peak = measure(load_raw_arrays_per_field, reader, *args)
+        new, new_time, new_peak = measure(reader.load_raw_arrays, *args)
+        for a, b in zip(old, new):
+            np.testing.assert_array_equal(a, b)
+
+    print("%d sids x %d sessions, %d fields:" % (n_sids, n_sessions, len(FIELDS)))
+    print("  per field query + pivot: %6.2f s, peak %7.1f MB" % (old_time, old_peak / 1024 ** 2))
+    print("  single query + scatter:  %6.2f s, peak %7.1f MB" % (new_time, new_peak / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,111 @@
+"""Benchmark of the sid sets of SQLiteAssetFinder on a synthetic asset database.
+
+Compares the former queries, which inline the sids in the statement, with
+the queries joining the temporary table of the sids, on the daily lookups of
+a pipeline chunk: the latest quarter and the 4 quarters window of a field,
+for 15k sids over 63 sessions.
+
+Usage: python sandbox/benchmark_sid_sets.py [n_sids] [n_sessions] [n_quarters]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+from exchange_calendars import get_calendar
+from pandas.tseries.offsets import DateOffset
+from sqlalchemy import create_engine, text
+from zipline.assets.asset_db_schema import metadata as asset_metadata, ASSET_DB_VERSION
+
+from sharadar.data.sql_lite_assets import SQLiteAssetFinder, MAX_DELAY
+from sharadar.util.equity_supplementary_util import create_fundamentals_tables, field_ids
+
+FIELD = 'revenue_arq'
+
+
+def get_fundamentals_inline(finder, sids, field_name, as_of_date, n=1):
+    """The former n-th latest quarter lookup, with the sids inlined in the statement."""
+    field_id = finder._field_id(field_name)
+    sql = "WITH nth AS MATERIALIZED (SELECT s.value AS sid, (SELECT start_date FROM fundamentals f " \
+          "WHERE f.field_id = %d AND f.sid = s.value AND f.start_date <= %d " \
+          "ORDER BY f.start_date DESC LIMIT 1 OFFSET %d) AS start_date FROM json_each('[%s]') s) " \
+          "SELECT nth.sid AS sid, f.value AS value FROM nth CROSS JOIN fundamentals f " \
+          "ON f.field_id = %d AND f.sid = nth.sid AND f.start_date = nth.start_date " \
+          "WHERE (%d - nth.start_date) <= %d;"
+    cmd = sql % (field_id, as_of_date.value, n - 1, ','.join(map(str, sids)), field_id, as_of_date.value,
+                 n * MAX_DELAY)
+    with finder.engine.connect() as conn:
+        result = conn.execute(text(cmd)).fetchall()
+    return pd.DataFrame(result).set_index('sid').reindex(sids).T.values.astype('float64')
+
+
+def get_window_inline(finder, sids, field_name, as_of_date, window_length):
+    """The former window of the latest quarters, with the sids inlined in the statement."""
+    start_date = as_of_date - DateOffset(months=(window_length + 1) * 3)
+    sql = "SELECT * FROM (SELECT ROW_NUMBER() OVER (PARTITION BY sid ORDER BY start_date DESC) row_num," \
+          "sid, start_date, value FROM fundamentals WHERE sid IN (%s) AND field_id = %d " \
+          "AND start_date >= %d AND start_date <= %d) t WHERE row_num <= %d"
+    cmd = sql % (', '.join(map(str, sids)), finder._field_id(field_name), start_date.value, as_of_date.value,
+                 window_length)
+    df = pd.read_sql_query(cmd, finder.engine)
+    df = df.pivot(index='row_num', columns='sid', values='value')
+    return df.reindex(index=range(1, window_length + 1), columns=sids).values.astype('float64')
+
+
+def get_window(finder, sids, field_name, as_of_date, window_length):
+    return finder.get_fundamentals_df_window_length(sids, field_name, as_of_date, window_length)
+
+
+def run_chunk(func, finder, sids, sessions, *args):
+    """Time of the daily calls of a pipeline chunk."""
+    start_time = time.perf_counter()
+    results = [func(finder, sids, FIELD, day, *args) for day in sessions]
+    return results, time.perf_counter() - start_time
+
+
+def main(n_sids=15000, n_sessions=63, n_quarters=40):
+    calendar = get_calendar('XNYS', start=pd.Timestamp('2000-01-01'))
+    sessions = calendar.sessions_in_range('2015-01-02', '2015-12-31')[:n_sessions]
+    sids = list(range(1, n_sids + 1))
+    quarters = pd.date_range('2005-02-01', periods=n_quarters, freq='3MS')
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'assets.sqlite')
+        engine = create_engine('sqlite:///' + filename)
+        asset_metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(asset_metadata.tables['version_info'].insert().values(version=ASSET_DB_VERSION))
+        with closing(sqlite3.connect(filename)) as con, con:
+            cursor = con.cursor()
+            create_fundamentals_tables(cursor)
+            field_id = field_ids(cursor, [FIELD])[FIELD]
+            # each sid files a few days after the start of the quarter
+            offsets = rng.integers(0, 45, n_sids) * 86400 * 10 ** 9
+            cursor.executemany("INSERT INTO fundamentals VALUES (?, ?, ?, ?)",
+                               ((field_id, sid, int(q.value + offsets[sid - 1]), float(rng.random()))
+                                for sid in sids for q in quarters))
+
+        finder = SQLiteAssetFinder(engine)
+        finder.point_in_time_cache_size = 0
+        # warm up the page cache
+        finder.get_fundamentals(sids, FIELD, sessions[0])
+
+        print("%d sids x %d sessions, %d quarters:" % (n_sids, n_sessions, n_quarters))
+        for label, old, new, args in [('latest quarter', get_fundamentals_inline, SQLiteAssetFinder.get_fundamentals,
+                                       (1,)),
+                                      ('4 quarters window', get_window_inline, get_window, (4,))]:
+            old_results, old_time = run_chunk(old, finder, sids, sessions, *args)
+            new_results, new_time = run_chunk(new, finder, sids, sessions, *args)
+            for a, b in zip(old_results, new_results):
+                np.testing.assert_array_equal(a, b)
+            print("  %-18s inlined sids: %6.2f s" % (label + ',', old_time))
+            print("  %-18s sid set:      %6.2f s" % (label + ',', new_time))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
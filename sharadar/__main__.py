@@ -21,6 +21,8 @@ from zipline.utils.compat import wraps
 from zipline.utils.cli import Date, Timestamp
 from zipline.utils.run_algo import BenchmarkSpec
 from sharadar.util.run_algo import _run, load_extensions
+from sharadar.util.output_dir import get_data_dir
+from sharadar.data import sql_lite_daily_pricing, sharded_daily_pricing
 from zipline.extensions import create_args
 from sharadar.live import brokers
 
@@ -517,6 +519,57 @@ def clean(bundle, before, after, keep_last):
     )
 
 
+@main.command(name='migrate-prices')
+@click.option(
+    '-i',
+    '--input',
+    'filename',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False, path_type=str),
+    help='The prices database to migrate.\n'
+         '[default: prices.sqlite of the sharadar bundle]',
+)
+@click.option(
+    '-o',
+    '--output',
+    default=None,
+    type=click.Path(dir_okay=False, path_type=str),
+    help='Write the migrated database to this file instead of converting it in place.',
+)
+def migrate_prices(filename, output):
+    """Convert a prices database to the integer-keyed schema.
+    """
+    if filename is None:
+        filename = os.path.join(get_data_dir(), "prices.sqlite")
+    sql_lite_daily_pricing.migrate_prices(filename, output)
+
+
+@main.command(name='shard-prices')
+@click.option(
+    '-i',
+    '--input',
+    'filename',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False, path_type=str),
+    help='The prices database to split.\n'
+         '[default: prices.sqlite of the sharadar bundle]',
+)
+@click.option(
+    '-o',
+    '--output',
+    default=None,
+    type=click.Path(file_okay=False, path_type=str),
+    help='Write the shards to this directory.\n'
+         '[default: prices.shards next to the prices database]',
+)
+def shard_prices(filename, output):
+    """Split a prices database into one database per year.
+    """
+    if filename is None:
+        filename = os.path.join(get_data_dir(), "prices.sqlite")
+    sharded_daily_pricing.shard_prices(filename, output)
+
+
 @main.command()
 def bundles():
     """List all of the available data bundles.
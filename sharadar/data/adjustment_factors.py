@@ -0,0 +1,175 @@
+"""Materialized adjustment factors of the adjustments database.
+
+The splits, mergers and dividends of a sid are ratios applied to the prices
+before their effective date. The adjustment_factors table stores, for each
+sid and effective date, the cumulative factor of the prices before that
+date: the product of the ratios of all the adjustments effective on or after
+it. The factor of the prices of a date d is therefore the factor of the first
+effective date after d, or 1.0, and the prices of d adjusted as of a later
+date end are
+
+    raw(d) * factor(d) / factor(end)
+
+which is the adjustment applied by the history windows of the DataPortal,
+computed with a single multiply instead of an AdjustedArray per sid.
+
+The volumes are adjusted by the inverse of the split ratios only, hence the
+separate volume factor.
+"""
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from sharadar.data.connection_pool import SQLiteConnectionPool
+from sharadar.util.logger import log
+
+ADJUSTMENT_FACTORS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS "adjustment_factors" (
+  "sid" INTEGER NOT NULL,
+  "effective_date" INTEGER NOT NULL,
+  "price_factor" REAL NOT NULL,
+  "volume_factor" REAL NOT NULL,
+  PRIMARY KEY (sid, effective_date)
+) WITHOUT ROWID;
+"""
+
+# Price fields adjusted by the price factor, the volume is adjusted by the volume factor
+ADJUSTED_PRICE_FIELDS = ('open', 'high', 'low', 'close')
+ADJUSTED_FIELDS = ADJUSTED_PRICE_FIELDS + ('volume',)
+
+# Decimal places of the adjusted prices, as rounded by the history windows of the DataPortal
+PRICE_DECIMALS = 3
+
+
+def _seconds(dates):
+    """Seconds since the epoch of dates, the unit of the effective_date columns."""
+    return pd.DatetimeIndex(dates).tz_localize(None).values.astype('datetime64[s]').astype(np.int64)
+
+
+def write_adjustment_factors(filename):
+    """Rebuild the adjustment_factors table from the splits, mergers and dividends tables.
+
+    Args:
+        filename: Path of the adjustments database.
+
+    Returns:
+        int: Number of rows written.
+    """
+    sql = """
+    SELECT sid, effective_date, ratio, 1 FROM splits WHERE ratio IS NOT NULL
+    UNION ALL SELECT sid, effective_date, ratio, 0 FROM mergers WHERE ratio IS NOT NULL
+    UNION ALL SELECT sid, effective_date, ratio, 0 FROM dividends WHERE ratio IS NOT NULL
+    """
+    with closing(sqlite3.connect(filename)) as con:
+        rows = con.execute(sql).fetchall()
+    adjustments = pd.DataFrame(rows, columns=['sid', 'effective_date', 'price_factor', 'split']).astype(
+        {'sid': np.int64, 'effective_date': np.int64, 'price_factor': np.float64, 'split': np.int64})
+    adjustments['volume_factor'] = np.where(adjustments['split'] == 1, 1.0 / adjustments['price_factor'], 1.0)
+
+    # ratios of the adjustments of a sid on the same date, then products of the ratios on or after each date
+    factors = adjustments.groupby(['sid', 'effective_date'])[['price_factor', 'volume_factor']].prod()
+    factors = factors.iloc[::-1].groupby(level='sid').cumprod().iloc[::-1]
+
+    records = list(zip(factors.index.get_level_values('sid').tolist(),
+                       factors.index.get_level_values('effective_date').tolist(),
+                       factors['price_factor'].tolist(),
+                       factors['volume_factor'].tolist()))
+    with closing(sqlite3.connect(filename)) as con, closing(con.cursor()) as c:
+        with con:
+            c.executescript(ADJUSTMENT_FACTORS_SCHEMA)
+            c.execute("DELETE FROM adjustment_factors")
+            c.executemany("INSERT INTO adjustment_factors VALUES (?, ?, ?, ?)", records)
+    log.info("Wrote %d adjustment factors of %d sids." % (len(records), factors.index.get_level_values('sid').nunique()))
+    return len(records)
+
+
+class AdjustmentFactorReader(object):
+    """Reads the adjustment factors written by write_adjustment_factors.
+
+    Attributes:
+        filename: Path of the adjustments database.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._pool = SQLiteConnectionPool(filename)
+        self._has_factors = None
+
+    @property
+    def has_factors(self):
+        """True if the adjustment_factors table exists, i.e. the bundle was ingested with it."""
+        if self._has_factors is None:
+            sql = "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='adjustment_factors'"
+            try:
+                self._has_factors = self._pool.execute(sql)[0][0] == 1
+            except sqlite3.Error:
+                self._has_factors = False
+        return self._has_factors
+
+    def close(self):
+        """Close the pooled connections."""
+        self._pool.close()
+
+    def load_factors(self, dates, sids):
+        """The cumulative price and volume factors of the prices of each date.
+
+        Args:
+            dates: DatetimeIndex of the dates.
+            sids: Security identifiers.
+
+        Returns:
+            Tuple of two np.ndarray of shape (len(dates), len(sids)): the price and the volume factors.
+        """
+        sids = np.asarray([int(x) for x in sids], dtype=np.int64)
+        seconds = _seconds(dates)
+        price_factors = np.ones((len(seconds), len(sids)))
+        volume_factors = np.ones((len(seconds), len(sids)))
+        if len(seconds) == 0 or len(sids) == 0:
+            return price_factors, volume_factors
+
+        # only the effective dates after the first date change the factors of the dates
+        sql = "SELECT sid, effective_date, price_factor, volume_factor FROM adjustment_factors " \
+              "WHERE sid IN (%s) AND effective_date > ? ORDER BY sid, effective_date" \
+              % ",".join(map(str, np.unique(sids)))
+        rows = self._pool.execute(sql, (int(seconds.min()),))
+        if len(rows) == 0:
+            return price_factors, volume_factors
+        factors = pd.DataFrame(rows, columns=['sid', 'effective_date', 'price_factor', 'volume_factor'])
+        for sid, group in factors.groupby('sid'):
+            # the factor of a date is the one of the first effective date after it, 1.0 after the last one
+            ix = np.searchsorted(group['effective_date'].values, seconds, side='right')
+            columns = np.flatnonzero(sids == sid)
+            price_factors[:, columns] = np.append(group['price_factor'].values, 1.0)[ix][:, None]
+            volume_factors[:, columns] = np.append(group['volume_factor'].values, 1.0)[ix][:, None]
+        return price_factors, volume_factors
+
+    def load_adjusted_arrays(self, bar_reader, fields, start_dt, end_dt, sids):
+        """The arrays of bar_reader.load_raw_arrays adjusted as of end_dt.
+
+        Args:
+            bar_reader: Daily bar reader of the raw prices.
+            fields: List of OHLCV column names to load.
+            start_dt: Start date (inclusive).
+            end_dt: End date (inclusive), the date as of which the prices are adjusted.
+            sids: List of security identifiers.
+
+        Returns:
+            List of numpy arrays, one per field, each of shape (num_sessions, num_sids).
+        """
+        sessions = bar_reader.trading_calendar.sessions_in_range(start_dt, end_dt)
+        raw_arrays = bar_reader.load_raw_arrays(fields, start_dt, end_dt, sids)
+        price_factors, volume_factors = self.load_factors(sessions.append(pd.DatetimeIndex([end_dt])), sids)
+        price_factors = price_factors[:-1] / price_factors[-1]
+        volume_factors = volume_factors[:-1] / volume_factors[-1]
+
+        arrays = []
+        for field, array in zip(fields, raw_arrays):
+            if field == 'volume':
+                # no trade is a volume of 0, as in zipline
+                arrays.append(np.nan_to_num(array * volume_factors, nan=0.0))
+            elif field in ADJUSTED_PRICE_FIELDS:
+                arrays.append(np.round(array * price_factors, PRICE_DECIMALS))
+            else:
+                raise ValueError("Unknown price field: %s" % field)
+        return arrays
@@ -0,0 +1,135 @@
+"""Pool of read-only SQLite connections.
+
+The readers of the bundle query the same database file thousands of times
+per backtest. Opening a connection for each query costs the connect, the
+schema parsing and a cold page cache every time; the pool keeps the
+connections open and reuses them, together with their page cache, their
+memory map and their cache of prepared statements.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+# Connection settings of the read-only connections
+READ_PRAGMAS = (
+    "PRAGMA query_only = ON",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Number of prepared statements cached by each connection
+CACHED_STATEMENTS = 256
+
+
+def memory_uri(name):
+    """URI of a named in-memory database of the memdb VFS, shared by all the connections of the process.
+
+    Unlike the shared cache of mode=memory, the connections to a memdb
+    database do not share a page cache, so they read without table locks.
+    """
+    return 'file:/%s?vfs=memdb' % quote(name)
+
+
+def is_memory_uri(filename):
+    """True if filename is the URI of a named in-memory database, see memory_uri."""
+    return filename.startswith('file:') and 'vfs=memdb' in filename
+
+
+class SQLiteConnectionPool(object):
+    """Thread-safe and fork-aware pool of read-only connections to a SQLite database.
+
+    A connection is used by a single thread at a time. The pool is emptied
+    when it is used from a forked process, since the connections of the
+    parent process must not be shared.
+
+    Attributes:
+        filename: Path of the SQLite database, or URI of an in-memory database (see memory_uri).
+        immutable: If True, the database is opened as immutable: SQLite skips
+            the file locks and the change detection. Use it only if the file
+            is not written while the pool is in use.
+        max_size: Maximum number of idle connections kept open.
+    """
+    def __init__(self, filename, immutable=False, max_size=8):
+        self.filename = filename
+        self.immutable = immutable
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _uri(self):
+        if is_memory_uri(self.filename):
+            return self.filename
+        uri = 'file:%s?mode=ro' % quote(os.path.abspath(self.filename))
+        if self.immutable:
+            uri += '&immutable=1'
+        return uri
+
+    def _connect(self):
+        con = sqlite3.connect(self._uri(), uri=True, check_same_thread=False,
+                              cached_statements=CACHED_STATEMENTS)
+        for pragma in READ_PRAGMAS:
+            con.execute(pragma)
+        return con
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the connections inherited from the parent process are not closed, they belong to the parent
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _release(self, con):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.max_size:
+                self._idle.append(con)
+                return
+        con.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool.
+
+        Yields:
+            sqlite3.Connection: Read-only connection, returned to the pool on exit.
+        """
+        con = self._acquire()
+        broken = False
+        try:
+            yield con
+        except sqlite3.Error:
+            # the connection may be in an unknown state
+            broken = True
+            raise
+        finally:
+            if broken:
+                con.close()
+            else:
+                self._release(con)
+
+    def execute(self, sql, parameters=()):
+        """Execute a query with bound parameters and return all the rows.
+
+        Args:
+            sql: SQL query with ? placeholders.
+            parameters: Values of the placeholders.
+
+        Returns:
+            List of result tuples.
+        """
+        with self.connection() as con:
+            return con.execute(sql, parameters).fetchall()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        if self._pid == os.getpid():
+            for con in idle:
+                con.close()
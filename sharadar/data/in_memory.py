@@ -0,0 +1,239 @@
+"""In-memory copies of the bundle databases.
+
+The prices, assets and adjustments databases are copied into named
+in-memory databases with the SQLite online backup API, optionally bounded
+to a date range and a set of sids. The readers of an InMemoryBundle open
+connections to these databases by URI, so that a parameter sweep pays the
+load once and then runs without disk reads.
+
+A named in-memory database exists as long as a connection to it is open:
+each InMemoryDatabase keeps one open until it is closed.
+
+The prices of a sharded bundle are merged into a single in-memory prices
+database, see InMemoryDatabase.from_shards.
+"""
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from urllib.parse import quote
+
+import pandas as pd
+from sqlalchemy import create_engine
+from zipline.data.adjustments import SQLiteAdjustmentReader
+from zipline.data.bundles.core import BundleData
+
+from sharadar.data.connection_pool import memory_uri
+from sharadar.data.prices_manifest import PricesManifest
+from sharadar.data.sharded_daily_pricing import shard_path, shard_years
+from sharadar.data.sql_lite_assets import SQLiteAssetFinder
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarReader, prices_schema_version, date_keys
+from sharadar.util.logger import log
+
+
+class InMemoryDatabase(object):
+    """A copy of a SQLite database in a named in-memory database.
+
+    Attributes:
+        source: Path of the copied database.
+        name: Name of the in-memory database.
+        uri: URI of the in-memory database, see connection_pool.memory_uri.
+    """
+    def __init__(self, source, name=None):
+        self.source = source
+        self.name = name or 'sharadar-%s-%s' % (os.path.basename(source), uuid.uuid4().hex)
+        self.uri = memory_uri(self.name)
+        # the connection that keeps the database alive, also used to slice it
+        self._con = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        source_uri = 'file:%s?mode=ro' % quote(os.path.abspath(source))
+        with closing(sqlite3.connect(source_uri, uri=True)) as con:
+            con.backup(self._con)
+
+    @classmethod
+    def from_shards(cls, directory, start=None, end=None):
+        """A prices database merging the price shards of a directory.
+
+        Only the shards of the years between start and end are copied, the
+        rows outside of the dates are deleted by slice_prices.
+
+        Args:
+            directory: Directory of the shards, see sharded_daily_pricing.
+            start: First date of the prices, None for the first shard.
+            end: Last date of the prices, None for the last shard.
+
+        Returns:
+            InMemoryDatabase
+
+        Raises:
+            ValueError: If there is no shard between start and end.
+        """
+        years = [year for year in shard_years(directory)
+                 if (start is None or year >= pd.Timestamp(start).year) and
+                 (end is None or year <= pd.Timestamp(end).year)]
+        if len(years) == 0:
+            raise ValueError("No price shards in %s between %s and %s." % (directory, start, end))
+        # the first shard brings the schema and the properties
+        database = cls(shard_path(directory, years[0]),
+                       name='sharadar-%s-%s' % (os.path.basename(directory), uuid.uuid4().hex))
+        database.source = directory
+        # an attached file would use the memdb VFS of the connection, the rows are copied through Python
+        for year in years[1:]:
+            source_uri = 'file:%s?mode=ro' % quote(os.path.abspath(shard_path(directory, year)))
+            with closing(sqlite3.connect(source_uri, uri=True)) as con, database._con:
+                rows = con.execute("SELECT date, sid, open, high, low, close, volume FROM prices")
+                database._con.executemany("INSERT INTO prices (date, sid, open, high, low, close, volume) "
+                                          "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return database
+
+    def connect(self):
+        """A new connection to the in-memory database.
+
+        Returns:
+            sqlite3.Connection: Usable from any thread.
+        """
+        return sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+
+    def execute(self, sql, parameters=()):
+        """Execute a statement in a transaction.
+
+        Returns:
+            int: Number of changed rows.
+        """
+        with self._con:
+            return self._con.execute(sql, parameters).rowcount
+
+    def tables_with_column(self, column):
+        """Names of the tables with a column."""
+        tables = [r[0] for r in self._con.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        return [t for t in tables
+                if column in [r[1] for r in self._con.execute('PRAGMA table_info("%s")' % t)]]
+
+    def keep_sids(self, sids):
+        """Delete the rows of the other sids from all the tables with a sid column.
+
+        Args:
+            sids: Security identifiers to keep.
+
+        Returns:
+            int: Number of deleted rows.
+        """
+        deleted = 0
+        with self._con:
+            self._con.execute("CREATE TEMP TABLE IF NOT EXISTS keep_sids (sid INTEGER PRIMARY KEY)")
+            self._con.execute("DELETE FROM keep_sids")
+            self._con.executemany("INSERT OR IGNORE INTO keep_sids VALUES (?)", [(int(x),) for x in sids])
+            for table in self.tables_with_column('sid'):
+                deleted += self._con.execute(
+                    'DELETE FROM "%s" WHERE sid NOT IN (SELECT sid FROM keep_sids)' % table).rowcount
+            self._con.execute("DROP TABLE keep_sids")
+        return deleted
+
+    def vacuum(self):
+        """Release the pages of the deleted rows."""
+        self._con.execute("VACUUM")
+
+    @property
+    def size_bytes(self):
+        """Memory used by the pages of the database."""
+        page_count = self._con.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._con.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def close(self):
+        """Close the keeping connection, the database is freed with the last connection."""
+        self._con.close()
+
+
+def slice_prices(database, start=None, end=None):
+    """Delete the prices before start and after end.
+
+    Args:
+        database: InMemoryDatabase of a prices database.
+        start: First date to keep, None to keep the first dates.
+        end: Last date to keep, None to keep the last dates.
+
+    Returns:
+        int: Number of deleted rows.
+    """
+    with closing(database.connect()) as con:
+        schema_version = prices_schema_version(con)
+    deleted = 0
+    if start is not None:
+        start_key = date_keys([pd.Timestamp(start).normalize()], schema_version).tolist()[0]
+        deleted += database.execute("DELETE FROM prices WHERE date < ?", (start_key,))
+    if end is not None:
+        end_key = date_keys([pd.Timestamp(end).normalize()], schema_version).tolist()[0]
+        deleted += database.execute("DELETE FROM prices WHERE date > ?", (end_key,))
+    return deleted
+
+
+class InMemoryBundle(object):
+    """The prices, assets and adjustments databases of a bundle, copied into memory.
+
+    The slice keeps the prices between start and end, and all the rows of the
+    sids in sids. The history windows of a backtest need the sessions before
+    its start, so start must include them.
+
+    The prices path is either a prices database or the directory of the price
+    shards of a sharded bundle.
+
+    Attributes:
+        prices: InMemoryDatabase of the prices.
+        prices_manifest: PricesManifest of the prices.
+        assets: InMemoryDatabase of the assets.
+        adjustments: InMemoryDatabase of the adjustments.
+        load_time: Seconds spent copying and slicing the databases.
+    """
+    def __init__(self, prices_path, assets_path, adjustments_path, start=None, end=None, sids=None):
+        start_time = time.time()
+        if os.path.isdir(prices_path):
+            self.prices = InMemoryDatabase.from_shards(prices_path, start, end)
+        else:
+            self.prices = InMemoryDatabase(prices_path)
+        self.assets = InMemoryDatabase(assets_path)
+        self.adjustments = InMemoryDatabase(adjustments_path)
+        if start is not None or end is not None:
+            slice_prices(self.prices, start, end)
+        if sids is not None:
+            for database in self.databases:
+                database.keep_sids(sids)
+        if start is not None or end is not None or sids is not None:
+            for database in self.databases:
+                database.vacuum()
+        # the copy is not written anymore, its manifest is built once
+        with closing(self.prices.connect()) as con:
+            self.prices_manifest = PricesManifest.from_connection(con)
+        self.load_time = time.time() - start_time
+        log.info("Loaded the bundle in memory in %.1f seconds: %.1f MB (prices %.1f MB, assets %.1f MB, "
+                 "adjustments %.1f MB)." % (self.load_time, self.size_bytes / 1024 ** 2,
+                                            self.prices.size_bytes / 1024 ** 2,
+                                            self.assets.size_bytes / 1024 ** 2,
+                                            self.adjustments.size_bytes / 1024 ** 2))
+
+    @property
+    def databases(self):
+        return self.prices, self.assets, self.adjustments
+
+    @property
+    def size_bytes(self):
+        """Memory used by the pages of the three databases."""
+        return sum(database.size_bytes for database in self.databases)
+
+    def bundle_data(self):
+        """Readers of the in-memory databases.
+
+        Returns:
+            BundleData: Object containing asset finder, bar reader, and adjustment reader.
+        """
+        return BundleData(
+            asset_finder=SQLiteAssetFinder(create_engine('sqlite://', creator=self.assets.connect)),
+            equity_minute_bar_reader=None,
+            equity_daily_bar_reader=SQLiteDailyBarReader(self.prices.uri, manifest=self.prices_manifest),
+            adjustment_reader=SQLiteAdjustmentReader(self.adjustments.connect()),
+        )
+
+    def close(self):
+        """Free the in-memory databases, once the readers are closed too."""
+        for database in self.databases:
+            database.close()
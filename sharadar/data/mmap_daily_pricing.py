@@ -0,0 +1,533 @@
+"""Columnar memory-mapped daily pricing store for the Sharadar zipline bundle.
+
+Stores daily OHLCV bars as dense (session x sid) column files (.npy) which are
+memory-mapped by the reader, so that loading a window of sessions for many sids
+is an array slice instead of a SQL query followed by a pivot. The prices are
+float32: the store is read by the pipeline only, the DataPortal reads the
+float64 prices of the SQLite store (see pipeline_bar_reader).
+
+Layout of the store directory:
+
+    properties.json   {"calendar_name": ..., "last_session": "YYYY-MM-DD", "lattice": "lattice-..."}
+    lattice-.../      the lattice named by the properties:
+        sessions.npy      int64 nanoseconds of the trading sessions (rows)
+        sids.npy          int64 sorted security identifiers (columns)
+        open.npy, high.npy, low.npy, close.npy   float32, NaN when no bar
+        volume.npy        uint32, 0 when no bar
+
+A write of the sids of the store from its first session on is done in place:
+the new sessions are appended to the rows of the lattice files. Any other
+write builds a new lattice and replaces properties.json to point to it, so
+there is always a complete store; the previous lattice is kept until the
+next rebuild for the readers that have just read the old properties.
+"""
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+from exchange_calendars import get_calendar
+
+from sharadar.util.logger import log
+from sharadar.util.output_dir import get_data_dir
+from zipline.data.bar_reader import (
+    NoDataBeforeDate,
+)
+from zipline.data.session_bars import SessionBarReader
+from zipline.utils.memoize import lazyval
+
+PRICE_FIELDS = ('open', 'high', 'low', 'close')
+OHLCV_FIELDS = PRICE_FIELDS + ('volume',)
+FIELD_DTYPES = {
+    'open': np.float32,
+    'high': np.float32,
+    'low': np.float32,
+    'close': np.float32,
+    'volume': np.uint32,
+}
+FIELD_MISSING_VALUES = {
+    'open': np.nan,
+    'high': np.nan,
+    'low': np.nan,
+    'close': np.nan,
+    'volume': 0,
+}
+UINT32_MAX = np.iinfo(np.uint32).max
+
+PROPERTIES_FILENAME = 'properties.json'
+SESSIONS_FILENAME = 'sessions.npy'
+SIDS_FILENAME = 'sids.npy'
+LATTICE_PREFIX = 'lattice-'
+
+_NPY_HEADERS = {
+    (1, 0): (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+    (2, 0): (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0),
+}
+
+
+def _field_filename(field):
+    return field + '.npy'
+
+
+class MMapDailyBarWriter(object):
+    """Writes daily OHLCV bar data to a columnar memory-mapped store.
+
+    A write of known sids from the first session of the store on updates the
+    lattice in place, appending the new sessions, see _append. A write with
+    new sids or earlier sessions rebuilds the dense (session x sid) lattice as
+    the union of the existing store and the new data. Both behave like the
+    INSERT OR REPLACE semantics of SQLiteDailyBarWriter.
+
+    Attributes:
+        _rootdir: Directory of the columnar store.
+        _calendar: Trading calendar used for session alignment.
+    """
+    def __init__(self, rootdir, calendar):
+        self._rootdir = rootdir
+        self._calendar = calendar
+
+    def _path(self, filename):
+        return os.path.join(self._rootdir, filename)
+
+    def _validate(self, data):
+        """Validate that input data has the expected format.
+
+        Args:
+            data: DataFrame to validate.
+
+        Raises:
+            ValueError: If data is not a DataFrame or lacks ['date', 'sid'] index.
+        """
+        if not isinstance(data, pd.DataFrame):
+            raise ValueError("data must be an instance of DataFrame.")
+        if data.index.names != ['date', 'sid']:
+            raise ValueError("data indexes must be ['date', 'sid'].")
+
+    def _current_lattice(self):
+        """Directory of the lattice named by the properties, None if there is no store."""
+        if not os.path.exists(self._path(PROPERTIES_FILENAME)):
+            return None
+        with open(self._path(PROPERTIES_FILENAME)) as f:
+            return self._path(json.load(f)['lattice'])
+
+    def _read_existing(self):
+        """Open the current lattice, if any.
+
+        Returns:
+            Tuple of (lattice directory, sessions DatetimeIndex, sids array, dict field -> memmap),
+            or (None, None, None, None) if there is no store.
+        """
+        lattice = self._current_lattice()
+        if lattice is None:
+            return None, None, None, None
+        sessions = pd.DatetimeIndex(np.load(os.path.join(lattice, SESSIONS_FILENAME)).astype('datetime64[ns]'))
+        sids = np.load(os.path.join(lattice, SIDS_FILENAME))
+        arrays = {f: np.load(os.path.join(lattice, _field_filename(f)), mmap_mode='r') for f in OHLCV_FIELDS}
+        return lattice, sessions, sids, arrays
+
+    def _new_lattice(self, sessions, sids):
+        """Create the empty lattice of a new store in a new directory of the store.
+
+        Returns:
+            Tuple of (lattice directory, dict field -> memmap).
+        """
+        os.makedirs(self._rootdir, exist_ok=True)
+        lattice = tempfile.mkdtemp(prefix=LATTICE_PREFIX, dir=self._rootdir)
+        arrays = {}
+        for field in OHLCV_FIELDS:
+            arr = np.lib.format.open_memmap(os.path.join(lattice, _field_filename(field)), mode='w+',
+                                            dtype=FIELD_DTYPES[field], shape=(len(sessions), len(sids)))
+            arr[:] = FIELD_MISSING_VALUES[field]
+            arrays[field] = arr
+        return lattice, arrays
+
+    def _fill(self, arrays, sessions, all_sids, data):
+        """Write the bars of data into the lattice of sessions x all_sids.
+
+        Returns:
+            int: Number of written rows.
+        """
+        df = data[list(OHLCV_FIELDS)]
+        dates = pd.DatetimeIndex(df.index.get_level_values('date')).tz_localize(None).normalize()
+        sids = df.index.get_level_values('sid').values.astype(np.int64)
+
+        rows = sessions.get_indexer(dates)
+        valid = rows >= 0
+        if not valid.all():
+            log.warn("Dropping %d price rows outside the %s sessions." % ((~valid).sum(), self._calendar.name))
+        rows = rows[valid]
+        cols = np.searchsorted(all_sids, sids[valid])
+        for field in PRICE_FIELDS:
+            arrays[field][rows, cols] = df[field].values[valid]
+        volume = np.nan_to_num(df['volume'].values[valid].astype(np.float64))
+        overflow = volume > UINT32_MAX
+        if overflow.any():
+            log.warn("Clipping %d volume values exceeding uint32." % overflow.sum())
+        arrays['volume'][rows, cols] = np.clip(volume, 0, UINT32_MAX)
+        return valid.sum()
+
+    def _save_sessions(self, lattice, sessions):
+        """Replace the sessions of a lattice."""
+        path = os.path.join(lattice, SESSIONS_FILENAME)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, sessions.values.astype('datetime64[ns]').view(np.int64))
+        os.replace(path + '.tmp', path)
+
+    def _save_properties(self, lattice, sessions):
+        """Point the store to a lattice, replacing properties.json in one step."""
+        last_session = str(sessions[-1].date()) if len(sessions) > 0 else None
+        path = self._path(PROPERTIES_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'calendar_name': self._calendar.name, 'last_session': last_session,
+                       'lattice': os.path.basename(lattice)}, f)
+        os.replace(path + '.tmp', path)
+
+    def _commit(self, lattice, arrays, sessions, sids):
+        """Complete a new lattice and make it the one of the store.
+
+        The lattices before the previous one are removed: the previous one
+        may still be opened by a reader that has read the old properties. The
+        open memory maps of the removed files stay valid.
+        """
+        for field in OHLCV_FIELDS:
+            arrays[field].flush()
+        arrays.clear()
+        np.save(os.path.join(lattice, SIDS_FILENAME), sids)
+        self._save_sessions(lattice, sessions)
+        previous = self._current_lattice()
+        self._save_properties(lattice, sessions)
+        keep = {os.path.basename(lattice), None if previous is None else os.path.basename(previous)}
+        for name in os.listdir(self._rootdir):
+            if name.startswith(LATTICE_PREFIX) and name not in keep:
+                shutil.rmtree(self._path(name), ignore_errors=True)
+
+    @staticmethod
+    def _grow(path, n_rows, n_cols, missing_value):
+        """Resize the rows of a lattice file in place, the new rows are missing values.
+
+        The header of a C-order .npy file is padded for the first dimension
+        to grow (see numpy.lib.format.GROWTH_AXIS_MAX_DIGITS), so the data of
+        the existing rows stays in place.
+
+        Returns:
+            numpy.memmap of the file, None if the header can not be rewritten in place.
+        """
+        fmt = np.lib.format
+        with open(path, 'r+b') as f:
+            version = fmt.read_magic(f)
+            if version not in _NPY_HEADERS:
+                return None
+            read_header, write_header = _NPY_HEADERS[version]
+            (old_rows, old_cols), fortran_order, dtype = read_header(f)
+            offset = f.tell()
+            header = io.BytesIO()
+            write_header(header, {'descr': fmt.dtype_to_descr(dtype), 'fortran_order': False,
+                                  'shape': (n_rows, n_cols)})
+            if fortran_order or old_cols != n_cols or len(header.getvalue()) != offset:
+                return None
+            f.truncate(offset + n_rows * n_cols * dtype.itemsize)
+            f.seek(0)
+            f.write(header.getvalue())
+        arr = np.memmap(path, dtype=dtype, mode='r+', offset=offset, shape=(n_rows, n_cols))
+        if n_rows > old_rows:
+            arr[old_rows:] = missing_value
+        return arr
+
+    def _append(self, data, dates, sids):
+        """Write data in place in the current lattice.
+
+        Only the bars of the sids of the lattice from its first session on
+        can be written in place: the new sessions are appended to the rows of
+        the lattice files, the bars of the existing sessions are replaced.
+
+        Returns:
+            int: Number of written rows, None if the lattice must be rebuilt.
+        """
+        lattice, old_sessions, old_sids, _ = self._read_existing()
+        if lattice is None or len(old_sessions) == 0 or dates.min() < old_sessions[0] or \
+                not np.isin(sids, old_sids).all():
+            return None
+        sessions = self._calendar.sessions_in_range(old_sessions[0], max(dates.max(), old_sessions[-1]))
+        sessions = sessions.tz_localize(None)
+        if not sessions[:len(old_sessions)].equals(old_sessions):
+            return None
+
+        arrays = {}
+        for field in OHLCV_FIELDS:
+            arr = self._grow(os.path.join(lattice, _field_filename(field)), len(sessions), len(old_sids),
+                             FIELD_MISSING_VALUES[field])
+            if arr is None:
+                return None
+            arrays[field] = arr
+        written = self._fill(arrays, sessions, old_sids, data)
+        for field in OHLCV_FIELDS:
+            arrays[field].flush()
+        arrays.clear()
+        # the rows are written before the sessions that index them
+        if len(sessions) > len(old_sessions):
+            self._save_sessions(lattice, sessions)
+        self._save_properties(lattice, sessions)
+        log.info("Written %d price rows in place to %s, %d new sessions." %
+                 (written, self._rootdir, len(sessions) - len(old_sessions)))
+        return written
+
+    def write(self, data):
+        """Write OHLCV data to the store, replacing existing bars.
+
+        Args:
+            data: DataFrame indexed by ['date', 'sid'] with the columns
+                open, high, low, close and volume.
+        """
+        self._validate(data)
+        if len(data) == 0:
+            log.info("No price data to write.")
+            return
+
+        dates = pd.DatetimeIndex(data.index.get_level_values('date')).tz_localize(None).normalize()
+        sids = data.index.get_level_values('sid').values.astype(np.int64)
+        if self._append(data, dates, sids) is not None:
+            return
+
+        _, old_sessions, old_sids, old_arrays = self._read_existing()
+
+        start, end = dates.min(), dates.max()
+        if old_sessions is not None and len(old_sessions) > 0:
+            start, end = min(start, old_sessions[0]), max(end, old_sessions[-1])
+        sessions = self._calendar.sessions_in_range(start, end).tz_localize(None)
+        all_sids = np.unique(sids) if old_sids is None else np.union1d(old_sids, sids)
+
+        lattice, out = self._new_lattice(sessions, all_sids)
+        if old_sessions is not None and len(old_sessions) > 0:
+            # the old lattice is a contiguous block of rows in the new one
+            r0 = sessions.get_loc(old_sessions[0])
+            r1 = r0 + len(old_sessions)
+            cols = np.searchsorted(all_sids, old_sids)
+            for field in OHLCV_FIELDS:
+                out[field][r0:r1, cols] = old_arrays[field][:len(old_sessions)]
+        written = self._fill(out, sessions, all_sids, data)
+        self._commit(lattice, out, sessions, all_sids)
+
+        log.info("Written %d price rows to %s, lattice of %d sessions x %d sids." %
+                 (written, self._rootdir, len(sessions), len(all_sids)))
+
+    def write_from_sqlite(self, filenames, chunksize=5000000):
+        """Build the store from prices databases written by SQLiteDailyBarWriter.
+
+        The existing store is replaced. The lattice is sized once from the
+        date range and the sids of the databases, then filled chunk by chunk.
+
+        Args:
+            filenames: Path of the SQLite prices database, or list of paths
+                (e.g. the price shards of the years).
+            chunksize: Number of rows fetched per read.
+        """
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        first, last, sids = [], [], []
+        for filename in filenames:
+            with closing(sqlite3.connect(filename)) as con:
+                dates = con.execute("SELECT MIN(date), MAX(date) FROM prices").fetchone()
+                if dates[0] is None:
+                    continue
+                # text dates (schema version 1) or int64 nanoseconds (schema version 2)
+                first.append(pd.Timestamp(dates[0]))
+                last.append(pd.Timestamp(dates[1]))
+                sids.append(np.array([r[0] for r in con.execute("SELECT DISTINCT sid FROM prices")], dtype=np.int64))
+        if len(first) == 0:
+            log.info("No price data to write.")
+            return
+
+        sessions = self._calendar.sessions_in_range(min(first), max(last)).tz_localize(None)
+        all_sids = np.unique(np.concatenate(sids))
+        lattice, out = self._new_lattice(sessions, all_sids)
+        written = 0
+        query = "SELECT date, sid, open, high, low, close, volume FROM prices"
+        for filename in filenames:
+            with closing(sqlite3.connect(filename)) as con:
+                for df in pd.read_sql_query(query, con, chunksize=chunksize):
+                    df['date'] = pd.to_datetime(df['date'])
+                    written += self._fill(out, sessions, all_sids, df.set_index(['date', 'sid']))
+        self._commit(lattice, out, sessions, all_sids)
+
+        log.info("Written %d price rows of %d databases to %s, lattice of %d sessions x %d sids." %
+                 (written, len(filenames), self._rootdir, len(sessions), len(all_sids)))
+
+
+class MMapDailyBarReader(SessionBarReader):
+    """
+    Reader for pricing data written by MMapDailyBarWriter.
+
+    Replacement of SQLiteDailyBarReader for USEquityPricingLoader: prices
+    are float32 with NaN for missing bars, volume is uint32 with 0 for
+    missing bars.
+
+    See Also
+    --------
+    sharadar.data.sql_lite_daily_pricing.SQLiteDailyBarReader
+    """
+    def __init__(self, rootdir=os.path.join(get_data_dir(), "prices.mmap")):
+        self._rootdir = rootdir
+
+    def _path(self, filename):
+        return os.path.join(self._rootdir, filename)
+
+    @lazyval
+    def _store(self):
+        # all the files of the lattice of the properties are opened together, the memory maps stay valid if
+        # the store is rebuilt; the sessions are read first, the lattice files have at least their rows
+        with open(self._path(PROPERTIES_FILENAME)) as f:
+            properties = json.load(f)
+        lattice = self._path(properties['lattice'])
+        return (properties,
+                pd.DatetimeIndex(np.load(os.path.join(lattice, SESSIONS_FILENAME)).astype('datetime64[ns]')),
+                np.load(os.path.join(lattice, SIDS_FILENAME)),
+                {f: np.load(os.path.join(lattice, _field_filename(f)), mmap_mode='r') for f in OHLCV_FIELDS})
+
+    @property
+    def _properties(self):
+        return self._store[0]
+
+    @property
+    def _sessions(self):
+        return self._store[1]
+
+    @property
+    def _sids(self):
+        return self._store[2]
+
+    @lazyval
+    def _sid_index(self):
+        return pd.Index(self._sids)
+
+    @property
+    def _arrays(self):
+        return self._store[3]
+
+    def _sid_loc(self, sid):
+        """Column of a sid in the lattice.
+
+        Raises:
+            KeyError: If the sid does not exist.
+        """
+        return self._sid_index.get_loc(int(sid))
+
+    def get_value(self, sid, dt, field):
+        """Get a single field value for a sid on a specific date.
+
+        Args:
+            sid: Security identifier.
+            dt: Date to query.
+            field: Column name (e.g., 'close', 'volume').
+
+        Returns:
+            The scalar value for the requested field.
+
+        Raises:
+            NoDataBeforeDate: If no data exists on the date.
+            KeyError: If the sid does not exist.
+        """
+        col = self._sid_loc(sid)
+        row = self._sessions.get_indexer([pd.Timestamp(dt).tz_localize(None).normalize()])[0]
+        if row < 0 or np.isnan(self._arrays['close'][row, col]):
+            raise NoDataBeforeDate("No data on or before day={0} for sid={1}".format(dt, sid))
+        return float(self._arrays[field][row, col])
+
+    def load_raw_arrays(self, fields, start_dt, end_dt, sids):
+        """Load raw numpy arrays for pipeline computation.
+
+        Args:
+            fields: List of column names to load.
+            start_dt: Start date (inclusive).
+            end_dt: End date (inclusive).
+            sids: List of security identifiers.
+
+        Returns:
+            List of numpy arrays, one per field, each of shape
+            (num_sessions, num_sids).
+        """
+        sessions = self.trading_calendar.sessions_in_range(start_dt, end_dt)
+        log.debug("Loading raw arrays for %d assets (%s)." % (len(sids), type(sids)))
+
+        if any(not isinstance(x, (int, np.integer)) for x in sids):
+            sids = [x.sid for x in sids]
+
+        rows = self._sessions.get_indexer(sessions)
+        cols = self._sid_index.get_indexer(sids)
+        rows_contiguous = len(rows) > 0 and rows[0] >= 0 and np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows)))
+        cols_contiguous = len(cols) > 0 and cols[0] >= 0 and np.array_equal(cols, np.arange(cols[0], cols[0] + len(cols)))
+        rows_missing = rows < 0
+        cols_missing = cols < 0
+
+        raw_arrays = []
+        for field in fields:
+            arr = self._arrays[field]
+            if rows_contiguous:
+                block = arr[rows[0]:rows[0] + len(rows)]
+            else:
+                block = arr.take(np.where(rows_missing, 0, rows), axis=0)
+                block[rows_missing] = FIELD_MISSING_VALUES[field]
+
+            if cols_contiguous:
+                # zero-copy view of the memory-mapped file
+                data = block[:, cols[0]:cols[0] + len(cols)]
+            else:
+                data = block.take(np.where(cols_missing, 0, cols), axis=1)
+                data[:, cols_missing] = FIELD_MISSING_VALUES[field]
+            raw_arrays.append(data)
+
+        return raw_arrays
+
+    def get_last_traded_dt(self, sid, dt):
+        """Get the last traded datetime for a sid on or before dt.
+
+        Args:
+            sid: Security identifier.
+            dt: Date to query.
+
+        Returns:
+            pd.Timestamp or pd.NaT if no data found.
+
+        Raises:
+            KeyError: If the sid does not exist.
+        """
+        col = self._sid_loc(sid)
+        end = self._sessions.searchsorted(pd.Timestamp(dt).tz_localize(None).normalize(), side='right')
+        traded = np.flatnonzero(~np.isnan(self._arrays['close'][:end, col]))
+        if len(traded) == 0:
+            return pd.NaT
+        return self._sessions[traded[-1]]
+
+    @property
+    def last_available_dt(self):
+        if len(self._sessions) == 0:
+            return pd.NaT
+        return self._sessions[-1]
+
+    @property
+    def last_session(self):
+        """The last session recorded in the properties of the store, NaT if it is not recorded."""
+        last_session = self._properties.get('last_session')
+        return pd.NaT if last_session is None else pd.Timestamp(last_session)
+
+    @lazyval
+    def trading_calendar(self):
+        calendar_name = self._properties.get('calendar_name')
+        if calendar_name is None:
+            raise ValueError("No trading calendar defined.")
+        return get_calendar(calendar_name, start=pd.Timestamp('2000-01-01 00:00:00'))
+
+    @property
+    def first_trading_day(self):
+        if len(self._sessions) == 0:
+            return pd.NaT
+        return max(self._sessions[0], self.trading_calendar.first_session)
+
+    @property
+    def sessions(self):
+        cal = self.trading_calendar
+        return cal.sessions_in_range(self.first_trading_day, self.last_available_dt)
@@ -0,0 +1,242 @@
+"""Point-in-time arrays of supplementary data for a fixed set of sids.
+
+The full history of a field (e.g. 'revenue_arq') is loaded once for all the
+sids of a pipeline chunk. "The n-th latest value as of date" then becomes a
+vectorized lookup instead of a ROW_NUMBER() window query per pipeline day.
+
+The text fields (e.g. 'sector') change a few times in the life of an equity:
+CategoricalIntervals keeps their history as (sid, start, end, code) intervals
+and expands them to the codes of all the sessions of a chunk at once.
+"""
+import numpy as np
+import pandas as pd
+from zipline.lib.labelarray import LabelArray
+
+# padding for the unused slots of the dates matrix, greater than any date
+_NO_DATE = np.iinfo(np.int64).max
+
+
+class PointInTimeArrays(object):
+    """History of a single field for a fixed set of sids.
+
+    The records are stored in two (num sids x max records per sid) matrices,
+    sorted by start_date in ascending order and right padded.
+
+    Attributes:
+        sids: Security identifiers, the order of the rows.
+        dates: int64 start dates in nanoseconds, padded with int64 max.
+        values: float64 values, padded with NaN.
+    """
+    def __init__(self, sids, sid_values, start_dates, values):
+        """
+        Args:
+            sids: Security identifiers of the rows.
+            sid_values: sid of each record.
+            start_dates: start_date (nanoseconds) of each record.
+            values: float64 value of each record.
+        """
+        self.sids = np.asarray(sids, dtype=np.int64)
+        rows = pd.Index(self.sids).get_indexer(np.asarray(sid_values, dtype=np.int64))
+        start_dates = np.asarray(start_dates, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+
+        known = rows >= 0
+        rows, start_dates, values = rows[known], start_dates[known], values[known]
+        order = np.lexsort((start_dates, rows))
+        rows, start_dates, values = rows[order], start_dates[order], values[order]
+
+        counts = np.bincount(rows, minlength=len(self.sids))
+        width = max(counts.max(initial=0), 1)
+        cols = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+
+        self.dates = np.full((len(self.sids), width), _NO_DATE, dtype=np.int64)
+        self.values = np.full((len(self.sids), width), np.nan, dtype=np.float64)
+        self.dates[rows, cols] = start_dates
+        self.values[rows, cols] = values
+        self._counts = counts
+
+    @classmethod
+    def from_frame(cls, sids, df):
+        """Build from a frame with the columns sid, start_date and value.
+
+        Non numeric values (e.g. 'None') become NaN.
+        """
+        return cls(sids, df['sid'].values, df['start_date'].values,
+                   pd.to_numeric(df['value'], errors='coerce').values)
+
+    def __len__(self):
+        return int(self._counts.sum())
+
+    def _available(self, as_of_date):
+        # number of records per sid known as of the date (dates are sorted)
+        return (self.dates <= as_of_date.value).sum(axis=1)
+
+    def _nth_latest_index(self, as_of_date, n, max_age, available=None):
+        """Column of the n-th latest record per sid, -1 if there is none.
+
+        'max_age' (nanoseconds) discards records older than as_of_date - max_age.
+        'available' is the result of _available(as_of_date), if already computed.
+        """
+        if available is None:
+            available = self._available(as_of_date)
+        col = available - n
+        rows = np.arange(len(self.sids))
+        valid = col >= 0
+        if max_age is not None:
+            dates = self.dates[rows, np.maximum(col, 0)]
+            valid &= (as_of_date.value - dates) <= max_age
+        return np.where(valid, col, -1)
+
+    def latest_dates(self, as_of_date, n=1, max_age=None):
+        """Start date (float64 nanoseconds) of the n-th latest record, NaN if missing."""
+        col = self._nth_latest_index(as_of_date, n, max_age)
+        out = self.dates[np.arange(len(self.sids)), np.maximum(col, 0)].astype(np.float64)
+        out[col < 0] = np.nan
+        return out
+
+    def latest_values(self, as_of_date, n=1, max_age=None):
+        """Value of the n-th latest record (n=1 is the most recent), NaN if missing."""
+        col = self._nth_latest_index(as_of_date, n, max_age)
+        out = self.values[np.arange(len(self.sids)), np.maximum(col, 0)]
+        out[col < 0] = np.nan
+        return out
+
+    def sum_latest_values(self, as_of_date, first, last, max_age=None):
+        """Sum of the values from the first-th to the last-th latest records.
+
+        NaN for sids without any of these records, like a SQL SUM().
+        """
+        available = self._available(as_of_date)
+        rows = np.arange(len(self.sids))
+        total = np.zeros(len(self.sids))
+        found = np.zeros(len(self.sids), dtype=bool)
+        for n in range(first, last + 1):
+            col = self._nth_latest_index(as_of_date, n, max_age, available)
+            values = self.values[rows, np.maximum(col, 0)]
+            present = (col >= 0) & ~np.isnan(values)
+            total[present] += values[present]
+            found |= present
+        total[~found] = np.nan
+        return total
+
+    def window_values(self, as_of_date, window_length, min_date=None):
+        """The latest 'window_length' values, the most recent first.
+
+        Args:
+            as_of_date: Point in time of the lookup.
+            window_length: Number of records per sid.
+            min_date: Optional pd.Timestamp, older records are ignored.
+
+        Returns:
+            numpy.ndarray: Array of shape (window_length, num sids).
+        """
+        available = self._available(as_of_date)
+        rows = np.arange(len(self.sids))
+        out = np.full((window_length, len(self.sids)), np.nan)
+        for n in range(1, window_length + 1):
+            col = available - n
+            valid = col >= 0
+            if min_date is not None:
+                valid &= self.dates[rows, np.maximum(col, 0)] >= min_date.value
+            out[n - 1, valid] = self.values[rows[valid], col[valid]]
+        return out
+
+
+class CategoricalIntervals(object):
+    """History of a text field for a fixed set of sids, as intervals of codes.
+
+    The value of a sid is the code of its interval from the start date
+    (inclusive) to the end date (exclusive). The consecutive records of a sid
+    with the same value are merged into one interval.
+
+    Attributes:
+        sids: Security identifiers, the columns of the codes.
+        categories: object array of the labels of the codes, the missing value is the last one
+            unless given in the categories.
+        missing_value: Label of the dates without a value.
+        columns: Column of the sid of each interval.
+        starts: int64 start dates in nanoseconds.
+        ends: int64 end dates in nanoseconds, int64 max for the current values.
+        codes: Code of each interval.
+    """
+    def __init__(self, sids, sid_values, start_dates, values, categories=None, missing_value='NA'):
+        """
+        Args:
+            sids: Security identifiers of the columns.
+            sid_values: sid of each record.
+            start_dates: start_date (nanoseconds) of each record.
+            values: Text value of each record.
+            categories: Known labels, the other values are missing. Default: all the values.
+            missing_value: Label of the dates without a value.
+        """
+        self.sids = np.asarray(sids, dtype=np.int64)
+        self.missing_value = missing_value
+        columns = pd.Index(self.sids).get_indexer(np.asarray(sid_values, dtype=np.int64))
+        start_dates = np.asarray(start_dates, dtype=np.int64)
+        values = np.asarray(values, dtype=object)
+
+        if categories is None:
+            categories = sorted(set(values.tolist()) - {missing_value})
+        categories = list(categories)
+        if missing_value not in categories:
+            categories.append(missing_value)
+        self.categories = np.asarray(categories, dtype=object)
+        codes = pd.Index(self.categories).get_indexer(values)
+        codes[codes < 0] = categories.index(missing_value)
+
+        known = columns >= 0
+        columns, start_dates, codes = columns[known], start_dates[known], codes[known]
+        order = np.lexsort((start_dates, columns))
+        columns, start_dates, codes = columns[order], start_dates[order], codes[order]
+
+        # a record starts an interval if it is the first of its sid or changes the value
+        first = np.ones(len(columns), dtype=bool)
+        first[1:] = (columns[1:] != columns[:-1]) | (codes[1:] != codes[:-1])
+        self.columns, self.starts, self.codes = columns[first], start_dates[first], codes[first]
+        self.ends = np.full(len(self.columns), _NO_DATE, dtype=np.int64)
+        same_sid = self.columns[1:] == self.columns[:-1]
+        self.ends[:-1][same_sid] = self.starts[1:][same_sid]
+
+    @classmethod
+    def from_frame(cls, sids, df, categories=None, missing_value='NA'):
+        """Build from a frame with the columns sid, start_date and value."""
+        return cls(sids, df['sid'].values, df['start_date'].values, df['value'].values, categories, missing_value)
+
+    def __len__(self):
+        return len(self.columns)
+
+    @property
+    def missing_code(self):
+        return int(np.flatnonzero(self.categories == self.missing_value)[0])
+
+    def codes_of(self, dates):
+        """The code of each sid on each date.
+
+        The intervals of a sid do not overlap: each one adds its code + 1 to
+        the rows of its dates with a difference at its first and after its
+        last row, summed over the dates.
+
+        Args:
+            dates: DatetimeIndex of the dates, sorted.
+
+        Returns:
+            numpy.ndarray: int64 array of shape (num dates, num sids), the missing code where there is no value.
+        """
+        dates = pd.DatetimeIndex(dates).asi8
+        first_rows = np.searchsorted(dates, self.starts, side='left')
+        end_rows = np.searchsorted(dates, self.ends, side='left')
+        deltas = np.zeros((len(dates) + 1, len(self.sids)), dtype=np.int64)
+        np.add.at(deltas, (first_rows, self.columns), self.codes + 1)
+        np.add.at(deltas, (end_rows, self.columns), -(self.codes + 1))
+        out = np.cumsum(deltas[:-1], axis=0) - 1
+        out[out < 0] = self.missing_code
+        return out
+
+    def label_array(self, dates):
+        """The values of each sid on each date as a LabelArray of shape (num dates, num sids)."""
+        return LabelArray.from_codes_and_metadata(
+            codes=self.codes_of(dates),
+            categories=self.categories,
+            reverse_categories={label: code for code, label in enumerate(self.categories)},
+            missing_value=self.missing_value,
+        )
@@ -0,0 +1,179 @@
+"""Manifest of a prices database written by SQLiteDailyBarWriter.
+
+The manifest is a JSON file next to the database (prices.sqlite.manifest.json)
+with the calendar name, the session range and the first and last traded
+date of each sid, so that SQLiteDailyBarReader answers its metadata
+queries from memory instead of aggregate SQL queries.
+
+The manifest records the file change counter of the SQLite header, which
+SQLite increments with every committed write: a manifest is valid only if
+the counter of the database is the same, otherwise the database was
+modified without updating the manifest (e.g. by delete_otc) and the reader
+falls back to SQL.
+"""
+import json
+import os
+import sqlite3
+import struct
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+# offset of the file change counter in the header of a SQLite database
+_CHANGE_COUNTER_OFFSET = 24
+
+
+def manifest_path(filename):
+    """Path of the manifest of a prices database."""
+    return filename + MANIFEST_SUFFIX
+
+
+def change_counter(filename):
+    """File change counter of a SQLite database, None if the file is missing or empty."""
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(_CHANGE_COUNTER_OFFSET)
+            data = f.read(4)
+    except OSError:
+        return None
+    if len(data) < 4:
+        return None
+    return struct.unpack('>I', data)[0]
+
+
+class PricesManifest(object):
+    """Calendar, session range and per sid traded range of a prices database.
+
+    Attributes:
+        calendar_name: Name of the trading calendar.
+        sids: Sorted int64 array of the sids with prices.
+        first_traded: datetime64[ns] array of the first traded date of each sid.
+        last_traded: datetime64[ns] array of the last traded date of each sid.
+        change_counter: File change counter of the database described by the manifest.
+    """
+    def __init__(self, calendar_name, sids, first_traded, last_traded, change_counter=None):
+        order = np.argsort(sids, kind='stable')
+        self.calendar_name = calendar_name
+        self.sids = np.asarray(sids, dtype=np.int64)[order]
+        self.first_traded = np.asarray(first_traded, dtype='datetime64[ns]')[order]
+        self.last_traded = np.asarray(last_traded, dtype='datetime64[ns]')[order]
+        self.change_counter = change_counter
+        self._sid_index = pd.Index(self.sids)
+
+    @property
+    def first_session(self):
+        return pd.Timestamp(self.first_traded.min()) if len(self.sids) > 0 else pd.NaT
+
+    @property
+    def last_session(self):
+        return pd.Timestamp(self.last_traded.max()) if len(self.sids) > 0 else pd.NaT
+
+    def __contains__(self, sid):
+        return int(sid) in self._sid_index
+
+    def traded_range(self, sid):
+        """First and last traded date of a sid.
+
+        Raises:
+            KeyError: If the sid has no prices.
+        """
+        i = self._sid_index.get_loc(int(sid))
+        return pd.Timestamp(self.first_traded[i]), pd.Timestamp(self.last_traded[i])
+
+    def update(self, sids, dates):
+        """The manifest after writing prices on the (sid, date) pairs.
+
+        Args:
+            sids: Sids of the written rows.
+            dates: Dates of the written rows.
+
+        Returns:
+            PricesManifest: Without change counter.
+        """
+        written = pd.DataFrame({'sid': np.asarray(sids, dtype=np.int64),
+                                'date': pd.DatetimeIndex(dates).tz_localize(None)})
+        current = pd.DataFrame({'sid': np.concatenate([self.sids, self.sids]),
+                                'date': np.concatenate([self.first_traded, self.last_traded])})
+        ranges = pd.concat([current, written]).groupby('sid')['date'].agg(['min', 'max'])
+        return PricesManifest(self.calendar_name, ranges.index.values, ranges['min'].values, ranges['max'].values)
+
+    @classmethod
+    def from_database(cls, filename):
+        """Build the manifest of a prices database with an aggregate query per sid.
+
+        Args:
+            filename: Path of the prices database.
+
+        Returns:
+            PricesManifest
+        """
+        with closing(sqlite3.connect(filename)) as con:
+            manifest = cls.from_connection(con)
+        manifest.change_counter = change_counter(filename)
+        return manifest
+
+    @classmethod
+    def from_connection(cls, con):
+        """Build the manifest of the prices database of a connection, e.g. an in-memory database.
+
+        Args:
+            con: sqlite3.Connection to the prices database.
+
+        Returns:
+            PricesManifest: Without change counter.
+        """
+        res = con.execute('SELECT "0" FROM properties WHERE key="calendar_name"').fetchall()
+        calendar_name = res[0][0] if len(res) > 0 else None
+        rows = con.execute("SELECT sid, MIN(date), MAX(date) FROM prices GROUP BY sid").fetchall()
+        sids = np.array([r[0] for r in rows], dtype=np.int64)
+        # text dates (schema version 1) or int64 nanoseconds (schema version 2)
+        first = pd.to_datetime([r[1] for r in rows]).values
+        last = pd.to_datetime([r[2] for r in rows]).values
+        return cls(calendar_name, sids, first, last)
+
+    def save(self, filename):
+        """Save the manifest of the prices database, recording its current change counter.
+
+        Args:
+            filename: Path of the prices database.
+        """
+        self.change_counter = change_counter(filename)
+        manifest = {
+            'calendar_name': self.calendar_name,
+            'change_counter': self.change_counter,
+            'first_session': str(self.first_session.date()) if len(self.sids) > 0 else None,
+            'last_session': str(self.last_session.date()) if len(self.sids) > 0 else None,
+            'sids': self.sids.tolist(),
+            'first_traded': self.first_traded.view(np.int64).tolist(),
+            'last_traded': self.last_traded.view(np.int64).tolist(),
+        }
+        path = manifest_path(filename)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, filename):
+        """Load the manifest of a prices database.
+
+        Args:
+            filename: Path of the prices database.
+
+        Returns:
+            PricesManifest, None if the manifest is missing or does not match the database.
+        """
+        path = manifest_path(filename)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['change_counter'] is None or manifest['change_counter'] != change_counter(filename):
+            return None
+        return cls(manifest['calendar_name'],
+                   np.array(manifest['sids'], dtype=np.int64),
+                   np.array(manifest['first_traded'], dtype=np.int64).view('datetime64[ns]'),
+                   np.array(manifest['last_traded'], dtype=np.int64).view('datetime64[ns]'),
+                   manifest['change_counter'])
@@ -0,0 +1,395 @@
+"""Daily prices stored in one SQLite database per calendar year.
+
+The shards are prices-YYYY.sqlite files of a prices.shards directory next to
+prices.sqlite, each one a prices database of SQLiteDailyBarWriter with its
+own manifest. The B-trees of a shard are a fraction of the size of the ones
+of a single database, the queries of the reader are routed only to the
+shards that overlap the requested dates, and an incremental ingest writes
+only the shard of the current year: the older shards can be opened as
+immutable.
+
+A bundle uses the sharded layout if its prices.shards directory exists, see
+shard_prices to convert a prices.sqlite.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+from zipline.data.bar_reader import NoDataBeforeDate
+from zipline.data.session_bars import SessionBarReader
+
+from sharadar.data.prices_manifest import PricesManifest
+from sharadar.data.sql_lite_daily_pricing import (
+    BULK_LOAD_PRAGMAS,
+    DEFAULT_SESSION_CACHE_SIZE,
+    PRICE_FIELDS,
+    PRICES_INDEXES,
+    SCHEMA_V2,
+    SQLiteDailyBarReader,
+    SQLiteDailyBarWriter,
+    date_keys,
+    previous_session_values,
+    prices_schema_version,
+)
+from sharadar.util.logger import log
+
+SHARDS_DIRNAME = 'prices.shards'
+
+_SHARD_PATTERN = re.compile(r'^prices-(\d{4})\.sqlite$')
+
+
+def shards_dir(output_dir):
+    """Directory of the price shards of a bundle directory."""
+    return os.path.join(output_dir, SHARDS_DIRNAME)
+
+
+def shard_path(directory, year):
+    """Path of the shard of a year."""
+    return os.path.join(directory, 'prices-%d.sqlite' % year)
+
+
+def shard_years(directory):
+    """Sorted years of the shards of a directory."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(m.group(1)) for m in map(_SHARD_PATTERN.match, os.listdir(directory)) if m is not None)
+
+
+class ShardedDailyBarWriter(object):
+    """Writes daily OHLCV bars to the shards of their year.
+
+    Attributes:
+        _directory: Directory of the shards.
+        _calendar: Trading calendar used for session alignment.
+    """
+    def __init__(self, directory, calendar):
+        self._directory = directory
+        self._calendar = calendar
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, data, batch_size=100000):
+        """Write OHLCV price data, each row to the shard of its year.
+
+        Args:
+            data: DataFrame indexed by ['date', 'sid'] with the columns
+                open, high, low, close and volume.
+            batch_size: Number of rows per executemany call.
+        """
+        if not isinstance(data, pd.DataFrame):
+            raise ValueError("data must be an instance of DataFrame.")
+        if data.index.names != ['date', 'sid']:
+            raise ValueError("data indexes must be ['date', 'sid'].")
+
+        years = data.index.get_level_values('date').year
+        for year in np.unique(years):
+            log.info("Writing the prices of %d to %s..." % (year, shard_path(self._directory, year)))
+            SQLiteDailyBarWriter(shard_path(self._directory, year), self._calendar).write(data[years == year],
+                                                                                        batch_size)
+
+
+class ShardedDailyBarReader(SessionBarReader):
+    """
+    Reader for pricing data written by ShardedDailyBarWriter.
+
+    Drop-in replacement of SQLiteDailyBarReader: each query is routed to the
+    shards of the years it spans.
+    """
+    def __init__(self, directory, immutable=False, session_cache_size=DEFAULT_SESSION_CACHE_SIZE):
+        """Initialize the reader.
+
+        Args:
+            directory: Directory of the shards.
+            immutable: If True, the shards before the last one are opened as immutable
+                (no file locks), only if they are not written while the reader is in use.
+            session_cache_size: Number of sessions whose prices are kept in memory by each shard.
+        """
+        self._directory = directory
+        self._immutable = immutable
+        self._session_cache_size = session_cache_size
+        self._shards = {}
+        self._lock = threading.Lock()
+        # (years, sids) of the shards before the last one, see _exist_sid
+        self._closed_sids = None
+
+    def _years(self):
+        years = shard_years(self._directory)
+        if len(years) == 0:
+            raise ValueError("No price shards in %s." % self._directory)
+        return years
+
+    def _shard(self, year):
+        """The reader of the shard of a year, None if there is no shard."""
+        with self._lock:
+            shard = self._shards.get(year)
+            if shard is None:
+                years = shard_years(self._directory)
+                if year not in years:
+                    return None
+                shard = self._shards[year] = SQLiteDailyBarReader(
+                    shard_path(self._directory, year),
+                    immutable=self._immutable and year < years[-1],
+                    session_cache_size=self._session_cache_size)
+            return shard
+
+    def close(self):
+        """Close the pooled connections of the shards."""
+        with self._lock:
+            shards, self._shards = self._shards, {}
+        for shard in shards.values():
+            shard.close()
+
+    @staticmethod
+    def _check_field(field):
+        if field not in PRICE_FIELDS:
+            raise ValueError("Unknown price field: %s" % field)
+        return field
+
+    def _closed_shards_sids(self, years):
+        """The sids of the shards of years, read once: the shards before the last one are not written anymore."""
+        years = tuple(years)
+        with self._lock:
+            if self._closed_sids is not None and self._closed_sids[0] == years:
+                return self._closed_sids[1]
+        sids = set()
+        for year in years:
+            shard = self._shard(year)
+            manifest = shard.manifest
+            if manifest is not None:
+                sids.update(manifest.sids.tolist())
+            else:
+                sids.update(r[0] for r in shard._query("SELECT DISTINCT sid FROM prices"))
+        with self._lock:
+            self._closed_sids = (years, frozenset(sids))
+        return self._closed_sids[1]
+
+    def _exist_sid(self, sid):
+        years = self._years()
+        return self._shard(years[-1])._exist_sid(sid) or int(sid) in self._closed_shards_sids(years[:-1])
+
+    @property
+    def trading_calendar(self):
+        return self._shard(self._years()[0]).trading_calendar
+
+    @property
+    def first_trading_day(self):
+        return self._shard(self._years()[0]).first_trading_day
+
+    @property
+    def last_available_dt(self):
+        return self._shard(self._years()[-1]).last_available_dt
+
+    @property
+    def sessions(self):
+        cal = self.trading_calendar
+        return cal.sessions_in_range(self.first_trading_day, self.last_available_dt)
+
+    def get_value(self, sid, dt, field):
+        """Get a single field value for a sid on a specific date.
+
+        Args:
+            sid: Security identifier.
+            dt: Date to query.
+            field: Column name (e.g., 'close', 'volume').
+
+        Returns:
+            The scalar value for the requested field.
+
+        Raises:
+            NoDataBeforeDate: If no data exists on the date.
+            KeyError: If the sid does not exist.
+        """
+        self._check_field(field)
+        shard = self._shard(pd.Timestamp(dt).year)
+        if shard is not None:
+            try:
+                return shard.get_value(sid, dt, field)
+            except KeyError:
+                # the sid may have prices in the shards of other years
+                pass
+        if self._exist_sid(sid):
+            raise NoDataBeforeDate("No data on or before day={0} for sid={1}".format(dt, sid))
+        raise KeyError(sid)
+
+    def get_values(self, sids, dt, field):
+        """Get a field value for many sids on a specific date.
+
+        Args:
+            sids: Security identifiers.
+            dt: Date to query.
+            field: Column name (e.g., 'close', 'volume').
+
+        Returns:
+            np.ndarray: The values of the sids, NaN for the sids without data on the date.
+        """
+        self._check_field(field)
+        shard = self._shard(pd.Timestamp(dt).year)
+        if shard is None:
+            return np.full(len(sids), np.nan)
+        return shard.get_values(sids, dt, field)
+
+    def get_session_values(self, sids, sessions, field):
+        """Get a field value for many (sid, session) pairs, see SQLiteDailyBarReader.get_session_values."""
+        self._check_field(field)
+        sids = np.asarray([int(x) for x in sids], dtype=np.int64)
+        sessions = pd.DatetimeIndex(sessions).tz_localize(None)
+        values = np.full(len(sids), np.nan)
+        years = sessions.year
+        for year in np.unique(years):
+            shard = self._shard(year)
+            if shard is not None:
+                pairs = np.flatnonzero(years == year)
+                values[pairs] = shard.get_session_values(sids[pairs], sessions[pairs], field)
+        return values
+
+    def get_previous_values(self, sids, dts, field):
+        """Get a field value for many (sid, date) pairs on the session before each date.
+
+        The previous session of the first session of a year is in the shard of the year before.
+        """
+        self._check_field(field)
+        return previous_session_values(self, sids, dts, field)
+
+    def load_dataframe(self, field, start_dt, end_dt, sids):
+        """Load price data as a DataFrame with sessions as index, see SQLiteDailyBarReader.load_dataframe."""
+        data = self.load_raw_arrays([field], start_dt, end_dt, sids)
+        sessions = self.trading_calendar.sessions_in_range(start_dt, end_dt)
+        df = pd.DataFrame(data[0], index=sessions)
+        df.columns = sids
+        return df
+
+    def load_series(self, field, start_dt, end_dt, sid):
+        """Load price data for a single sid as a Series, see SQLiteDailyBarReader.load_series."""
+        data = self.load_raw_arrays([field], start_dt, end_dt, [sid])
+        sessions = self.trading_calendar.sessions_in_range(start_dt, end_dt)
+        return pd.Series(data[0][:, 0], index=sessions)
+
+    def load_raw_arrays(self, fields, start_dt, end_dt, sids):
+        """Load raw numpy arrays for pipeline computation.
+
+        The rows of each year are loaded from its shard, the years without a
+        shard are NaN.
+
+        Args:
+            fields: List of column names to load.
+            start_dt: Start date (inclusive).
+            end_dt: End date (inclusive).
+            sids: List of security identifiers.
+
+        Returns:
+            List of numpy arrays, one per field, each of shape
+            (num_sessions, num_sids).
+        """
+        fields = [self._check_field(field) for field in fields]
+        sessions = self.trading_calendar.sessions_in_range(start_dt, end_dt)
+        arrays = [np.full((len(sessions), len(sids)), np.nan) for _ in fields]
+        years = sessions.year
+        for year in np.unique(years):
+            shard = self._shard(year)
+            if shard is None:
+                continue
+            rows = np.flatnonzero(years == year)
+            year_arrays = shard.load_raw_arrays(fields, sessions[rows[0]], sessions[rows[-1]], sids)
+            for array, year_array in zip(arrays, year_arrays):
+                array[rows] = year_array
+        return arrays
+
+    def get_last_traded_dt(self, sid, dt):
+        """Get the last traded datetime for a sid on or before dt.
+
+        The shards are searched from the year of dt backwards.
+
+        Args:
+            sid: Security identifier.
+            dt: Date to query.
+
+        Returns:
+            pd.Timestamp or pd.NaT if no data found.
+
+        Raises:
+            KeyError: If the sid does not exist.
+        """
+        year = pd.Timestamp(dt).year
+        for shard_year in reversed(self._years()):
+            if shard_year > year:
+                continue
+            try:
+                last_traded = self._shard(shard_year).get_last_traded_dt(sid, dt)
+            except KeyError:
+                continue
+            if last_traded is not pd.NaT:
+                return last_traded
+        if not self._exist_sid(sid):
+            raise KeyError(sid)
+        return pd.NaT
+
+
+def shard_prices(filename, directory=None):
+    """Split a prices database into the shards of its years.
+
+    The shards use the schema version 2, the rows of each year are copied in
+    SQLite from the database attached to its shard. The source database is
+    not modified.
+
+    Args:
+        filename: Path of the prices database.
+        directory: Directory of the shards, defaults to prices.shards next to the database.
+
+    Returns:
+        str: The directory of the shards.
+
+    Raises:
+        ValueError: If there is no prices table or the directory already contains shards.
+    """
+    if directory is None:
+        directory = shards_dir(os.path.dirname(os.path.abspath(filename)))
+    if len(shard_years(directory)) > 0:
+        raise ValueError("The directory %s already contains price shards." % directory)
+
+    with closing(sqlite3.connect(filename)) as con:
+        version = prices_schema_version(con)
+        if version is None:
+            raise ValueError("No prices table in %s." % filename)
+        first, last = con.execute("SELECT MIN(date), MAX(date) FROM prices").fetchone()
+    if version == 2:
+        date = 'date'
+    else:
+        date = "CAST(strftime('%s', date) AS INTEGER) * 1000000000"
+
+    start_time = time.time()
+    rows = 0
+    os.makedirs(directory, exist_ok=True)
+    for year in range(pd.Timestamp(first).year, pd.Timestamp(last).year + 1):
+        start, end = date_keys([pd.Timestamp(year, 1, 1), pd.Timestamp(year + 1, 1, 1)], version).tolist()
+        target = shard_path(directory, year)
+        with closing(sqlite3.connect(target)) as con, closing(con.cursor()) as c:
+            c.executescript(SCHEMA_V2)
+            for pragma in BULK_LOAD_PRAGMAS:
+                c.execute(pragma)
+            c.execute("ATTACH DATABASE ? AS source", (filename,))
+            with con:
+                c.execute("BEGIN")
+                for index_name, _ in PRICES_INDEXES[2]:
+                    c.execute('DROP INDEX IF EXISTS "%s"' % index_name)
+                c.execute('INSERT INTO prices (date, sid, open, high, low, close, volume) '
+                          'SELECT %s, sid, open, high, low, close, volume FROM source.prices '
+                          'WHERE date >= ? AND date < ? ORDER BY sid, date' % date, (start, end))
+                count = c.rowcount
+                c.execute('INSERT INTO properties ("key", "0") SELECT "key", "0" FROM source.properties')
+                for index_name, column in PRICES_INDEXES[2]:
+                    c.execute('CREATE INDEX IF NOT EXISTS "%s" ON "prices" ("%s")' % (index_name, column))
+            c.execute("DETACH DATABASE source")
+        if count == 0:
+            # a year without prices
+            os.remove(target)
+            continue
+        PricesManifest.from_database(target).save(target)
+        rows += count
+
+    log.info("Split %d price rows of %s into %d shards in %s in %.1f seconds." %
+             (rows, filename, len(shard_years(directory)), directory, time.time() - start_time))
+    return directory
@@ -3,16 +3,30 @@
 Provides SQLiteAssetFinder for querying equity metadata, fundamentals,
 and daily metrics from a SQLite database, and SQLiteAssetDBWriter for
 writing asset data with supplementary mappings.
+
+The numeric fields are read from the fundamentals table, see
+equity_supplementary_util. The fields missing from its dictionary, e.g. in
+an asset database ingested before it, are read from
+equity_supplementary_mappings.
+
+The queries select their sids from a temporary table of the connection,
+filled once per set of sids, see SQLiteAssetFinder._sid_set.
 """
+import hashlib
+import json
 import os
 import time
 import warnings
+from collections import OrderedDict
 from datetime import timedelta
 
 import numpy as np
 import pandas as pd
 from exchange_calendars import get_calendar
 from pandas.tseries.offsets import DateOffset
+from sharadar.data.point_in_time import PointInTimeArrays, CategoricalIntervals
+from sharadar.data.prices_manifest import change_counter
+from sharadar.util.equity_supplementary_util import FUNDAMENTALS_SCHEMA, TTM_YEARS
 from sharadar.util.logger import log
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import OperationalError
@@ -29,6 +43,15 @@ from zipline.assets.asset_db_schema import (
 )
 from zipline.utils.memoize import lazyval
 
+# Max delay of a SEC filing: 5 months in nanoseconds
+MAX_DELAY = 1.296e+16
+
+# Number of (field, sids) histories kept in memory by SQLiteAssetFinder
+POINT_IN_TIME_CACHE_SIZE = 32
+
+# Number of sid sets kept in temporary tables by each connection of SQLiteAssetFinder
+SID_SETS_PER_CONNECTION = 8
+
 
 class SQLiteAssetFinder(AssetFinder):
 
@@ -40,10 +63,21 @@ class SQLiteAssetFinder(AssetFinder):
     Attributes:
         is_live_trading: When True, extends end_date/auto_close_date by 5 days
             to support live pipeline usage.
+        point_in_time_cache_size: Number of fundamentals histories kept in
+            memory, 0 disables the cache. The cache is bypassed in live trading,
+            because the database is updated while the process is running, and
+            dropped when the change counter of the database file changes.
     """
     def __init__(self, engine):
         super().__init__(engine)
         self.is_live_trading = False
+        self.point_in_time_cache_size = POINT_IN_TIME_CACHE_SIZE
+        self._point_in_time_cache = OrderedDict()
+        self._field_ids = {}
+        self._missing_fields = set()
+        self._counter = None
+        self._refresh()
+        self._ttm_written = False
 
     def _retrieve_asset_dicts(self, sids, asset_tbl, querying_equities):
         """Retrieve asset dictionaries, extending dates for live trading.
@@ -81,69 +115,242 @@ class SQLiteAssetFinder(AssetFinder):
         warnings.warn("get_supplementary_field is deprecated", DeprecationWarning)
         raise NotImplementedError()
 
-    def _get_inner_select(self):
-        """Build the inner SQL SELECT for supplementary mappings lookup.
+    def _use_point_in_time_cache(self):
+        return self.point_in_time_cache_size > 0 and not self.is_live_trading
+
+    def _point_in_time(self, sids, field_name):
+        """Load the whole history of a field for the given sids, once.
+
+        A pipeline chunk passes the same sids every day, so the per-day
+        lookups of the chunk are served by a single query.
+
+        Args:
+            sids: Security identifiers.
+            field_name: The supplementary mapping field name.
+
+        Returns:
+            PointInTimeArrays: The history of the field, rows ordered as sids.
+        """
+        self._refresh()
+        sids = np.asarray(sids, dtype=np.int64)
+        key = (field_name, sids.tobytes())
+        pit = self._point_in_time_cache.get(key)
+        if pit is not None:
+            self._point_in_time_cache.move_to_end(key)
+            return pit
+
+        table, condition, params = self._field_source(field_name)
+        sql = "SELECT sid, start_date, value FROM %s WHERE %s AND sid IN (SELECT sid FROM %s)"
+        with self.engine.connect() as conn:
+            cmd = sql % (table, condition, self._sid_set(conn, sids))
+            pit = PointInTimeArrays.from_frame(sids, pd.read_sql_query(text(cmd), conn, params=params))
+        log.debug("Loaded %d records of '%s' for %d assets." % (len(pit), field_name, len(sids)))
+
+        self._point_in_time_cache[key] = pit
+        while len(self._point_in_time_cache) > self.point_in_time_cache_size:
+            self._point_in_time_cache.popitem(last=False)
+        return pit
+
+    def clear_point_in_time_cache(self):
+        """Drop the preloaded fundamentals and the field ids, e.g. after an ingest."""
+        self._point_in_time_cache.clear()
+        self._field_ids = {}
+        self._missing_fields = set()
+
+    def _refresh(self):
+        """Drop the preloaded fundamentals and field ids if the database file has changed since they were loaded."""
+        database = self.engine.url.database
+        counter = change_counter(database) if database else None
+        if counter != self._counter:
+            self._counter = counter
+            self.clear_point_in_time_cache()
+
+    def _field_id(self, field_name):
+        """The id of a field in fundamental_fields, None if the field is not in the fundamentals table.
+
+        The dictionary is reloaded when a field is missing, since an ingest can add fields. The
+        missing fields (e.g. 'sector') are remembered until the database file changes, or
+        clear_point_in_time_cache is called.
+        """
+        if field_name in self._missing_fields:
+            self._refresh()
+        if field_name not in self._field_ids and field_name not in self._missing_fields:
+            try:
+                with self.engine.connect() as conn:
+                    rows = conn.execute(text("SELECT field, field_id FROM fundamental_fields")).fetchall()
+                self._field_ids = dict(rows)
+            except OperationalError:
+                # an asset database ingested before the fundamentals table
+                self._field_ids = {}
+            self._missing_fields.difference_update(self._field_ids)
+            if field_name not in self._field_ids:
+                self._missing_fields.add(field_name)
+        return self._field_ids.get(field_name)
+
+    def _field_source(self, field_name):
+        """The table and the WHERE condition of the rows of a numeric field.
+
+        Returns:
+            Tuple of the table name, the SQL condition and its bound parameters.
+        """
+        field_id = self._field_id(field_name)
+        if field_id is None:
+            return 'equity_supplementary_mappings', "field = :field", {'field': field_name}
+        return 'fundamentals', "field_id = :field_id", {'field_id': field_id}
+
+    def _sid_set(self, conn, sids):
+        """The temporary table of a set of sids on a connection, filled once per set.
+
+        A pipeline chunk passes the same sids every day: its queries select the
+        sids from the table instead of inlining them, so that SQLite does not
+        parse a statement of thousands of literals every day and reuses the
+        prepared statement. The tables are keyed by a hash of the sids, the
+        SID_SETS_PER_CONNECTION most recently used are kept in the temp schema
+        of each connection.
+
+        Args:
+            conn: SQLAlchemy connection of the queries.
+            sids: Security identifiers.
 
         Returns:
-            str: SQL query string with placeholders for sids, field, date, and delay.
+            str: Qualified name of the table, with a sid column.
+        """
+        sids = np.asarray(sids, dtype=np.int64)
+        name = 'sids_%s' % hashlib.md5(sids.tobytes()).hexdigest()[:16]
+        sid_sets = conn.info.setdefault('sid_sets', OrderedDict())
+        if name in sid_sets:
+            sid_sets.move_to_end(name)
+            return 'temp.' + name
+
+        while len(sid_sets) >= SID_SETS_PER_CONNECTION:
+            conn.exec_driver_sql('DROP TABLE IF EXISTS temp.%s' % sid_sets.popitem(last=False)[0])
+        conn.exec_driver_sql('CREATE TEMP TABLE IF NOT EXISTS %s (sid INTEGER PRIMARY KEY)' % name)
+        conn.exec_driver_sql('INSERT OR IGNORE INTO temp.%s VALUES (?)' % name, [(x,) for x in sids.tolist()])
+        # the rows are rolled back with the connection if not committed
+        conn.commit()
+        sid_sets[name] = len(sids)
+        return 'temp.' + name
+
+    def _get_inner_select(self, table='equity_supplementary_mappings'):
+        """Build the inner SQL SELECT for the lookup of a field.
+
+        Args:
+            table: 'equity_supplementary_mappings' or 'fundamentals', see _field_source.
+
+        Returns:
+            str: SQL query string with placeholders for the sids subquery and the field condition,
+            and the bound parameters :as_of, :date_check and :max_age.
         """
         sql = ("SELECT sid, value, "
                "ROW_NUMBER() OVER (PARTITION BY sid "
                "ORDER BY start_date DESC) AS rown "
-               "FROM equity_supplementary_mappings "
+               "FROM " + table + " "
                "WHERE sid IN (%s) "
-               "AND field = '%s' "
-               "AND start_date <= %d "
-               "AND (%d - start_date) <= %d "
+               "AND %s "
+               "AND start_date <= :as_of "
+               "AND (:date_check - start_date) <= :max_age "
                )
         return sql
 
-    def _get_result(self, sids, field_name, as_of_date, n, enforce_date):
+    def _get_result(self, sids, field_name, as_of_date, n, enforce_date, numeric=True):
         """
         'enforce_date' is relevant for fundamentals to avoid delinquent SEC files.
+        'numeric' is False for the text fields, always read from equity_supplementary_mappings.
         """
-        MAX_DELAY = 1.296e+16  # 5 months
-        sql = "SELECT sid, value FROM (" + self._get_inner_select() + ") t WHERE rown = %d;"
+        if numeric:
+            table, condition, params = self._field_source(field_name)
+        else:
+            table, condition, params = 'equity_supplementary_mappings', "field = :field", {'field': field_name}
 
         if as_of_date is None:
             as_of_date = pd.Timestamp.today()
 
-        date_check = as_of_date.value if enforce_date else 0
-        cmd = sql % (', '.join(map(str, sids)), field_name, as_of_date.value, date_check, n * MAX_DELAY, n)
+        params.update(as_of=as_of_date.value, date_check=as_of_date.value if enforce_date else 0,
+                      max_age=int(n * MAX_DELAY), n=n)
         with self.engine.connect() as conn:
-            return conn.execute(text(cmd)).fetchall()
+            sid_set = self._sid_set(conn, sids)
+            if table == 'fundamentals':
+                # the n-th latest record of each sid is a seek on the primary key, without the window of its
+                # history. The records older than the max delay are not numbered, the n-th latest one is too old
+                # only if it is.
+                sql = "WITH nth AS MATERIALIZED (SELECT s.sid AS sid, (SELECT start_date FROM fundamentals f " \
+                      "WHERE f.%s AND f.sid = s.sid AND f.start_date <= :as_of " \
+                      "ORDER BY f.start_date DESC LIMIT 1 OFFSET :n - 1) AS start_date FROM %s s) " \
+                      "SELECT nth.sid AS sid, f.value AS value FROM nth CROSS JOIN fundamentals f " \
+                      "ON f.%s AND f.sid = nth.sid AND f.start_date = nth.start_date " \
+                      "WHERE (:date_check - nth.start_date) <= :max_age;"
+                cmd = sql % (condition, sid_set, condition)
+            else:
+                sql = "SELECT sid, value FROM (" + self._get_inner_select(table) + ") t WHERE rown = :n;"
+                cmd = sql % ('SELECT sid FROM ' + sid_set, condition)
+            return conn.execute(text(cmd), params).fetchall()
+
+    def _has_ttm(self):
+        """True if the TTM sums have been materialized, see write_fundamentals_ttm."""
+        if not self._ttm_written:
+            try:
+                with self.engine.connect() as conn:
+                    self._ttm_written = len(conn.execute(text("SELECT 1 FROM fundamentals_ttm LIMIT 1")).fetchall()) > 0
+            except OperationalError:
+                self._ttm_written = False
+        return self._ttm_written
 
     def _get_result_ttm(self, sids, field_name, as_of_date, k):
         """
-        'enforce_date' is relevant for fundamentals to avoid delinquent SEC files.
+        The k-th TTM sum of each sid as (sid, value) tuples. The sums materialized at ingest are
+        looked up as of the date, unless one of the summed records is older than the max delay.
         """
-        MAX_DELAY = 1.296e+16  # 5 months
-        sql = "SELECT sid, SUM(value) FROM (" + self._get_inner_select() + ") t WHERE rown >= %d and rown <= %d GROUP BY sid;"
-
         m = k * 4
         n = m - 3
-        cmd = sql % (', '.join(map(str, sids)), field_name, as_of_date.value, as_of_date.value, m * MAX_DELAY * 4, n, m)
+        max_age = m * MAX_DELAY * 4
+        field_id = self._field_id(field_name)
+        table, condition, params = self._field_source(field_name)
+        params.update(as_of=as_of_date.value, date_check=as_of_date.value, max_age=int(max_age), n=n, m=m)
+        materialized = field_id is not None and k <= TTM_YEARS and self._has_ttm()
         with self.engine.connect() as conn:
-            return conn.execute(text(cmd)).fetchall()
+            sid_filter = 'SELECT sid FROM ' + self._sid_set(conn, sids)
+            result = []
+            if materialized:
+                sql = "SELECT sid, value, first_date, MAX(start_date) FROM fundamentals_ttm " \
+                      "WHERE field_id = :field_id AND k = :k AND sid IN (%s) AND start_date <= :as_of GROUP BY sid;"
+                rows = conn.execute(text(sql % sid_filter), dict(params, k=k)).fetchall()
+                result = [(sid, value) for sid, value, first_date, _ in rows
+                          if value is not None and as_of_date.value - first_date <= max_age]
+                stale = [sid for sid, _, first_date, _ in rows if as_of_date.value - first_date > max_age]
+                if len(stale) == 0:
+                    return result
+                # a few sids, bound as a JSON array rather than registered as a sid set
+                sid_filter = 'SELECT value FROM json_each(:stale)'
+                params['stale'] = json.dumps(stale)
+
+            sql = "SELECT sid, SUM(value) FROM (" + self._get_inner_select(table) + \
+                  ") t WHERE rown >= :n and rown <= :m GROUP BY sid;"
+            return result + [tuple(row) for row in conn.execute(text(sql % (sid_filter, condition)), params)]
 
     def get_datekey(self, sids, as_of_date, n):
         """
         Get the last SEC filing date.
         """
+        if self._use_point_in_time_cache():
+            pit = self._point_in_time(sids, 'revenue_arq')
+            return pit.latest_dates(as_of_date, n).reshape(1, -1)
+
+        table, condition, params = self._field_source('revenue_arq')
         sql = ("SELECT sid, start_date FROM ("
                "SELECT sid, start_date, "
                "ROW_NUMBER() OVER (PARTITION BY sid "
                "ORDER BY start_date DESC) AS rown "
-               "FROM equity_supplementary_mappings "
-               "WHERE sid IN (%s) "
-               "AND field = 'revenue_arq' "
-               "AND start_date <= %d "
-               ") t WHERE rown = %d;"
+               "FROM %s "
+               "WHERE sid IN (SELECT sid FROM %s) "
+               "AND %s "
+               "AND start_date <= :as_of "
+               ") t WHERE rown = :n;"
                )
 
-        cmd = sql % (', '.join(map(str, sids)), as_of_date.value, n)
+        params.update(as_of=as_of_date.value, n=n)
         with self.engine.connect() as conn:
-            result = conn.execute(text(cmd)).fetchall()
+            cmd = sql % (table, self._sid_set(conn, sids), condition)
+            result = conn.execute(text(cmd), params).fetchall()
         return pd.DataFrame(result).set_index('sid').reindex(sids).T.values.astype('float64')
 
     # @cached
@@ -152,6 +359,17 @@ class SQLiteAssetFinder(AssetFinder):
         n=1 is the most recent quarter or last ttm, n=2 indicate the previous quarter or ttm and so on...
         It's different from the original zipline window_length
         """
+        if self._use_point_in_time_cache():
+            if as_of_date is None:
+                as_of_date = pd.Timestamp.today()
+            values = self._point_in_time(sids, field_name).latest_values(as_of_date, n, n * MAX_DELAY)
+            if np.isnan(values).all():
+                log.warn("No result: asset_finder().get_fundamentals(%s, %s, %s, n=%s)" %
+                         (sids, field_name, as_of_date, n)
+                         )
+                return []
+            return values.reshape(1, -1)
+
         result = self._get_result(sids, field_name, as_of_date, n, enforce_date=True)
         if len(result) == 0:
             log.warn("No result: asset_finder().get_fundamentals(%s, %s, %s, n=%s)" %
@@ -160,7 +378,10 @@ class SQLiteAssetFinder(AssetFinder):
             return []
         # shape: (windows lenghts=1, num of assets)
         df = pd.DataFrame(result).set_index('sid').reindex(sids).T
-        values = df.replace('None', np.nan).values
+        values = df.values
+        if values.dtype == object:
+            # text values of equity_supplementary_mappings
+            values = df.replace('None', np.nan).values
         # shape: (num of assets, windows lenghts=1)
         return values.astype('float64')
 
@@ -177,20 +398,28 @@ class SQLiteAssetFinder(AssetFinder):
             value_(t-n, sid 1)	value_(t-n, sid 2)	...	value_(t-n, sid m)
 
         where n is the window_length (for example n=4 for the last four quarters)
+        and the values of the missing quarters are NaN.
 
         """
         if as_of_date is None:
             as_of_date = pd.Timestamp.today()
         start_date = as_of_date - DateOffset(months=(window_length + 1) * 3)
 
+        if self._use_point_in_time_cache():
+            return self._point_in_time(sids, field_name).window_values(as_of_date, window_length, start_date)
+
+        table, condition, params = self._field_source(field_name)
         sql = "SELECT * FROM (SELECT ROW_NUMBER() OVER (PARTITION BY sid ORDER BY start_date DESC) row_num," \
-              "sid, start_date, value FROM equity_supplementary_mappings WHERE sid IN (%s) AND field = '%s' " \
-              "AND start_date >= %d AND start_date <= %d) t WHERE row_num <= %d"
-        cmd = sql % (', '.join(map(str, sids)), field_name, start_date.value, as_of_date.value, window_length)
+              "sid, start_date, value FROM %s WHERE sid IN (SELECT sid FROM %s) AND %s " \
+              "AND start_date >= :start AND start_date <= :as_of) t WHERE row_num <= :window_length"
+        params.update(start=start_date.value, as_of=as_of_date.value, window_length=window_length)
 
-        df = pd.read_sql_query(cmd, self.engine)
+        with self.engine.connect() as conn:
+            cmd = sql % (table, self._sid_set(conn, sids), condition)
+            df = pd.read_sql_query(text(cmd), conn, params=params)
         df = df.pivot(index='row_num', columns='sid', values='value')
-        df = df.reindex(columns=sids)
+        # window_length rows as with the point in time cache, NaN where a sid has fewer quarters
+        df = df.reindex(index=range(1, window_length + 1), columns=sids)
         return df.values.astype('float64')
 
     # @cached
@@ -199,10 +428,18 @@ class SQLiteAssetFinder(AssetFinder):
         k=1 is the sum of the last twelve months, k=2 is the sum of the previous twelve months and so on...
         It's different from windows_length
         """
+        if self._use_point_in_time_cache():
+            m = k * 4
+            pit = self._point_in_time(sids, field_name + '_arq')
+            values = pit.sum_latest_values(as_of_date, m - 3, m, m * MAX_DELAY * 4)
+            if np.isnan(values).all():
+                return []
+            return values.reshape(1, -1)
+
         result = self._get_result_ttm(sids, field_name + '_arq', as_of_date, k)
         if len(result) == 0:
             return []
-        return pd.DataFrame(result).set_index('sid').reindex(sids).T.values.astype('float64')
+        return pd.DataFrame(result, columns=['sid', 'value']).set_index('sid').reindex(sids).T.values.astype('float64')
 
     # @cached
     def get_info(self, sids, field_name, as_of_date=None):
@@ -210,11 +447,31 @@ class SQLiteAssetFinder(AssetFinder):
         Unlike get_fundamentals(.), it use the string 'NA' for unknown values, 
         because np nan isn't supported in LabelArray
         """
-        result = self._get_result(sids, field_name, as_of_date, n=1, enforce_date=False)
+        result = self._get_result(sids, field_name, as_of_date, n=1, enforce_date=False, numeric=False)
         if len(result) == 0:
             return []
         return pd.DataFrame(result).set_index('sid').reindex(sids, fill_value='NA').T.values
 
+    def get_info_intervals(self, sids, field_name, categories=None, missing_value='NA'):
+        """The whole history of a text field as intervals, see get_info for a single date.
+
+        Args:
+            sids: Security identifiers.
+            field_name: The supplementary mapping field name (e.g., 'sector').
+            categories: Known labels, the other values are missing. Default: all the values.
+            missing_value: Label of the dates without a value.
+
+        Returns:
+            CategoricalIntervals: The intervals of the values, columns ordered as sids.
+        """
+        sql = "SELECT sid, start_date, value FROM equity_supplementary_mappings " \
+              "WHERE field = :field AND sid IN (SELECT sid FROM %s)"
+        with self.engine.connect() as conn:
+            df = pd.read_sql_query(text(sql % self._sid_set(conn, sids)), conn, params={'field': field_name})
+        intervals = CategoricalIntervals.from_frame(sids, df, categories, missing_value)
+        log.debug("Loaded %d intervals of '%s' for %d assets." % (len(intervals), field_name, len(sids)))
+        return intervals
+
     # @cached
     def get_daily_metrics(self, sids, field_name, as_of_date=pd.Timestamp.today(), n=1, calendar=get_calendar('XNYS', start=pd.Timestamp('2000-01-01 00:00:00'))):
         """Retrieve daily metric values over a trading window.
@@ -236,14 +493,54 @@ class SQLiteAssetFinder(AssetFinder):
         else:
             sessions = calendar.sessions_window(as_of_date, count)
 
-        query = "SELECT start_date, sid, value FROM equity_supplementary_mappings " \
-                "WHERE field ='%s' AND sid in (%s) AND start_date >= %s AND start_date <= %s" \
-                % (field_name, ",".join(map(str, sids)), sessions[0].value, sessions[-1].value)
+        return self.get_daily_metrics_window(sids, [field_name], sessions)[field_name]
 
-        df = pd.read_sql_query(query, self.engine)
-        df = df.pivot(index='start_date', columns='sid', values='value')
-        df = df.reindex(index=list(map(self._fmt_date, sessions)), columns=sids)
-        return df.values.astype('float64')
+    def get_daily_metrics_window(self, sids, field_names, sessions):
+        """Retrieve several daily metrics over a range of sessions in one query.
+
+        Args:
+            sids: List of security identifiers.
+            field_names: Daily metric field names (e.g., ['marketcap', 'pe']).
+            sessions: DatetimeIndex of the sessions to retrieve.
+
+        Returns:
+            dict: Map from field name to a float64 array of shape
+            (num_sessions, num_assets), NaN where there is no value.
+        """
+        sessions = pd.DatetimeIndex(sessions)
+        sids = np.asarray(sids, dtype=np.int64)
+        out = {field: np.full((len(sessions), len(sids)), np.nan) for field in field_names}
+        if len(sessions) == 0 or len(sids) == 0:
+            return out
+
+        # the 'field' column of the rows of a field: its id in fundamentals, its name in equity_supplementary_mappings
+        keys = {field: self._field_id(field) for field in field_names}
+        typed = [keys[f] for f in field_names if keys[f] is not None]
+        untyped = [f for f in field_names if keys[f] is None]
+        keys.update({f: f for f in untyped})
+        queries = []
+        if len(typed) > 0:
+            queries.append("SELECT start_date, sid, field_id AS field, value FROM fundamentals "
+                           "WHERE field_id IN (%s)" % ",".join(map(str, typed)))
+        if len(untyped) > 0:
+            queries.append("SELECT start_date, sid, field, value FROM equity_supplementary_mappings "
+                           "WHERE field IN (%s)" % ",".join("'%s'" % f for f in untyped))
+
+        params = {'start': sessions[0].value, 'end': sessions[-1].value}
+        for query in queries:
+            with self.engine.connect() as conn:
+                query += " AND sid IN (SELECT sid FROM %s) AND start_date >= :start AND start_date <= :end" \
+                         % self._sid_set(conn, sids)
+                df = pd.read_sql_query(text(query), conn, params=params)
+
+            rows = pd.Index(sessions.asi8).get_indexer(df['start_date'].values)
+            cols = pd.Index(sids).get_indexer(df['sid'].values)
+            values = pd.to_numeric(df['value'], errors='coerce').values
+            fields = df['field'].values
+            for field in field_names:
+                found = (fields == keys[field]) & (rows >= 0) & (cols >= 0)
+                out[field][rows[found], cols[found]] = values[found]
+        return out
 
     def _fmt_date(self, dt):
         return dt.value
@@ -265,9 +562,10 @@ class SQLiteAssetFinder(AssetFinder):
         Returns:
             pd.Timestamp: The latest date, or pd.NaT if no data exists.
         """
-        sql = "SELECT MAX(start_date) FROM equity_supplementary_mappings WHERE field = '%s';" % field
+        table, condition, params = self._field_source(field)
+        sql = "SELECT MAX(start_date) FROM %s WHERE %s;" % (table, condition)
         with self.engine.connect() as conn:
-            res = conn.execute(text(sql)).fetchall()
+            res = conn.execute(text(sql), params).fetchall()
         if len(res) == 0:
             return pd.NaT
         return pd.Timestamp(res[0][0])
@@ -347,6 +645,8 @@ class SQLiteAssetDBWriter(AssetDBWriter):
                     conn.execute(text(
                         "CREATE INDEX IF NOT EXISTS idx_start_date_field  ON equity_supplementary_mappings (start_date, field);"
                     ))
+                    for statement in FUNDAMENTALS_SCHEMA:
+                        conn.execute(text(statement))
                 return
 
             self._configure_sqlite_connection(txn)
@@ -354,6 +654,8 @@ class SQLiteAssetDBWriter(AssetDBWriter):
             txn.execute(text(
                 "CREATE INDEX IF NOT EXISTS idx_start_date_field  ON equity_supplementary_mappings (start_date, field);"
             ))
+            for statement in FUNDAMENTALS_SCHEMA:
+                txn.execute(text(statement))
 
         self._execute_with_retry(run, "initializing the asset database")
 
@@ -521,13 +823,17 @@ class SQLiteAssetDBWriter(AssetDBWriter):
         return insert_statement
 
     def _write_df_to_table(self, tbl, df, txn, chunk_size=None, idx=True, idx_label=None):
-        """Write a DataFrame to a SQLite table row by row.
+        """Write a DataFrame to a SQLite table with INSERT OR REPLACE.
+
+        The rows are written in the caller's transaction, chunk_size rows per
+        executemany. A separate connection would wait for the lock held by the
+        transaction, e.g. on the tables just created in a new database.
 
         Args:
             tbl: SQLAlchemy Table object.
             df: DataFrame to write.
-            txn: SQLAlchemy transaction.
-            chunk_size: Unused, kept for API compatibility.
+            txn: SQLAlchemy connection of the transaction.
+            chunk_size: Number of rows per executemany, all the rows if None.
             idx: Whether to include the index in the insert.
             idx_label: Label for the index column.
         """
@@ -536,17 +842,19 @@ class SQLiteAssetDBWriter(AssetDBWriter):
             if idx_label is not None else
             first(tbl.primary_key.columns).name
         )
-        cmd = self.insert_statement(df, tbl.name, idx, index_label)
-
-        for index, row in df.iterrows():
-            values = row.values
-            if idx:
-                values = np.insert(values, 0, str(index), axis=0)
-
-            params = dict(zip([str(x) for x in range(0, len(values))], values.flatten()))
-            with self.engine.connect() as conn:
-                conn.execute(text(cmd), params)
-                conn.commit()
+        cmd = text(self.insert_statement(df, tbl.name, idx, index_label))
+
+        # the index is written as text, like the values of the rows of object dtype
+        columns = [df[c].tolist() for c in df.columns]
+        if idx:
+            columns.insert(0, [str(index) for index in df.index])
+        keys = [str(x) for x in range(len(columns))]
+        rows = [dict(zip(keys, values)) for values in zip(*columns)]
+
+        chunk_size = chunk_size or len(rows)
+        for start in range(0, len(rows), chunk_size):
+            txn.execute(cmd, rows[start:start + chunk_size])
+        log.debug("Wrote %d rows to %s." % (len(rows), tbl.name))
 
     def check_sanity(self):
         """
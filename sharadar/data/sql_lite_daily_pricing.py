@@ -5,6 +5,9 @@ data (splits, dividends, mergers) stored in SQLite databases.
 """
 import os
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from contextlib import closing
 
 import click
@@ -12,16 +15,18 @@ import numpy as np
 import pandas as pd
 from exchange_calendars import get_calendar
 
+from sharadar.data.adjustment_factors import write_adjustment_factors
+from sharadar.data.connection_pool import SQLiteConnectionPool
+from sharadar.data.prices_manifest import PricesManifest, change_counter
 from sharadar.util.logger import log
 from sharadar.util.output_dir import get_data_dir
 from six import (
     iteritems,
 )
-from zipline.data.adjustments import SQLiteAdjustmentWriter, SQLiteAdjustmentReader
+from zipline.data.adjustments import SQLiteAdjustmentWriter
 from zipline.data.bar_reader import (
     NoDataBeforeDate,
 )
-from zipline.data.data_portal import DataPortal
 from zipline.data.session_bars import SessionBarReader
 from zipline.utils.numpy_utils import (
     float64_dtype,
@@ -50,6 +55,32 @@ CREATE INDEX  "ix_prices_date" ON "prices" ("date");
 CREATE INDEX "ix_prices_sid" ON "prices" ("sid");
 """
 
+# The dates are int64 nanoseconds since the epoch and the rows are clustered by (sid, date)
+SCHEMA_V2 = """
+CREATE TABLE IF NOT EXISTS "properties" (
+"key" TEXT,
+  "0" TEXT
+);
+CREATE INDEX "ix_properties_key" ON "properties" ("key");
+
+CREATE TABLE IF NOT EXISTS "prices" (
+  "date" INTEGER NOT NULL,
+  "sid" INTEGER NOT NULL,
+  "open" REAL NOT NULL,
+  "high" REAL NOT NULL,
+  "low" REAL NOT NULL,
+  "close" REAL NOT NULL,
+  "volume" REAL NOT NULL,
+  PRIMARY KEY (sid, date)
+) WITHOUT ROWID;
+CREATE INDEX "ix_prices_date" ON "prices" ("date");
+"""
+
+# Schema version of the new prices databases
+PRICES_SCHEMA_VERSION = 2
+
+PRICES_SCHEMAS = {1: SCHEMA, 2: SCHEMA_V2}
+
 SCHEMA_ADJUST = """
 CREATE TABLE IF NOT EXISTS "splits" (
 "index" INTEGER,
@@ -114,9 +145,75 @@ CREATE INDEX IF NOT EXISTS dividends_payouts_ex_date ON dividend_payouts(ex_date
 CREATE INDEX IF NOT EXISTS stock_dividend_payouts_sid ON stock_dividend_payouts(sid);
 CREATE INDEX IF NOT EXISTS stock_dividends_payouts_ex_date ON stock_dividend_payouts(ex_date);
 """
+# Columns of the prices table that can be queried by field name
+PRICE_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+# Number of rows fetched at a time by SQLiteDailyBarReader.load_raw_arrays
+LOAD_BATCH_SIZE = 100000
+
+# Number of (sid, date) pairs per query of SQLiteDailyBarReader.get_session_values
+PREVIOUS_VALUES_BATCH_SIZE = 5000
+
+# Number of rows per executemany call of SQLiteDailyAdjustmentWriter
+ADJUSTMENT_BATCH_SIZE = 100000
+
+# Number of sessions kept in memory by SQLiteDailyBarReader
+DEFAULT_SESSION_CACHE_SIZE = 32
+
 # Sqlite Maximum Number Of Columns in a table or query
 SQLITE_MAX_COLUMN = 2000
 
+# Secondary indexes of the prices table by schema version, rebuilt after a bulk load
+PRICES_INDEXES = {
+    1: (('ix_prices_date', 'date'), ('ix_prices_sid', 'sid')),
+    2: (('ix_prices_date', 'date'),),
+}
+
+# Minimum number of rows of a write loaded as a bulk load into a non empty prices table, see SQLiteDailyBarWriter.write
+BULK_LOAD_MIN_ROWS = 1000000
+
+# Connection settings for bulk loads: the database can be rebuilt from the source if the load is interrupted
+BULK_LOAD_PRAGMAS = (
+    "PRAGMA synchronous = OFF",
+    "PRAGMA journal_mode = MEMORY",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",
+)
+
+
+def prices_schema_version(con):
+    """Version of the schema of the prices table.
+
+    Args:
+        con: sqlite3 connection to the prices database.
+
+    Returns:
+        int: 1 for the dates stored as text, 2 for the dates stored as int64 nanoseconds,
+            None if there is no prices table.
+    """
+    columns = {row[1]: row[2] for row in con.execute('PRAGMA table_info("prices")').fetchall()}
+    if len(columns) == 0:
+        return None
+    return 2 if columns['date'].upper() == 'INTEGER' else 1
+
+
+def date_keys(dates, schema_version):
+    """The values of the date column of the prices table for the dates.
+
+    Args:
+        dates: Datetime-like values.
+        schema_version: Schema version of the prices table.
+
+    Returns:
+        np.ndarray of int64 nanoseconds (version 2) or of 'YYYY-MM-DD HH:MM:SS' strings (version 1).
+    """
+    dates = pd.DatetimeIndex(dates)
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    if schema_version == 2:
+        return dates.asi8
+    return np.asarray(dates.strftime('%Y-%m-%d %H:%M:%S'))
+
 
 class SQLiteDailyBarWriter(object):
     """Writes daily OHLCV bar data to a SQLite database.
@@ -127,16 +224,33 @@ class SQLiteDailyBarWriter(object):
     Attributes:
         _filename: Path to the SQLite database file.
         _calendar: Trading calendar used for session alignment.
+        _schema_version: Schema version of the prices table.
     """
-    def __init__(self, filename, calendar):
+    def __init__(self, filename, calendar, schema_version=None):
+        """Initialize the writer.
+
+        Args:
+            filename: Path to the SQLite database file.
+            calendar: Trading calendar used for session alignment.
+            schema_version: Schema version of a new database, defaults to PRICES_SCHEMA_VERSION.
+                An existing database keeps its schema.
+
+        Raises:
+            ValueError: If the existing database has a different schema version.
+        """
         self._filename = filename
         self._calendar = calendar
 
         # Create schema, if not exists
         with closing(sqlite3.connect(self._filename)) as con, con, closing(con.cursor()) as c:
-            c.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='prices'")
-            if c.fetchone()[0] == 0:
-                c.executescript(SCHEMA)
+            existing_version = prices_schema_version(con)
+            if existing_version is None:
+                existing_version = schema_version if schema_version is not None else PRICES_SCHEMA_VERSION
+                c.executescript(PRICES_SCHEMAS[existing_version])
+            elif schema_version is not None and schema_version != existing_version:
+                raise ValueError("The prices schema of %s is version %d, run 'sharadar-zipline migrate-prices'." %
+                                 (self._filename, existing_version))
+        self._schema_version = existing_version
 
     def _validate(self, data):
         """Validate that input data has the expected format.
@@ -152,33 +266,183 @@ class SQLiteDailyBarWriter(object):
         if data.index.names != ['date', 'sid']:
             raise ValueError("data indexes must be ['date', 'sid'].")
 
-    def write(self, data):
-        """Write splits, mergers, and dividend data to the database.
+    def write(self, data, batch_size=100000, bulk=None):
+        """Write OHLCV price data to the database.
+
+        Rows are inserted with executemany in a single transaction, with
+        INSERT OR REPLACE semantics on (date, sid). For a bulk load the
+        secondary indexes are dropped during the load and rebuilt afterward,
+        with the BULK_LOAD_PRAGMAS; an incremental write keeps the indexes,
+        whose rebuild would cost a scan of the whole table. The manifest of
+        the database is updated with the written rows.
 
         Args:
-            splits: DataFrame of split records.
-            mergers: DataFrame of merger records.
-            dividends: DataFrame of dividend payout records.
-            stock_dividends: DataFrame of stock dividend records.
+            data: DataFrame indexed by ['date', 'sid'] with the columns
+                open, high, low, close and volume.
+            batch_size: Number of rows per executemany call.
+            bulk: True for a bulk load, False for an incremental write. If None,
+                the write is a bulk load if the prices table is empty or the data
+                has at least BULK_LOAD_MIN_ROWS rows.
         """
         self._validate(data)
 
         df = data[['open', 'high', 'low', 'close', 'volume']]
-        with closing(sqlite3.connect(self._filename)) as con, con, closing(con.cursor()) as c:
+        invalid = df.isnull().any(axis=1).values
+        if invalid.any():
+            log.error("Skipping %d price rows with NaN values." % invalid.sum())
+            df = df[~invalid]
+
+        dates = date_keys(df.index.get_level_values('date'), self._schema_version).tolist()
+        sids = df.index.get_level_values('sid').values.astype(np.int64)
+        values = df.values.astype(np.float64)
+
+        # the manifest is updated incrementally only if it matches the database before the write
+        manifest = PricesManifest.load(self._filename)
+
+        sql = "INSERT OR REPLACE INTO prices (date, sid, open, high, low, close, volume) VALUES (?, ?, ?, ?, ?, ?, ?)"
+        start_time = time.time()
+        with closing(sqlite3.connect(self._filename)) as con, closing(con.cursor()) as c:
             properties = pd.Series({'calendar_name': self._calendar.name})
             properties.to_sql('properties', con, index_label='key', if_exists="replace")
 
-            with click.progressbar(length=len(df), label="Inserting price data...") as pbar:
-                count = 0
-                for index, row in df.iterrows():
-                    sql = "INSERT OR REPLACE INTO prices (date, sid, open, high, low, close, volume) VALUES ('%s',%f,%f,%f,%f,%f,%f)"
-                    values = index + tuple(row.values)
-                    try:
-                        c.execute(sql % values)
-                    except sqlite3.OperationalError as e:
-                        log.error("SqlError %s: %s" % (e, (sql % values)))
-                    count += 1
-                    pbar.update(count)
+            if bulk is None:
+                bulk = len(df) >= BULK_LOAD_MIN_ROWS or c.execute("SELECT 1 FROM prices LIMIT 1").fetchone() is None
+            if bulk:
+                for pragma in BULK_LOAD_PRAGMAS:
+                    c.execute(pragma)
+
+            with con:
+                c.execute("BEGIN")
+                if bulk:
+                    for index_name, _ in PRICES_INDEXES[self._schema_version]:
+                        c.execute('DROP INDEX IF EXISTS "%s"' % index_name)
+
+                with click.progressbar(length=len(df), label="Inserting price data...") as pbar:
+                    for i in range(0, len(df), batch_size):
+                        j = min(i + batch_size, len(df))
+                        batch = zip(dates[i:j], sids[i:j].tolist(), *values[i:j].T.tolist())
+                        c.executemany(sql, batch)
+                        pbar.update(j - i)
+
+                if bulk:
+                    log.info("Rebuilding prices indexes...")
+                    for index_name, column in PRICES_INDEXES[self._schema_version]:
+                        c.execute('CREATE INDEX IF NOT EXISTS "%s" ON "prices" ("%s")' % (index_name, column))
+
+        if manifest is not None:
+            manifest = manifest.update(sids, df.index.get_level_values('date'))
+            manifest.calendar_name = self._calendar.name
+        else:
+            manifest = PricesManifest.from_database(self._filename)
+        manifest.save(self._filename)
+
+        elapsed = time.time() - start_time
+        log.info("Inserted %d price rows in %.1f seconds (%.0f rows/second)." %
+                 (len(df), elapsed, len(df) / elapsed if elapsed > 0 else float('inf')))
+
+
+def migrate_prices(filename, output=None):
+    """Convert a prices database to the schema version 2.
+
+    The dates are converted to int64 nanoseconds and the rows are clustered
+    by (sid, date). The conversion runs in SQLite, from a copy of the
+    database attached to the new one.
+
+    Args:
+        filename: Path of the prices database.
+        output: Path of the converted database. If None, the database is
+            converted in place.
+
+    Raises:
+        ValueError: If there is no prices table or the output file already exists.
+    """
+    with closing(sqlite3.connect(filename)) as con:
+        version = prices_schema_version(con)
+    if version is None:
+        raise ValueError("No prices table in %s." % filename)
+    if version == PRICES_SCHEMA_VERSION:
+        log.info("The prices schema of %s is already version %d." % (filename, version))
+        return
+    if output is not None and os.path.exists(output):
+        raise ValueError("The output file %s already exists." % output)
+
+    target = output if output is not None else filename + '.migrating'
+    if os.path.exists(target):
+        # left by an interrupted migration
+        os.remove(target)
+
+    start_time = time.time()
+    with closing(sqlite3.connect(target)) as con, closing(con.cursor()) as c:
+        c.executescript(SCHEMA_V2)
+        for pragma in BULK_LOAD_PRAGMAS:
+            c.execute(pragma)
+        c.execute("ATTACH DATABASE ? AS source", (filename,))
+        with con:
+            c.execute("BEGIN")
+            for index_name, _ in PRICES_INDEXES[2]:
+                c.execute('DROP INDEX IF EXISTS "%s"' % index_name)
+            log.info("Converting the prices of %s..." % filename)
+            c.execute('INSERT INTO prices (date, sid, open, high, low, close, volume) '
+                      "SELECT CAST(strftime('%s', date) AS INTEGER) * 1000000000, sid, open, high, low, close, volume "
+                      "FROM source.prices ORDER BY sid, date")
+            rows = c.rowcount
+            c.execute('INSERT INTO properties ("key", "0") SELECT "key", "0" FROM source.properties')
+            log.info("Rebuilding prices indexes...")
+            for index_name, column in PRICES_INDEXES[2]:
+                c.execute('CREATE INDEX IF NOT EXISTS "%s" ON "prices" ("%s")' % (index_name, column))
+        c.execute("DETACH DATABASE source")
+
+    if output is None:
+        os.replace(target, filename)
+    PricesManifest.from_database(output or filename).save(output or filename)
+    log.info("Migrated %d price rows of %s to the schema version %d in %.1f seconds (%s)." %
+             (rows, filename, PRICES_SCHEMA_VERSION, time.time() - start_time, target if output else "in place"))
+
+
+def previous_session_values(reader, sids, dts, field):
+    """The values of the (sid, date) pairs on the session before each date, see get_previous_values.
+
+    Args:
+        reader: Reader with the sessions property and the get_session_values method.
+        sids: Security identifiers.
+        dts: Dates, one per sid.
+        field: Column name (e.g., 'close', 'volume').
+
+    Returns:
+        np.ndarray: The value of each pair, NaN without a previous session.
+    """
+    sids = np.asarray([int(x) for x in sids], dtype=np.int64)
+    dts = pd.DatetimeIndex(dts).tz_localize(None)
+    if len(sids) != len(dts):
+        raise ValueError("Expected as many dates as sids, got %d and %d." % (len(dts), len(sids)))
+    values = np.full(len(sids), np.nan)
+    if len(sids) == 0:
+        return values
+    sessions = reader.sessions
+    date_ix = sessions.searchsorted(dts)
+    pairs = np.flatnonzero(date_ix > 0)
+    values[pairs] = reader.get_session_values(sids[pairs], sessions[date_ix[pairs] - 1], field)
+    return values
+
+
+class SessionSnapshot(object):
+    """OHLCV of all the sids on a session.
+
+    Attributes:
+        sids: pd.Index of the sids with prices on the session, maps a sid to its row.
+        values: Array of shape (len(sids), len(PRICE_FIELDS)).
+    """
+    def __init__(self, sids, values):
+        self.sids = pd.Index(sids)
+        self.values = values
+
+    def get_values(self, sids, field):
+        """Values of a field, NaN for the sids without prices."""
+        positions = self.sids.get_indexer(sids)
+        found = positions >= 0
+        result = np.full(len(positions), np.nan)
+        result[found] = self.values[positions[found], PRICE_FIELDS.index(field)]
+        return result
 
 
 class SQLiteDailyBarReader(SessionBarReader):
@@ -190,45 +454,160 @@ class SQLiteDailyBarReader(SessionBarReader):
     --------
     zipline.data.us_equity_pricing.BcolzDailyBarReader
     """
-    def __init__(self, filename=os.path.join(get_data_dir(), "prices.sqlite")):
-        self._filename = filename
+    def __init__(self, filename=os.path.join(get_data_dir(), "prices.sqlite"), immutable=False,
+                 session_cache_size=DEFAULT_SESSION_CACHE_SIZE, manifest=None):
+        """Initialize the reader.
 
-    def _query(self, sql):
-        """Execute a SQL query and return all results.
+        Args:
+            filename: Path of the prices database.
+            immutable: If True, the database is opened as immutable (no file locks),
+                only if it is not written while the reader is in use.
+            session_cache_size: Number of sessions whose prices are kept in memory.
+            manifest: PricesManifest of a database that is not written while the
+                reader is in use (e.g. an in-memory copy), used instead of the
+                manifest file.
+        """
+        self._filename = filename
+        self._pool = SQLiteConnectionPool(filename, immutable=immutable)
+        self._fixed_manifest = manifest
+        self._schema_version = None
+        # the state read from the database as of its last change counter, see _refresh
+        self._manifest_lock = threading.Lock()
+        self._counter = None
+        self._counter_checked = False
+        self._manifest_loaded = False
+        self._manifest_cache = None
+        self._calendar_name = None
+        self._calendars = {}
+        self._session_cache_size = session_cache_size
+        self._sessions_lock = threading.Lock()
+        self._session_snapshots = OrderedDict()
+
+    def _query(self, sql, parameters=()):
+        """Execute a SQL query on a pooled read-only connection and return all results.
 
         Args:
-            sql: SQL query string.
+            sql: SQL query string, with ? placeholders.
+            parameters: Values bound to the placeholders.
 
         Returns:
             List of result tuples.
         """
-        with closing(sqlite3.connect(self._filename)) as con, con, closing(con.cursor()) as c:
-            c.execute(sql)
-            return c.fetchall()
+        return self._pool.execute(sql, parameters)
 
-    def _exist_sid(self, sid):
-        """Check if a security ID exists in the prices table.
+    @staticmethod
+    def _check_field(field):
+        if field not in PRICE_FIELDS:
+            raise ValueError("Unknown price field: %s" % field)
+        return field
+
+    def close(self):
+        """Close the pooled connections."""
+        self._pool.close()
+
+    @property
+    def schema_version(self):
+        """Schema version of the prices table, see prices_schema_version."""
+        if self._schema_version is None:
+            with self._pool.connection() as con:
+                self._schema_version = prices_schema_version(con)
+        return self._schema_version
+
+    def _refresh(self):
+        """Drop the state read from the database if it changed since the last check.
+
+        The file change counter of the database is read once per lookup
+        (get_value, get_values, get_last_traded_dt, last_available_dt,
+        manifest): the session snapshots, the manifest and the calendar
+        name are kept until it changes, the other methods and properties
+        answer from them without reading the file.
+        """
+        if self._fixed_manifest is not None:
+            return
+        counter = change_counter(self._filename)
+        with self._manifest_lock:
+            if self._counter_checked and counter == self._counter:
+                return
+            self._counter = counter
+            self._counter_checked = True
+            self._manifest_loaded = False
+            self._manifest_cache = None
+            self._calendar_name = None
+        with self._sessions_lock:
+            self._session_snapshots.clear()
+
+    def _manifest(self):
+        """The PricesManifest as of the last _refresh, loaded once, None if it is missing or out of date."""
+        if self._fixed_manifest is not None:
+            return self._fixed_manifest
+        with self._manifest_lock:
+            if not self._manifest_loaded:
+                self._manifest_cache = PricesManifest.load(self._filename)
+                self._manifest_loaded = True
+            return self._manifest_cache
+
+    @property
+    def manifest(self):
+        """The PricesManifest of the database, None if it is missing or out of date.
+
+        The manifest is reloaded only when the database changes.
+        """
+        self._refresh()
+        return self._manifest()
+
+    def _date_key(self, dt):
+        """The value of the date column of the prices table for the session of dt."""
+        return date_keys([pd.Timestamp(dt).normalize()], self.schema_version).tolist()[0]
+
+    @staticmethod
+    def _to_timestamp(value):
+        """The Timestamp of a value of the date column, NaT for NULL."""
+        return pd.Timestamp(value).tz_localize(None)
+
+    def _session_snapshot(self, day):
+        """The prices of all the sids on a day, from the LRU of the recent sessions.
+
+        The LRU is cleared by _refresh when the database changes, the
+        callers refresh before the lookup.
 
         Args:
-            sid: Security identifier.
+            day: Date key returned by _date_key.
 
         Returns:
-            bool: True if the sid has price data.
+            SessionSnapshot
         """
-        sql = "SELECT COUNT(DISTINCT(sid)) FROM prices WHERE sid = %d" % sid
-        res = self._query(sql)
-        return res[0][0] == 1
+        with self._sessions_lock:
+            snapshot = self._session_snapshots.get(day)
+            if snapshot is not None:
+                self._session_snapshots.move_to_end(day)
+                return snapshot
+
+        sql = "SELECT sid, %s FROM prices WHERE date = ? ORDER BY sid" % ", ".join(PRICE_FIELDS)
+        rows = self._query(sql, (day,))
+        values = np.array([r[1:] for r in rows], dtype=float64_dtype).reshape(len(rows), len(PRICE_FIELDS))
+        snapshot = SessionSnapshot(np.array([r[0] for r in rows], dtype=np.int64), values)
+        if len(rows) > 0:
+            # a session not ingested yet is not cached
+            with self._sessions_lock:
+                self._session_snapshots[day] = snapshot
+                while len(self._session_snapshots) > self._session_cache_size:
+                    self._session_snapshots.popitem(last=False)
+        return snapshot
 
-    def _fmt_date(self, dt):
-        """Format a datetime to the string format used in the database.
+    def _exist_sid(self, sid):
+        """Check if a security ID exists in the prices table.
 
         Args:
-            dt: Datetime-like object.
+            sid: Security identifier.
 
         Returns:
-            str: Date formatted as 'YYYY-MM-DD 00:00:00'.
+            bool: True if the sid has price data.
         """
-        return pd.to_datetime(dt).strftime('%Y-%m-%d') + " 00:00:00"
+        manifest = self._manifest()
+        if manifest is not None:
+            return sid in manifest
+        sql = "SELECT 1 FROM prices WHERE sid = ? LIMIT 1"
+        return len(self._query(sql, (int(sid),))) == 1
 
     # @cached
     def get_value(self, sid, dt, field):
@@ -246,15 +625,85 @@ class SQLiteDailyBarReader(SessionBarReader):
             NoDataBeforeDate: If no data exists on or before the date.
             KeyError: If the sid does not exist.
         """
-        day = self._fmt_date(dt)
-        sql = "SELECT %s FROM prices WHERE sid = %d and date = '%s'" % (field, sid, day)
-        res = self._query(sql)
-        if len(res) == 0:
+        self._check_field(field)
+        self._refresh()
+        snapshot = self._session_snapshot(self._date_key(dt))
+        position = snapshot.sids.get_indexer([int(sid)])[0]
+        if position < 0:
             if self._exist_sid(sid):
                 raise NoDataBeforeDate("No data on or before day={0} for sid={1}".format(dt, sid))
             else:
                 raise KeyError(sid)
-        return res[0][0]
+        return snapshot.values[position, PRICE_FIELDS.index(field)]
+
+    def get_values(self, sids, dt, field):
+        """Get a field value for many sids on a specific date.
+
+        Args:
+            sids: Security identifiers.
+            dt: Date to query.
+            field: Column name (e.g., 'close', 'volume').
+
+        Returns:
+            np.ndarray: The values of the sids, NaN for the sids without data on the date.
+        """
+        self._check_field(field)
+        sids = np.asarray([int(x) for x in sids], dtype=np.int64)
+        self._refresh()
+        return self._session_snapshot(self._date_key(dt)).get_values(sids, field)
+
+    def get_session_values(self, sids, sessions, field):
+        """Get a field value for many (sid, session) pairs.
+
+        The pairs are looked up in batched queries on the (sid, date) index,
+        without loading the history of the sids.
+
+        Args:
+            sids: Security identifiers.
+            sessions: Sessions, one per sid.
+            field: Column name (e.g., 'close', 'volume').
+
+        Returns:
+            np.ndarray: The value of each pair, NaN if the sid has no data on the session.
+        """
+        self._check_field(field)
+        sids = np.asarray([int(x) for x in sids], dtype=np.int64)
+        sessions = pd.DatetimeIndex(sessions).tz_localize(None)
+        if len(sids) != len(sessions):
+            raise ValueError("Expected as many sessions as sids, got %d and %d." % (len(sessions), len(sids)))
+        values = np.full(len(sids), np.nan)
+        if len(sids) == 0:
+            return values
+
+        days = date_keys(sessions, self.schema_version).tolist()
+        pair_sids = sids.tolist()
+        with self._pool.connection() as conn:
+            for i in range(0, len(sids), PREVIOUS_VALUES_BATCH_SIZE):
+                j = min(i + PREVIOUS_VALUES_BATCH_SIZE, len(sids))
+                query = "WITH pairs(i, sid, date) AS (VALUES %s) " \
+                        "SELECT pairs.i, p.%s FROM pairs JOIN prices p ON p.sid = pairs.sid AND p.date = pairs.date" \
+                        % (",".join(["(?, ?, ?)"] * (j - i)), field)
+                parameters = [x for k in range(i, j) for x in (k, pair_sids[k], days[k])]
+                rows = conn.execute(query, parameters).fetchall()
+                if len(rows) > 0:
+                    found = np.array(rows, dtype=float64_dtype)
+                    values[found[:, 0].astype(np.int64)] = found[:, 1]
+        return values
+
+    def get_previous_values(self, sids, dts, field):
+        """Get a field value for many (sid, date) pairs on the session before each date.
+
+        Args:
+            sids: Security identifiers.
+            dts: Dates, one per sid.
+            field: Column name (e.g., 'close', 'volume').
+
+        Returns:
+            np.ndarray: The value of each pair, NaN if the sid has no data on the
+            previous session or if the date is not after the first session.
+        """
+        self._check_field(field)
+        return previous_session_values(self, sids, dts, field)
 
     # @cached
     def load_dataframe(self, field, start_dt, end_dt, sids):
@@ -306,29 +755,54 @@ class SQLiteDailyBarReader(SessionBarReader):
             List of numpy arrays, one per field, each of shape
             (num_sessions, num_sids).
         """
-        start_day = self._fmt_date(start_dt)
-        end_day = self._fmt_date(end_dt)
+        start_day = self._date_key(start_dt)
+        end_day = self._date_key(end_dt)
         sessions = self.trading_calendar.sessions_in_range(start_dt, end_dt)
         log.debug("Loading raw arrays for %d assets (%s)." % (len(sids), type(sids)))
 
         if any(not isinstance(x, (int, np.integer)) for x in sids):
             sids = [x.sid for x in sids]
 
-        raw_arrays = []
-        with sqlite3.connect(self._filename) as conn:
-            for field in fields:
-                query = "SELECT date, sid, %s FROM prices WHERE sid in (%s) and date >= '%s' AND date <= '%s';" \
-                        % (field, ",".join(map(str, sids)), str(start_day), str(end_day))
-                df = pd.read_sql_query(query, conn)
-                result = df.pivot(index='date', columns='sid', values=field)
-                result = result.reindex(index=list(map(self._fmt_date, sessions)), columns=sids)
-                raw_arrays.append(result.values)
-
-        return raw_arrays
+        fields = [self._check_field(field) for field in fields]
+        sids = np.asarray([int(x) for x in sids], dtype=np.int64)
+        sid_index = pd.Index(sids)
+        if not sid_index.is_unique:
+            sid_index = pd.Index(pd.unique(sids))
+        date_index = pd.Index(date_keys(sessions, self.schema_version))
+
+        # the rows are scattered straight into the (sessions x sids) arrays, the missing values are NaN
+        arrays = [np.full((len(date_index), len(sid_index)), np.nan) for _ in fields]
+        query = "SELECT date, sid, %s FROM prices WHERE sid in (%s) and date >= ? AND date <= ?;" \
+                % (", ".join(fields), ",".join(map(str, sid_index)))
+        # record dtype of the rows, the names are positional since a field can be requested twice
+        row_dtype = [('date', date_index.dtype if self.schema_version == 2 else 'U19'), ('sid', np.int64)] + \
+                    [('f%d' % i, float64_dtype) for i in range(len(fields))]
+        with self._pool.connection() as conn, closing(conn.cursor()) as c:
+            c.execute(query, (start_day, end_day))
+            while True:
+                rows = c.fetchmany(LOAD_BATCH_SIZE)
+                if len(rows) == 0:
+                    break
+                records = np.fromiter(rows, dtype=row_dtype, count=len(rows))
+                row_pos = date_index.get_indexer(records['date'])
+                col_pos = sid_index.get_indexer(records['sid'])
+                # the rows on a date that is not a session are dropped
+                valid = row_pos >= 0
+                row_pos, col_pos = row_pos[valid], col_pos[valid]
+                for i, array in enumerate(arrays):
+                    array[row_pos, col_pos] = records['f%d' % i][valid]
+
+        if len(sid_index) != len(sids):
+            arrays = [array[:, sid_index.get_indexer(sids)] for array in arrays]
+        return arrays
 
     def get_last_traded_dt(self, sid, dt):
         """Get the last traded datetime for a sid on or before dt.
 
+        The traded range of the sid in the manifest answers the dates before
+        its first and after its last trade, the dates in between are a
+        search of the (sid, date) index.
+
         Args:
             sid: Security identifier.
             dt: Date to query.
@@ -339,41 +813,69 @@ class SQLiteDailyBarReader(SessionBarReader):
         Raises:
             KeyError: If the sid does not exist.
         """
-        day = self._fmt_date(dt)
-        sql = "SELECT date FROM prices WHERE sid = %d and date = '%s'" % (sid, day)
-        res = self._query(sql)
-        if len(res) == 0:
-            if self._exist_sid(sid):
+        day = pd.Timestamp(dt).tz_localize(None).normalize()
+        self._refresh()
+        manifest = self._manifest()
+        if manifest is not None:
+            first_traded, last_traded = manifest.traded_range(sid)
+            if day < first_traded.normalize():
                 return pd.NaT
-            else:
-                raise KeyError(sid)
-
-        return pd.Timestamp(res[0][0]).tz_localize(None)
+            if day >= last_traded.normalize():
+                return last_traded
+
+        day_key = self._date_key(day)
+        if int(sid) in self._session_snapshot(day_key).sids:
+            return self._to_timestamp(day_key)
+        sql = "SELECT MAX(date) FROM prices WHERE sid = ? AND date <= ?"
+        last_traded = self._to_timestamp(self._query(sql, (int(sid), day_key))[0][0])
+        if last_traded is pd.NaT and manifest is None and not self._exist_sid(sid):
+            raise KeyError(sid)
+        return last_traded
 
     @property
     def last_available_dt(self):
+        self._refresh()
+        manifest = self._manifest()
+        if manifest is not None:
+            return manifest.last_session
         sql = "SELECT MAX(date) FROM prices"
         res = self._query(sql)
         if len(res) == 0:
             return pd.NaT
-        return pd.Timestamp(res[0][0]).tz_localize(None)
+        return self._to_timestamp(res[0][0])
 
     @property
     def trading_calendar(self):
-        sql = 'SELECT "0" FROM properties WHERE key="calendar_name"'
-        res = self._query(sql)
-        if len(res) == 0:
-            raise ValueError("No trading calendar defined.")
-        return get_calendar(res[0][0], start=pd.Timestamp('2000-01-01 00:00:00'))
+        manifest = self._manifest()
+        if manifest is not None and manifest.calendar_name is not None:
+            calendar_name = manifest.calendar_name
+        elif self._calendar_name is not None:
+            calendar_name = self._calendar_name
+        else:
+            sql = 'SELECT "0" FROM properties WHERE key="calendar_name"'
+            res = self._query(sql)
+            if len(res) == 0:
+                raise ValueError("No trading calendar defined.")
+            calendar_name = self._calendar_name = res[0][0]
+        # building a calendar is expensive, it is done once per name
+        calendar = self._calendars.get(calendar_name)
+        if calendar is None:
+            calendar = self._calendars[calendar_name] = get_calendar(calendar_name,
+                                                                     start=pd.Timestamp('2000-01-01 00:00:00'))
+        return calendar
 
     @property
     def first_trading_day(self):
         trading_calendar_first_session = self.trading_calendar.first_session
-        sql = "SELECT MIN(date) FROM prices"
-        res = self._query(sql)
-        if len(res) == 0:
-            return pd.NaT
-        first_trading_day = pd.Timestamp(res[0][0]).tz_localize(None)
+        manifest = self._manifest()
+        if manifest is not None:
+            first_trading_day = manifest.first_session
+        else:
+            sql = "SELECT MIN(date) FROM prices"
+            res = self._query(sql)
+            if len(res) == 0:
+                return pd.NaT
+            first_trading_day = self._to_timestamp(res[0][0])
         return max(first_trading_day, trading_calendar_first_session)
 
     @property
@@ -408,51 +910,83 @@ class SQLiteDailyAdjustmentWriter(SQLiteAdjustmentWriter):
                 c.executescript(SCHEMA_ADJUST)
 
     def _write(self, tablename, expected_dtypes, frame):
+        """Bulk insert the rows of a frame, in a single transaction.
+
+        The columns of the frame are matched by name with the columns of the
+        table, and the index of the frame goes to the remaining column
+        ("index" or "date"). The rows are inserted with INSERT OR REPLACE
+        semantics, the rows with NaN values are skipped.
+
+        Args:
+            tablename: Name of the adjustments table.
+            expected_dtypes: Map from column name to its expected dtype.
+            frame: DataFrame of the rows, or None.
+
+        Raises:
+            ValueError: If the columns of the frame are not the expected ones.
+            TypeError: If a column does not have the expected dtype.
+        """
         if frame is None or frame.empty:
-            # keeping the dtypes correct for empty frames is not easy
-            frame = pd.DataFrame(
-                np.array([], dtype=list(expected_dtypes.items())),
-            )
-        else:
-            if frozenset(frame.columns) != frozenset(expected_dtypes):
-                raise ValueError(
-                    "Unexpected frame columns:\n"
-                    "Expected Columns: %s\n"
-                    "Received Columns: %s" % (
-                        set(expected_dtypes),
-                        frame.columns.tolist(),
-                    )
+            return
+
+        if frozenset(frame.columns) != frozenset(expected_dtypes):
+            raise ValueError(
+                "Unexpected frame columns:\n"
+                "Expected Columns: %s\n"
+                "Received Columns: %s" % (
+                    set(expected_dtypes),
+                    frame.columns.tolist(),
                 )
+            )
 
-            actual_dtypes = frame.dtypes
-            for colname, expected in iteritems(expected_dtypes):
-                actual = actual_dtypes[colname]
-                if actual != expected:
-                    raise TypeError(
-                        "Expected data of type {expected} for column"
-                        " '{colname}', but got '{actual}'.".format(
-                            expected=expected,
-                            colname=colname,
-                            actual=actual,
-                        ),
-                    )
+        actual_dtypes = frame.dtypes
+        for colname, expected in iteritems(expected_dtypes):
+            actual = actual_dtypes[colname]
+            if actual != expected:
+                raise TypeError(
+                    "Expected data of type {expected} for column"
+                    " '{colname}', but got '{actual}'.".format(
+                        expected=expected,
+                        colname=colname,
+                        actual=actual,
+                    ),
+                )
 
-        with closing(sqlite3.connect(self._filename)) as con, con, closing(con.cursor()) as c:
-            with click.progressbar(length=len(frame), label="Inserting price data...") as pbar:
-                count = 0
-                for index, row in frame.iterrows():
-                    sql = "INSERT OR REPLACE INTO %s VALUES ('%s', %s)"
-                    cmd = sql % (tablename, index, ', '.join(map(str, row.values)))
-                    try:
-                        c.execute(cmd)
-                    except sqlite3.OperationalError as e:
-                        log.error(str(e) + ": " + cmd)
-                    count += 1
-                    pbar.update(count)
+        invalid = frame.isnull().any(axis=1).values
+        if invalid.any():
+            log.error("Skipping %d %s rows with NaN values." % (invalid.sum(), tablename))
+            frame = frame[~invalid]
+
+        # the index of the frame goes to the table column that is not a frame column ("index" or "date")
+        with closing(sqlite3.connect(self._filename)) as con:
+            table_columns = [row[1] for row in con.execute('PRAGMA table_info("%s")' % tablename).fetchall()]
+        index_column = [c for c in table_columns if c not in frame.columns][0]
+        if isinstance(frame.index, pd.DatetimeIndex):
+            index = frame.index.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            index = frame.index.astype(str)
+        columns = [index_column] + list(frame.columns)
+        records = np.rec.fromarrays([np.asarray(index, dtype=str)] + [frame[c].values for c in frame.columns],
+                                    names=['f%d' % i for i in range(len(columns))])
+
+        sql = 'INSERT OR REPLACE INTO "%s" (%s) VALUES (%s)' % (
+            tablename, ', '.join('"%s"' % c for c in columns), ', '.join('?' * len(columns)))
+        with closing(sqlite3.connect(self._filename)) as con, closing(con.cursor()) as c:
+            with con:
+                c.execute("BEGIN")
+                with click.progressbar(length=len(records), label="Inserting %s..." % tablename) as pbar:
+                    for i in range(0, len(records), ADJUSTMENT_BATCH_SIZE):
+                        j = min(i + ADJUSTMENT_BATCH_SIZE, len(records))
+                        # tolist converts the numpy values to the Python types bound by sqlite3
+                        c.executemany(sql, records[i:j].tolist())
+                        pbar.update(j - i)
 
     def write(self, splits=None, mergers=None, dividends=None, stock_dividends=None):
         """Write splits, mergers, and dividend data to the database.
 
+        The adjustment factors are rebuilt from all the adjustments of the
+        database, see sharadar.data.adjustment_factors.
+
         Args:
             splits: DataFrame of split records.
             mergers: DataFrame of merger records.
@@ -462,6 +996,60 @@ class SQLiteDailyAdjustmentWriter(SQLiteAdjustmentWriter):
         self.write_frame('splits', splits)
         self.write_frame('mergers', mergers)
         self.write_dividend_data(dividends, stock_dividends)
+        write_adjustment_factors(self._filename)
+
+    def _processed_dividends(self, dividends):
+        """Mask of the dividends whose ratio is already in the dividends table, written by a previous ingest.
+
+        Args:
+            dividends: DataFrame of dividend payouts, with sid and ex_date columns.
+
+        Returns:
+            np.ndarray: Boolean mask of the dividends.
+        """
+        effective_dates = dividends.ex_date.values.astype('datetime64[s]').astype(np.int64)
+        sql = "SELECT sid, effective_date FROM dividends WHERE effective_date >= ?"
+        with closing(sqlite3.connect(self._filename)) as con:
+            rows = con.execute(sql, (int(effective_dates.min()),)).fetchall()
+        processed = pd.MultiIndex.from_tuples(rows, names=['sid', 'effective_date']) if len(rows) > 0 else None
+        if processed is None:
+            return np.zeros(len(dividends), dtype=bool)
+        pairs = pd.MultiIndex.from_arrays([dividends.sid.values.astype(np.int64), effective_dates])
+        return pairs.isin(processed)
+
+    def _adjustment_multipliers(self, sids, dates, end):
+        """Product of the adjustment ratios of each sid effective after its date and on or before end.
+
+        The prices of a date multiplied by it are adjusted as of end, like the
+        history windows of the DataPortal.
+
+        Args:
+            sids: Security identifiers.
+            dates: DatetimeIndex, one date per sid.
+            end: Date as of which the prices are adjusted.
+
+        Returns:
+            np.ndarray: The multiplier of each (sid, date) pair, 1.0 without adjustments.
+        """
+        multipliers = np.ones(len(sids))
+        if len(sids) == 0:
+            return multipliers
+        seconds = dates.values.astype('datetime64[s]').astype(np.int64)
+        end_seconds = pd.Timestamp(end).to_datetime64().astype('datetime64[s]').astype(np.int64)
+        sql = " UNION ALL ".join(
+            "SELECT sid, effective_date, ratio FROM %s WHERE effective_date > ? AND effective_date <= ?" % table
+            for table in ('splits', 'mergers', 'dividends'))
+        with closing(sqlite3.connect(self._filename)) as con:
+            rows = con.execute(sql, (int(seconds.min()), int(end_seconds)) * 3).fetchall()
+        if len(rows) == 0:
+            return multipliers
+        adjustments = pd.DataFrame(rows, columns=['sid', 'effective_date', 'ratio'])
+        for sid, group in adjustments.groupby('sid'):
+            ix = np.flatnonzero(sids == sid)
+            if len(ix) > 0:
+                after = group.effective_date.values[None, :] > seconds[ix, None]
+                multipliers[ix] = np.prod(np.where(after, group.ratio.values[None, :], 1.0), axis=1)
+        return multipliers
 
     def calc_dividend_ratios(self, dividends):
         """
@@ -469,6 +1057,10 @@ class SQLiteDailyAdjustmentWriter(SQLiteAdjustmentWriter):
         history so that the price is smoothed over the ex_date, when the market
         adjusts to the change in equity value due to upcoming dividend.
 
+        The dividends already in the dividends table are skipped, and the close
+        on the session before each ex_date is looked up by (sid, date), adjusted
+        as of the last session.
+
         Returns
         -------
         DataFrame
@@ -477,47 +1069,39 @@ class SQLiteDailyAdjustmentWriter(SQLiteAdjustmentWriter):
             - effective_date, the date in seconds on which to apply the ratio.
             - ratio, the ratio to apply to backwards looking pricing data.
         """
+        empty = pd.DataFrame(np.array(
+            [],
+            dtype=[
+                ('sid', uint64_dtype),
+                ('effective_date', uint32_dtype),
+                ('ratio', float64_dtype),
+            ],
+        ))
         if dividends is None or dividends.empty:
-            return pd.DataFrame(np.array(
-                [],
-                dtype=[
-                    ('sid', uint64_dtype),
-                    ('effective_date', uint32_dtype),
-                    ('ratio', float64_dtype),
-                ],
-            ))
+            return empty
+
+        processed = self._processed_dividends(dividends)
+        if processed.any():
+            log.info("Skipping %d dividends processed by a previous ingest." % processed.sum())
+            dividends = dividends[~processed]
+            if dividends.empty:
+                return empty
 
         pricing_reader = self._equity_daily_bar_reader
-        input_sids = dividends.sid.values
-        unique_sids, sids_ix = np.unique(input_sids, return_inverse=True)
-        dates = pricing_reader.sessions.values
-        start = pd.Timestamp(dates[0]).tz_localize(None)
+        sessions = pricing_reader.sessions
+        dates = sessions.values
         end = pd.Timestamp(dates[-1]).tz_localize(None)
-        calendar = self._equity_daily_bar_reader.trading_calendar
-
-        data_portal = DataPortal(self._asset_finder,
-                                 trading_calendar=calendar,
-                                 first_trading_day=start,
-                                 equity_daily_reader=self._equity_daily_bar_reader,
-                                 adjustment_reader=SQLiteAdjustmentReader(self._filename))
-
-        close = data_portal.get_history_window(assets=unique_sids,
-                                               end_dt=end,
-                                               bar_count=calendar.sessions_distance(start, end),
-                                               frequency='1d',
-                                               field='close',
-                                               data_frequency='daily').values
 
         date_ix = np.searchsorted(dates, dividends.ex_date.values)
         mask = date_ix > 0
 
         date_ix = date_ix[mask]
-        sids_ix = sids_ix[mask]
+        input_sids = dividends.sid.values[mask]
         input_dates = dividends.ex_date.values[mask]
 
-        # subtract one day to get the close on the day prior to the merger
-        previous_close = close[date_ix - 1, sids_ix]
-        input_sids = input_sids[mask]
+        # the close on the day prior to the ex_date
+        previous_close = pricing_reader.get_previous_values(input_sids, input_dates, 'close')
+        previous_close *= self._adjustment_multipliers(input_sids, sessions[date_ix - 1], end)
 
         amount = dividends.amount.values[mask]
         ratio = 1.0 - amount / previous_close
@@ -0,0 +1,103 @@
+"""Data sources of the Sharadar tables used by the ingestion.
+
+NasdaqDataLinkSource downloads the tables from NASDAQ Data Link.
+LocalDataSource reads the same tables from CSV files in a directory, e.g. to
+ingest a previously saved snapshot or to run the ingestion offline in tests.
+"""
+import os
+from os import environ as env
+
+import nasdaqdatalink
+import pandas as pd
+
+from sharadar.util import nasdaqdatalink_util
+
+
+class NasdaqDataLinkSource(object):
+    """Sharadar tables downloaded from NASDAQ Data Link.
+
+    Attributes:
+        api_key: NASDAQ Data Link API key, defaults to the NASDAQ_API_KEY environment variable.
+    """
+    def __init__(self, api_key=None):
+        self.api_key = api_key if api_key is not None else env.get("NASDAQ_API_KEY", "")
+
+    def last_available_date(self):
+        return nasdaqdatalink_util.last_available_date()
+
+    def fetch_tickers(self):
+        """SHARADAR/TICKERS metadata of the SEP and SFP tables."""
+        nasdaqdatalink.ApiConfig.api_key = self.api_key
+        return nasdaqdatalink.get_table('SHARADAR/TICKERS', table=['SFP', 'SEP'], paginate=True)
+
+    def fetch_entire_table(self, table_name, parse_dates=False):
+        return nasdaqdatalink_util.fetch_entire_table(self.api_key, table_name, parse_dates=parse_dates)
+
+    def fetch_table_by_date(self, table_name, start, end=None):
+        return nasdaqdatalink_util.fetch_table_by_date(self.api_key, table_name, start, end)
+
+    def fetch_sf1_table_date(self, start, end=None):
+        return nasdaqdatalink_util.fetch_sf1_table_date(self.api_key, start, end)
+
+    def fetch_actions(self, start, actions):
+        """SHARADAR/ACTIONS of the given types (e.g. ['split']) from the start date."""
+        nasdaqdatalink.ApiConfig.api_key = self.api_key
+        return nasdaqdatalink.get_table('SHARADAR/ACTIONS', date={'gte': start}, action=actions, paginate=True)
+
+
+class LocalDataSource(object):
+    """Sharadar tables read from CSV files, one per table (SEP.csv, SFP.csv, SF1.csv,
+    DAILY.csv, ACTIONS.csv and TICKERS.csv).
+
+    The files have the same columns as the NASDAQ Data Link tables, and the
+    queries are filtered like the corresponding NASDAQ Data Link queries.
+
+    Attributes:
+        directory: Directory of the CSV files.
+    """
+    DATE_COLUMNS = ['date', 'datekey', 'reportperiod', 'calendardate', 'lastupdated',
+                    'firstpricedate', 'lastpricedate']
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _read(self, table_name):
+        # 'SHARADAR/SEP' -> SEP.csv
+        path = os.path.join(self.directory, table_name.split('/')[-1] + '.csv')
+        df = pd.read_csv(path, na_values=['NA'])
+        for column in self.DATE_COLUMNS:
+            if column in df.columns:
+                df[column] = pd.to_datetime(df[column])
+        return df
+
+    @staticmethod
+    def _between(values, start, end):
+        mask = values >= pd.Timestamp(start)
+        if end is not None:
+            mask &= values <= pd.Timestamp(end)
+        return mask
+
+    def last_available_date(self):
+        tickers = self._read('SHARADAR/TICKERS')
+        return tickers.loc[tickers['ticker'] == 'SPY', 'lastpricedate'].iloc[0].strftime('%Y-%m-%d')
+
+    def fetch_tickers(self):
+        df = self._read('SHARADAR/TICKERS')
+        return df[df['table'].isin(['SFP', 'SEP'])].reset_index(drop=True)
+
+    def fetch_entire_table(self, table_name, parse_dates=False):
+        return self._read(table_name)
+
+    def fetch_table_by_date(self, table_name, start, end=None):
+        df = self._read(table_name)
+        return df[self._between(df['date'], start, end)].reset_index(drop=True)
+
+    def fetch_sf1_table_date(self, start, end=None):
+        df = self._read('SHARADAR/SF1')
+        df = df[df['dimension'].isin(['ARQ', 'ART'])]
+        return df[self._between(df['lastupdated'], start, end)].reset_index(drop=True)
+
+    def fetch_actions(self, start, actions):
+        df = self._read('SHARADAR/ACTIONS')
+        df = df[df['action'].isin(actions) & self._between(df['date'], start, None)]
+        return df.reset_index(drop=True)
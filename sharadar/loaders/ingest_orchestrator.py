@@ -0,0 +1,181 @@
+"""Concurrent and resumable execution of the ingestion stages.
+
+The ingestion is a graph of stages: the downloads (SEP, SFP, SF1, DAILY) are
+independent of each other and the writes go to different database files.
+IngestOrchestrator runs each stage as soon as the stages it requires are done,
+in a thread pool, and checkpoints the result of each completed stage to disk.
+A failed run can then resume from the failed stage.
+
+The result of a stage, in memory and on disk, is dropped as soon as all the
+stages requiring it are done, so that the downloaded frames do not stay
+alive until the end of the ingestion.
+"""
+import os
+import pickle
+import shutil
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from sharadar.util.logger import log
+
+KEY_FILENAME = 'key.txt'
+
+
+class Stage(namedtuple('Stage', ['name', 'func', 'requires'])):
+    """A stage of the ingestion.
+
+    Attributes:
+        name: Unique name of the stage, also the name of its checkpoint.
+        func: Callable called with the results of the required stages, in order.
+        requires: Names of the stages that must complete before this one.
+    """
+    def __new__(cls, name, func, requires=()):
+        return super(Stage, cls).__new__(cls, name, func, tuple(requires))
+
+
+class IngestCheckpoint(object):
+    """Results of the completed stages, pickled in a directory.
+
+    The checkpoints are valid only for the same key (e.g. the ingestion
+    parameters), they are discarded if the key changes.
+
+    Attributes:
+        directory: Directory of the checkpoint files.
+    """
+    def __init__(self, directory, key=''):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        key_path = os.path.join(directory, KEY_FILENAME)
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                if f.read() != key:
+                    log.info("Discarding the ingest checkpoints of a different run in %s" % directory)
+                    self.clear()
+                    os.makedirs(directory, exist_ok=True)
+        with open(key_path, 'w') as f:
+            f.write(key)
+
+    def _path(self, stage_name):
+        return os.path.join(self.directory, stage_name + '.pkl')
+
+    def has(self, stage_name):
+        return os.path.exists(self._path(stage_name))
+
+    def load(self, stage_name):
+        with open(self._path(stage_name), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage_name, result):
+        path = self._path(stage_name)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # a checkpoint is either complete or missing
+        os.replace(path + '.tmp', path)
+
+    def discard(self, stage_name):
+        """Remove the checkpoint of a stage, if any."""
+        try:
+            os.remove(self._path(stage_name))
+        except OSError:
+            pass
+
+    def completed(self):
+        return sorted(f[:-len('.pkl')] for f in os.listdir(self.directory) if f.endswith('.pkl'))
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class IngestOrchestrator(object):
+    """Runs the stages concurrently, in dependency order.
+
+    Attributes:
+        stages: List of Stage.
+        checkpoint: Optional IngestCheckpoint, the completed stages are skipped.
+        max_workers: Number of threads.
+    """
+    def __init__(self, stages, checkpoint=None, max_workers=4):
+        self.stages = {s.name: s for s in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Duplicate stage names.")
+        for s in stages:
+            unknown = set(s.requires) - set(self.stages)
+            if unknown:
+                raise ValueError("Stage '%s' requires unknown stages: %s" % (s.name, sorted(unknown)))
+        self.checkpoint = checkpoint
+        self.max_workers = max_workers
+        # the stages requiring each stage
+        self.consumers = {name: {s.name for s in stages if name in s.requires} for name in self.stages}
+
+    def _run_stage(self, stage, inputs):
+        log.info("Start ingest stage '%s'..." % stage.name)
+        result = stage.func(*inputs)
+        if self.checkpoint is not None:
+            self.checkpoint.save(stage.name, result)
+        log.info("Ingest stage '%s' completed." % stage.name)
+        return result
+
+    def _consumed(self, name, finished):
+        """True if the result of a stage is required by stages and all of them are finished."""
+        consumers = self.consumers[name]
+        return len(consumers) > 0 and consumers <= finished
+
+    def _drop(self, name, results, finished):
+        """Drop the result of a stage, and its checkpoint, once all the stages requiring it are finished."""
+        if name in results and self._consumed(name, finished):
+            del results[name]
+            if self.checkpoint is not None:
+                self.checkpoint.discard(name)
+
+    def run(self):
+        """Run all the stages.
+
+        If a stage fails, no other stage is started, the running ones are
+        completed and the first error is raised.
+
+        Returns:
+            dict: Map from stage name to its result, for the stages that no
+            other stage requires.
+        """
+        results = {}
+        finished = set()
+        if self.checkpoint is not None:
+            completed = set(self.checkpoint.completed()) & set(self.stages)
+            for name in sorted(completed):
+                finished.add(name)
+                if self._consumed(name, completed):
+                    self.checkpoint.discard(name)
+                    continue
+                log.info("Resuming ingest stage '%s' from checkpoint." % name)
+                results[name] = self.checkpoint.load(name)
+
+        pending = {name: s for name, s in self.stages.items() if name not in finished}
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    ready = [s for s in pending.values() if all(r in finished for r in s.requires)]
+                    for s in ready:
+                        del pending[s.name]
+                        future = executor.submit(self._run_stage, s, [results[r] for r in s.requires])
+                        running[future] = s.name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                        finished.add(name)
+                        for r in self.stages[name].requires:
+                            self._drop(r, results, finished)
+                    except Exception as e:
+                        log.error("Ingest stage '%s' failed: %s" % (name, e))
+                        if error is None:
+                            error = e
+        if error is not None:
+            raise error
+        if pending:
+            raise ValueError("Cyclic stage requirements: %s" % sorted(pending))
+        return results
@@ -6,18 +6,22 @@ SQLite databases compatible with the zipline-reloaded pipeline.
 """
 from os import environ as env
 import os
+import shutil
 import pandas as pd
 import numpy as np
 import nasdaqdatalink
 
 from exchange_calendars import get_calendar
 from sharadar.util.output_dir import get_data_dir
-from sharadar.util.nasdaqdatalink_util import fetch_entire_table, fetch_table_by_date, fetch_sf1_table_date
-from sharadar.util.nasdaqdatalink_util import last_available_date
-from sharadar.util.equity_supplementary_util import lookup_sid
+from sharadar.util.equity_supplementary_util import SidResolver
 from sharadar.util.equity_supplementary_util import insert_asset_info, insert_fundamentals, insert_daily_metrics
 from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarWriter, SQLiteDailyBarReader, SQLiteDailyAdjustmentWriter
+from sharadar.data.mmap_daily_pricing import MMapDailyBarWriter, PROPERTIES_FILENAME
+from sharadar.data.sharded_daily_pricing import ShardedDailyBarWriter, ShardedDailyBarReader, shards_dir, \
+    shard_years, shard_path
 from sharadar.data.sql_lite_assets import SQLiteAssetDBWriter, SQLiteAssetFinder
+from sharadar.loaders.data_source import NasdaqDataLinkSource
+from sharadar.loaders.ingest_orchestrator import IngestOrchestrator, IngestCheckpoint, Stage
 from zipline.assets import ASSET_DB_VERSION
 from zipline.utils.cli import maybe_show_progress
 from pathlib import Path
@@ -29,6 +33,8 @@ import traceback
 
 nasdaqdatalink.ApiConfig.api_key = env.get("NASDAQ_API_KEY", "")
 
+CHECKPOINT_DIRNAME = "ingest_checkpoints"
+
 
 def process_data_table(df):
     # 'close' prices are adjusted only for stock splits, but not for dividends.
@@ -73,23 +79,33 @@ def must_fetch_entire_table(date):
     return pd.Timestamp(date) <= OLDEST_DATE_SEP
 
 
-def fetch_data(start, end):
+def fetch_prices(table_name, start, end=None, source=None):
     """
-    Fetch the Sharadar Equity Prices (SEP) and Sharadar Fund Prices (SFP). Entire dataset or by date.
+    Fetch a Sharadar price table (SHARADAR/SEP or SHARADAR/SFP). Entire dataset or by date.
     """
+    source = source if source is not None else NasdaqDataLinkSource()
     if must_fetch_entire_table(start):
-        df_sep = fetch_entire_table(env["NASDAQ_API_KEY"], "SHARADAR/SEP", parse_dates=['date'])
-        df_sfp = fetch_entire_table(env["NASDAQ_API_KEY"], "SHARADAR/SFP", parse_dates=['date'])
-    else:
-        df_sep = fetch_table_by_date(env["NASDAQ_API_KEY"], 'SHARADAR/SEP', start, end)
-        df_sfp = fetch_table_by_date(env["NASDAQ_API_KEY"], 'SHARADAR/SFP', start, end)
+        return source.fetch_entire_table(table_name, parse_dates=['date'])
+    return source.fetch_table_by_date(table_name, start, end)
 
+
+def concat_prices(df_sep, df_sfp):
+    """Concatenate the SEP and SFP prices, without duplicates."""
     df = pd.concat([df_sep, df_sfp])
     df = df.drop_duplicates().reset_index(drop=True)
     return df
 
 
-def get_data(sharadar_metadata_df, related_tickers, start=None, end=None):
+def fetch_data(start, end, source=None):
+    """
+    Fetch the Sharadar Equity Prices (SEP) and Sharadar Fund Prices (SFP). Entire dataset or by date.
+    """
+    df_sep = fetch_prices('SHARADAR/SEP', start, end, source)
+    df_sfp = fetch_prices('SHARADAR/SFP', start, end, source)
+    return concat_prices(df_sep, df_sfp)
+
+
+def get_data(sharadar_metadata_df, related_tickers, start=None, end=None, source=None):
     """Fetch and prepare price data with security identifiers.
 
     Fetches raw price data, maps tickers to SIDs, removes unknown
@@ -100,15 +116,32 @@ def get_data(sharadar_metadata_df, related_tickers, start=None, end=None):
         related_tickers: Series mapping tickers to related ticker strings.
         start: Start date for fetch. Defaults to None (full fetch).
         end: End date for fetch. Defaults to None.
+        source: Data source of the tables. Defaults to NASDAQ Data Link.
 
     Returns:
         pd.DataFrame: Sorted DataFrame indexed by ['date', 'sid'] with
         unadjusted OHLCV columns.
     """
-    df = fetch_data(start, end)
+    return prepare_prices(fetch_data(start, end, source), sharadar_metadata_df, related_tickers)
 
+
+def prepare_prices(df, sharadar_metadata_df, related_tickers, sid_resolver=None):
+    """Add the SIDs to the raw SEP/SFP prices and convert them to unadjusted prices.
+
+    Args:
+        df: Raw price data, as returned by fetch_data.
+        sharadar_metadata_df: Sharadar ticker metadata DataFrame.
+        related_tickers: Series mapping tickers to related ticker strings.
+        sid_resolver: Optional SidResolver of the metadata.
+
+    Returns:
+        pd.DataFrame: Sorted DataFrame indexed by ['date', 'sid'] with
+        unadjusted OHLCV columns.
+    """
     log.info("Adding SIDs to all stocks...")
-    df['sid'] = df['ticker'].apply(lambda x: lookup_sid(sharadar_metadata_df, related_tickers, x))
+    if sid_resolver is None:
+        sid_resolver = SidResolver(sharadar_metadata_df, related_tickers)
+    df['sid'] = sid_resolver.map(df['ticker'].values)
     # unknown sids are -1 instead of nan to preserve the integer type. Drop them.
     unknown_sids = df[df['sid'] == -1]
     df.drop(unknown_sids.index, inplace=True)
@@ -118,7 +151,7 @@ def get_data(sharadar_metadata_df, related_tickers, start=None, end=None):
     return df.sort_index()
 
 
-def create_dividends_df(sharadar_metadata_df, related_tickers, existing_tickers, start):
+def create_dividends_df(sharadar_metadata_df, related_tickers, existing_tickers, start, source=None, sid_resolver=None):
     """Create a dividends DataFrame from NASDAQ Data Link actions data.
 
     Args:
@@ -126,14 +159,14 @@ def create_dividends_df(sharadar_metadata_df, related_tickers, existing_tickers,
         related_tickers: Series mapping tickers to related ticker strings.
         existing_tickers: List of tickers with price data.
         start: Start date for dividend query.
+        source: Data source of the tables. Defaults to NASDAQ Data Link.
+        sid_resolver: Optional SidResolver of the metadata.
 
     Returns:
         pd.DataFrame: Dividend records with sid, amount, and date columns.
     """
-    dividends_df = nasdaqdatalink.get_table('SHARADAR/ACTIONS',
-                                            date={'gte': start},
-                                            action=['dividend', 'spinoffdividend'],
-                                            paginate=True)
+    source = source if source is not None else NasdaqDataLinkSource()
+    dividends_df = source.fetch_actions(start, ['dividend', 'spinoffdividend'])
 
     # Remove dividends_df entries, whose ticker doesn't exist
     tickers_dividends = dividends_df['ticker'].unique()
@@ -141,7 +174,9 @@ def create_dividends_df(sharadar_metadata_df, related_tickers, existing_tickers,
     dividends_df = dividends_df.loc[dividends_df['ticker'].isin(tickers_intersect)]
 
     dividends_df = dividends_df.rename(columns={'value': 'amount'})
-    dividends_df['sid'] = dividends_df['ticker'].apply(lambda x: lookup_sid(sharadar_metadata_df, related_tickers, x))
+    if sid_resolver is None:
+        sid_resolver = SidResolver(sharadar_metadata_df, related_tickers)
+    dividends_df['sid'] = sid_resolver.map(dividends_df['ticker'].values)
     dividends_df.index = dividends_df['date']
     dividends_df['record_date'] = dividends_df['declared_date'] = dividends_df['pay_date'] = dividends_df[
         'ex_date'] = dividends_df.index
@@ -149,7 +184,7 @@ def create_dividends_df(sharadar_metadata_df, related_tickers, existing_tickers,
     return dividends_df
 
 
-def create_splits_df(sharadar_metadata_df, related_tickers, existing_tickers, start):
+def create_splits_df(sharadar_metadata_df, related_tickers, existing_tickers, start, source=None, sid_resolver=None):
     """Create a splits DataFrame from NASDAQ Data Link actions data.
 
     Args:
@@ -157,14 +192,14 @@ def create_splits_df(sharadar_metadata_df, related_tickers, existing_tickers, st
         related_tickers: Series mapping tickers to related ticker strings.
         existing_tickers: List of tickers with price data.
         start: Start date for splits query.
+        source: Data source of the tables. Defaults to NASDAQ Data Link.
+        sid_resolver: Optional SidResolver of the metadata.
 
     Returns:
         pd.DataFrame: Split records with effective_date, ratio, and sid columns.
     """
-    splits_df = nasdaqdatalink.get_table('SHARADAR/ACTIONS',
-                                         date={'gte': start},
-                                         action=['split'],
-                                         paginate=True)
+    source = source if source is not None else NasdaqDataLinkSource()
+    splits_df = source.fetch_actions(start, ['split'])
 
     # Remove splits_df entries, whose ticker doesn't exist
     tickers_splits = splits_df['ticker'].unique()
@@ -182,49 +217,61 @@ def create_splits_df(sharadar_metadata_df, related_tickers, existing_tickers, st
         copy=False,
     )
     splits_df['ratio'] = splits_df['ratio'].astype(float)
-    splits_df['sid'] = splits_df['ticker'].apply(lambda x: lookup_sid(sharadar_metadata_df, related_tickers, x))
+    if sid_resolver is None:
+        sid_resolver = SidResolver(sharadar_metadata_df, related_tickers)
+    splits_df['sid'] = sid_resolver.map(splits_df['ticker'].values)
     splits_df.drop(['action', 'name', 'contraticker', 'contraname', 'ticker'], axis=1, inplace=True)
     return splits_df
 
 
-def synch_to_calendar(sessions, start_date, end_date, df_ticker: pd.DataFrame, df: pd.DataFrame):
-    """Synchronize ticker price data to the trading calendar.
+def synch_to_calendar(sessions, df: pd.DataFrame):
+    """Synchronize the price data to the trading calendar.
 
-    Fills missing interstitial trading dates by forward-filling price data
-    and setting volume to 0 for missing days.
+    Builds the (session x sid) lattice of the live range of each sid, from
+    its first to its last price date, and adds the missing interstitial
+    sessions: the ticker and the prices are forward filled and the volume is
+    set to 0.
 
     Args:
         sessions: DatetimeIndex of all valid trading sessions.
-        start_date: First date of ticker data.
-        end_date: Last date of ticker data.
-        df_ticker: DataFrame subset for a single ticker.
-        df: Full prices DataFrame (modified in place).
+        df: Prices DataFrame indexed by ['date', 'sid'].
+
+    Returns:
+        Tuple of (synched DataFrame sorted by ['date', 'sid'], Series with the
+        number of synthesized rows per sid).
     """
-    this_cal = sessions[(sessions >= start_date) & (sessions <= end_date)]
+    dates = df.index.get_level_values('date')
+    sids = df.index.get_level_values('sid')
+    live_range = pd.Series(dates).groupby(sids.values).agg(['min', 'max'])
 
-    missing_dates = this_cal.difference(df_ticker.index.get_level_values(0)).values
-    if len(missing_dates) > 0:
-        sid = df_ticker.index.get_level_values('sid')[0]
-        ticker = df_ticker['ticker'][0]
-        log.info("Fixing missing %d interstitial dates for %s from %s to %s: %s."
-                 % (len(missing_dates), ticker, this_cal[0], this_cal[-1], missing_dates))
+    start_ix = sessions.searchsorted(live_range['min'].values, side='left')
+    end_ix = sessions.searchsorted(live_range['max'].values, side='right')
+    counts = end_ix - start_ix
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    lattice = pd.MultiIndex.from_arrays([sessions[np.repeat(start_ix, counts) + offsets],
+                                         np.repeat(live_range.index.values, counts)], names=('date', 'sid'))
 
-        sids = np.full(len(this_cal), sid)
-        synch_index = pd.MultiIndex.from_arrays([this_cal, sids], names=('date', 'sid'))
-        df_ticker_synch = df_ticker.reindex(synch_index)
+    missing = lattice.difference(df.index)
+    synthesized = pd.Series(missing.get_level_values('sid')).value_counts().sort_index()
+    if len(missing) == 0:
+        return df.sort_index(), synthesized
 
-        # Forward fill missing data, volume and dividens must remain 0
-        columns_ffill = ['ticker', 'open', 'high', 'low', 'close']
-        df_ticker_synch[columns_ffill] = df_ticker_synch[columns_ffill].fillna(method='ffill')
-        df_ticker_synch = df_ticker_synch.fillna({'volume': 0})
+    missing_df = pd.DataFrame(np.nan, index=missing, columns=df.columns)
+    df_synch = pd.concat([df, missing_df]).sort_index(level=['sid', 'date'], sort_remaining=False)
 
-        # Drop remaining NaN
-        df_ticker_synch.dropna(inplace=True)
+    # Forward fill missing data, volume and dividens must remain 0
+    columns_ffill = [c for c in ['ticker', 'open', 'high', 'low', 'close'] if c in df_synch.columns]
+    df_synch[columns_ffill] = df_synch.groupby(level='sid')[columns_ffill].ffill()
+    df_synch = df_synch.fillna({'volume': 0})
+
+    # Drop remaining NaN
+    df_synch = df_synch.dropna()
+
+    # a single record, the logger is too slow for a line per sid
+    log.info("Fixing %d missing interstitial dates of %d sids (sid: dates): %s"
+             % (synthesized.sum(), len(synthesized), synthesized.to_dict()))
+    return df_synch.sort_index(), synthesized
 
-        # drop the existing sub dataframe
-        df.drop(df_ticker.index, inplace=True)
-        # and concat with the new one with all the dates.
-        pd.concat([df, df_ticker_synch])
 
 def trading_date(date, cal):
     """
@@ -241,12 +288,14 @@ def trading_date(date, cal):
     return date
 
 def _ingest(start, calendar=get_calendar('XNYS', start=pd.Timestamp('2000-01-01 00:00:00')), output_dir=get_data_dir(),
-            universe=False, sanity_check=True, use_last_available_dt=True):
+            universe=False, sanity_check=True, use_last_available_dt=True, columnar_prices=False,
+            source=None, max_workers=4, resume=True):
     """Main ingestion logic for Sharadar data.
 
     Orchestrates the full ingestion pipeline: fetches prices, metadata,
     fundamentals, daily metrics, splits, and dividends, then writes
-    everything to SQLite databases.
+    everything to SQLite databases. The independent stages run concurrently
+    and each completed stage is checkpointed, see create_ingest_stages.
 
     Args:
         start: Start date for data ingestion.
@@ -255,6 +304,13 @@ def _ingest(start, calendar=get_calendar('XNYS', start=pd.Timestamp('2000-01-01
         universe: If True, updates the tradable stocks universe.
         sanity_check: If True, validates metadata consistency after write.
         use_last_available_dt: If True, uses last DB date as fetch start.
+        columnar_prices: If True, also maintains the memory-mapped columnar
+            price store (prices.mmap) used by MMapDailyBarReader, otherwise
+            the store is removed.
+        source: Data source of the tables. Defaults to NASDAQ Data Link.
+        max_workers: Number of stages running concurrently.
+        resume: If True, resumes a failed ingestion from its checkpoints,
+            otherwise the checkpoints are discarded.
     """
     os.makedirs(output_dir, exist_ok=True)
 
@@ -262,103 +318,16 @@ def _ingest(start, calendar=get_calendar('XNYS', start=pd.Timestamp('2000-01-01
 
     log.info("Start ingesting SEP, SFP and SF1 data into %s ..." % output_dir)
 
-    start_session = trading_date(start, calendar)
-    end_session = pd.Timestamp(last_available_date())
-    # Check valid trading dates, according to the selected exchange calendar
-    sessions = calendar.sessions_in_range(start_session, end_session)
-
-    prices_dbpath = os.path.join(output_dir, "prices.sqlite")
-
-    # use string format expected by nasdaqdatalink
-    start_fetch_date = sessions[0].strftime('%Y-%m-%d')
-    if use_last_available_dt and os.path.exists(prices_dbpath):
-        start_fetch_date = SQLiteDailyBarReader(prices_dbpath).last_available_dt.strftime('%Y-%m-%d')
-
-    log.info("Start fetch date: %s" % start_fetch_date)
-
-    log.info("Start loading sharadar metadata...")
-    related_tickers, sharadar_metadata_df = create_metadata()
-    prices_df = get_data(sharadar_metadata_df, related_tickers, start_fetch_date)
-    if len(prices_df) > 0:
-        # the first price date may differ from start_fetch_date because we query quadl by lastupdate
-        log.info("Price data for %d equities from %s to %s." %
-                 (len(prices_df.index.get_level_values(1)), prices_df.index[0][0], prices_df.index[-1][0]))
-    else:
-        log.info("No price data retrieved for period from %s." % start_fetch_date)
-
-    # iterate over all the securities and pack data and metadata for writing
-    tickers = prices_df['ticker'].unique()
-    log.info("Start creating data for %d equities..." % (len(tickers)))
-    equities_df = create_equities_df(prices_df, tickers, sessions, sharadar_metadata_df, show_progress=True)
-
-    # Additional MACRO data
-    #macro_equities_df = create_macro_equities_df()
-    #equities_df = pd.concat([equities_df, macro_equities_df])
-
-    # Write equity metadata
-    log.info("Start writing equities...")
-    asset_dbpath = os.path.join(output_dir, ("assets-%d.sqlite" % ASSET_DB_VERSION))
-    asset_db_writer = SQLiteAssetDBWriter(asset_dbpath)
-    asset_db_writer.write(equities=equities_df, exchanges=EXCHANGE_DF)
-
-    # Write PRICING data
-    log.info(("Writing pricing data to '%s'..." % (prices_dbpath)))
-    sql_daily_bar_writer = SQLiteDailyBarWriter(prices_dbpath, calendar)
-    prices_df.sort_index(inplace=True)
-    sql_daily_bar_writer.write(prices_df)
-
-    # DIVIDENDS
-    log.info("Creating dividends data...")
-    dividends_df = create_dividends_df(sharadar_metadata_df, related_tickers, tickers, start_fetch_date)
-
-    # SPLITS
-    log.info("Creating splits data...")
-    splits_df = create_splits_df(sharadar_metadata_df, related_tickers, tickers, start_fetch_date)
-
-    # mergers?
-    # see also https://github.com/quantopian/zipline/blob/master/zipline/data/adjustments.py
-
-    # Write dividends and splits_df
-    adjustment_dbpath = os.path.join(output_dir, "adjustments.sqlite")
-    sql_daily_bar_reader = SQLiteDailyBarReader(prices_dbpath)
-    asset_db_reader = SQLiteAssetFinder(asset_dbpath)
-    adjustment_writer = SQLiteDailyAdjustmentWriter(adjustment_dbpath, sql_daily_bar_reader, asset_db_reader, sessions)
+    source = source if source is not None else NasdaqDataLinkSource()
+    stages = create_ingest_stages(start, calendar, output_dir, use_last_available_dt, columnar_prices, source)
 
-    log.info("Start writing %d splits and %d dividends data..." % (len(splits_df), len(dividends_df)))
-    adjustment_writer.write(splits=splits_df, dividends=dividends_df)
-
-    #log.info("Adding macro data from %s ..." % (start_fetch_date))
-    #macro_prices_df = create_macro_prices_df(start_fetch_date, calendar)
-    #sql_daily_bar_writer.write(macro_prices_df)
-
-    log.info("Start writing supplementary_mappings data...")
-    # EQUITY SUPPLEMENTARY MAPPINGS are used for company name, sector, industry and fundamentals financial data.
-    # They could be retrieved by AssetFinder.get_supplementary_field(sid, field_name, as_of_date)
-    log.info("Start creating company info dataframe...")
-    with closing(sqlite3.connect(asset_dbpath)) as conn, conn, closing(conn.cursor()) as cursor:
-        insert_asset_info(sharadar_metadata_df, cursor)
-
-    start_date_fundamentals = asset_db_reader.last_available_fundamentals_dt
-    log.info("Start creating Fundamentals dataframe...")
-    if must_fetch_entire_table(start_date_fundamentals):
-        log.info("Fetch entire table.")
-        sf1_df = fetch_entire_table(env["NASDAQ_API_KEY"], "SHARADAR/SF1", parse_dates=['datekey', 'reportperiod'])
-    else:
-        log.info("Start date: %s" % start_date_fundamentals)
-        sf1_df = fetch_sf1_table_date(env["NASDAQ_API_KEY"], start_date_fundamentals)
-    with closing(sqlite3.connect(asset_dbpath)) as conn, conn, closing(conn.cursor()) as cursor:
-        insert_fundamentals(sharadar_metadata_df, sf1_df, cursor, show_progress=True)
-
-    start_date_metrics = asset_db_reader.last_available_daily_metrics_dt
-    log.info("Start creating daily metrics dataframe...")
-    if must_fetch_entire_table(start_date_metrics):
-        log.info("Fetch entire table.")
-        daily_df = fetch_entire_table(env["NASDAQ_API_KEY"], "SHARADAR/DAILY", parse_dates=['date'])
-    else:
-        log.info("Start date: %s" % start_date_fundamentals)
-        daily_df = fetch_table_by_date(env["NASDAQ_API_KEY"], 'SHARADAR/DAILY', start_date_metrics)
-    with closing(sqlite3.connect(asset_dbpath)) as conn, conn, closing(conn.cursor()) as cursor:
-        insert_daily_metrics(sharadar_metadata_df, daily_df, cursor, show_progress=True)
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIRNAME)
+    if not resume:
+        IngestCheckpoint(checkpoint_dir).clear()
+    # the checkpoints of a failed run are resumed only until the source publishes new data
+    checkpoint = IngestCheckpoint(checkpoint_dir, key="%s %s %s" % (start, columnar_prices,
+                                                                    source.last_available_date()))
+    IngestOrchestrator(stages, checkpoint, max_workers).run()
 
     if universe:
         from sharadar.pipeline.universes import update_universe, TRADABLE_STOCKS_US, base_universe, context
@@ -366,23 +335,214 @@ def _ingest(start, calendar=get_calendar('XNYS', start=pd.Timestamp('2000-01-01
         update_universe(TRADABLE_STOCKS_US, screen)
 
     if sanity_check:
-        if asset_db_writer.check_sanity():
+        asset_dbpath = os.path.join(output_dir, ("assets-%d.sqlite" % ASSET_DB_VERSION))
+        if SQLiteAssetDBWriter(asset_dbpath).check_sanity():
             log.info("Sanity check successful!")
 
+    checkpoint.clear()
     okay_path = os.path.join(output_dir, "ok")
     Path(okay_path).touch()
     log.info("Ingest finished!")
 
 
-def create_metadata():
+def create_ingest_stages(start, calendar, output_dir, use_last_available_dt, columnar_prices, source):
+    """Create the stages of the ingestion, see _ingest.
+
+    The downloads (SEP, SFP, SF1 and DAILY) run concurrently. The writes to
+    the asset database run one after the other, while the prices and the
+    adjustments are written in their own database files.
+
+    Returns:
+        list: The Stage list for the IngestOrchestrator.
+    """
+    prices_dbpath = os.path.join(output_dir, "prices.sqlite")
+    asset_dbpath = os.path.join(output_dir, ("assets-%d.sqlite" % ASSET_DB_VERSION))
+    adjustment_dbpath = os.path.join(output_dir, "adjustments.sqlite")
+    # the prices are written to the per-year shards once they have been split, see shard_prices
+    prices_shards_path = shards_dir(output_dir)
+    sharded = len(shard_years(prices_shards_path)) > 0
+    mmap_path = os.path.join(output_dir, "prices.mmap")
+
+    def prices_reader():
+        return ShardedDailyBarReader(prices_shards_path) if sharded else SQLiteDailyBarReader(prices_dbpath)
+
+    def params():
+        start_session = trading_date(start, calendar)
+        end_session = pd.Timestamp(source.last_available_date())
+        # Check valid trading dates, according to the selected exchange calendar
+        sessions = calendar.sessions_in_range(start_session, end_session)
+
+        # use string format expected by nasdaqdatalink
+        start_fetch_date = sessions[0].strftime('%Y-%m-%d')
+        if use_last_available_dt and (sharded or os.path.exists(prices_dbpath)):
+            start_fetch_date = prices_reader().last_available_dt.strftime('%Y-%m-%d')
+        log.info("Start fetch date: %s" % start_fetch_date)
+
+        start_date_fundamentals = start_date_metrics = pd.NaT
+        if os.path.exists(asset_dbpath):
+            asset_db_reader = SQLiteAssetFinder(asset_dbpath)
+            start_date_fundamentals = asset_db_reader.last_available_fundamentals_dt
+            start_date_metrics = asset_db_reader.last_available_daily_metrics_dt
+        return dict(sessions=sessions, start_fetch_date=start_fetch_date,
+                    start_date_fundamentals=start_date_fundamentals, start_date_metrics=start_date_metrics)
+
+    def metadata():
+        log.info("Start loading sharadar metadata...")
+        return create_metadata(source)
+
+    def sid_resolver(meta):
+        related_tickers, sharadar_metadata_df = meta
+        return SidResolver(sharadar_metadata_df, related_tickers)
+
+    def sep(p):
+        return fetch_prices('SHARADAR/SEP', p['start_fetch_date'], source=source)
+
+    def sfp(p):
+        return fetch_prices('SHARADAR/SFP', p['start_fetch_date'], source=source)
+
+    def prices(p, meta, resolver, df_sep, df_sfp):
+        related_tickers, sharadar_metadata_df = meta
+        prices_df = prepare_prices(concat_prices(df_sep, df_sfp), sharadar_metadata_df, related_tickers, resolver)
+        if len(prices_df) > 0:
+            # the first price date may differ from start_fetch_date because we query quadl by lastupdate
+            log.info("Price data for %d equities from %s to %s." %
+                     (len(prices_df.index.get_level_values(1)), prices_df.index[0][0], prices_df.index[-1][0]))
+        else:
+            log.info("No price data retrieved.")
+        # Synch to the official exchange calendar, if necessary
+        prices_df, _ = synch_to_calendar(p['sessions'], prices_df)
+        return prices_df
+
+    def equities(meta, prices_df):
+        _, sharadar_metadata_df = meta
+        # iterate over all the securities and pack data and metadata for writing
+        tickers = prices_df['ticker'].unique()
+        log.info("Start creating data for %d equities..." % (len(tickers)))
+        equities_df = create_equities_df(prices_df, tickers, sharadar_metadata_df)
+
+        # Write equity metadata
+        log.info("Start writing equities...")
+        SQLiteAssetDBWriter(asset_dbpath).write(equities=equities_df, exchanges=EXCHANGE_DF)
+        return tickers
+
+    def write_prices(prices_df):
+        if not columnar_prices and os.path.exists(mmap_path):
+            # the columnar store is derived from the prices and would be left stale
+            log.info("Removing the columnar pricing data '%s', not maintained by this ingest." % mmap_path)
+            shutil.rmtree(mmap_path)
+        if sharded:
+            log.info("Writing pricing data to the shards of '%s'..." % prices_shards_path)
+            ShardedDailyBarWriter(prices_shards_path, calendar).write(prices_df)
+            return
+        log.info(("Writing pricing data to '%s'..." % (prices_dbpath)))
+        SQLiteDailyBarWriter(prices_dbpath, calendar).write(prices_df)
+
+    def write_columnar_prices(prices_df, _):
+        log.info("Writing columnar pricing data to '%s'..." % mmap_path)
+        mmap_daily_bar_writer = MMapDailyBarWriter(mmap_path, calendar)
+        if os.path.exists(os.path.join(mmap_path, PROPERTIES_FILENAME)):
+            mmap_daily_bar_writer.write(prices_df)
+        elif sharded:
+            # first build: the shards contain the whole history
+            mmap_daily_bar_writer.write_from_sqlite([shard_path(prices_shards_path, year)
+                                                     for year in shard_years(prices_shards_path)])
+        else:
+            # first build: the sqlite database contains the whole history
+            mmap_daily_bar_writer.write_from_sqlite(prices_dbpath)
+
+    def dividends(p, meta, resolver, tickers):
+        log.info("Creating dividends data...")
+        related_tickers, sharadar_metadata_df = meta
+        return create_dividends_df(sharadar_metadata_df, related_tickers, tickers, p['start_fetch_date'], source,
+                                   resolver)
+
+    def splits(p, meta, resolver, tickers):
+        log.info("Creating splits data...")
+        related_tickers, sharadar_metadata_df = meta
+        return create_splits_df(sharadar_metadata_df, related_tickers, tickers, p['start_fetch_date'], source,
+                                resolver)
+
+    def adjustments(p, dividends_df, splits_df, _, __):
+        # mergers?
+        # see also https://github.com/quantopian/zipline/blob/master/zipline/data/adjustments.py
+        sql_daily_bar_reader = prices_reader()
+        asset_db_reader = SQLiteAssetFinder(asset_dbpath)
+        adjustment_writer = SQLiteDailyAdjustmentWriter(adjustment_dbpath, sql_daily_bar_reader, asset_db_reader,
+                                                        p['sessions'])
+        log.info("Start writing %d splits and %d dividends data..." % (len(splits_df), len(dividends_df)))
+        adjustment_writer.write(splits=splits_df, dividends=dividends_df)
+
+    def sf1(p):
+        start_date_fundamentals = p['start_date_fundamentals']
+        log.info("Start creating Fundamentals dataframe...")
+        if must_fetch_entire_table(start_date_fundamentals):
+            log.info("Fetch entire table.")
+            return source.fetch_entire_table("SHARADAR/SF1", parse_dates=['datekey', 'reportperiod'])
+        log.info("Start date: %s" % start_date_fundamentals)
+        return source.fetch_sf1_table_date(start_date_fundamentals)
+
+    def daily(p):
+        start_date_metrics = p['start_date_metrics']
+        log.info("Start creating daily metrics dataframe...")
+        if must_fetch_entire_table(start_date_metrics):
+            log.info("Fetch entire table.")
+            return source.fetch_entire_table("SHARADAR/DAILY", parse_dates=['date'])
+        log.info("Start date: %s" % start_date_metrics)
+        return source.fetch_table_by_date('SHARADAR/DAILY', start_date_metrics)
+
+    # EQUITY SUPPLEMENTARY MAPPINGS are used for company name, sector, industry and fundamentals financial data.
+    # They could be retrieved by AssetFinder.get_supplementary_field(sid, field_name, as_of_date)
+    def asset_info(meta, _):
+        log.info("Start writing supplementary_mappings data...")
+        _, sharadar_metadata_df = meta
+        with closing(sqlite3.connect(asset_dbpath)) as conn, conn, closing(conn.cursor()) as cursor:
+            insert_asset_info(sharadar_metadata_df, cursor)
+
+    def fundamentals(meta, resolver, sf1_df, _):
+        _, sharadar_metadata_df = meta
+        with closing(sqlite3.connect(asset_dbpath)) as conn, conn, closing(conn.cursor()) as cursor:
+            insert_fundamentals(sharadar_metadata_df, sf1_df, cursor, show_progress=True, sid_resolver=resolver)
+
+    def daily_metrics(meta, resolver, daily_df, _):
+        _, sharadar_metadata_df = meta
+        with closing(sqlite3.connect(asset_dbpath)) as conn, conn, closing(conn.cursor()) as cursor:
+            insert_daily_metrics(sharadar_metadata_df, daily_df, cursor, show_progress=True, sid_resolver=resolver)
+
+    stages = [
+        Stage('params', params),
+        Stage('metadata', metadata),
+        Stage('sid_resolver', sid_resolver, ['metadata']),
+        Stage('sep', sep, ['params']),
+        Stage('sfp', sfp, ['params']),
+        Stage('sf1', sf1, ['params']),
+        Stage('daily', daily, ['params']),
+        Stage('prices', prices, ['params', 'metadata', 'sid_resolver', 'sep', 'sfp']),
+        Stage('equities', equities, ['metadata', 'prices']),
+        Stage('write_prices', write_prices, ['prices']),
+        Stage('dividends', dividends, ['params', 'metadata', 'sid_resolver', 'equities']),
+        Stage('splits', splits, ['params', 'metadata', 'sid_resolver', 'equities']),
+        # the adjustment writer reads the prices and the asset database
+        Stage('adjustments', adjustments, ['params', 'dividends', 'splits', 'equities', 'write_prices']),
+        Stage('asset_info', asset_info, ['metadata', 'adjustments']),
+        Stage('fundamentals', fundamentals, ['metadata', 'sid_resolver', 'sf1', 'asset_info']),
+        Stage('daily_metrics', daily_metrics, ['metadata', 'sid_resolver', 'daily', 'fundamentals']),
+    ]
+    if columnar_prices:
+        stages.append(Stage('columnar_prices', write_columnar_prices, ['prices', 'write_prices']))
+    return stages
+
+
+def create_metadata(source=None):
     """Load Sharadar ticker metadata from NASDAQ Data Link.
 
+    Args:
+        source: Data source of the tables. Defaults to NASDAQ Data Link.
+
     Returns:
         Tuple of (related_tickers Series, sharadar_metadata_df DataFrame).
     """
-    sharadar_metadata_df = nasdaqdatalink.get_table('SHARADAR/TICKERS',
-                                                    table=['SFP', 'SEP'],
-                                                    paginate=True)
+    source = source if source is not None else NasdaqDataLinkSource()
+    sharadar_metadata_df = source.fetch_tickers()
     sharadar_metadata_df.set_index('ticker', inplace=True)
     related_tickers = sharadar_metadata_df['relatedtickers'].dropna()
     # Add a space at the start and end of relatedtickers, search for ' TICKER '
@@ -390,59 +550,52 @@ def create_metadata():
     return related_tickers, sharadar_metadata_df
 
 
-def create_equities_df(df, tickers, sessions, sharadar_metadata_df, show_progress):
-    # Prepare an empty DataFrame for equities, the index of this dataframe is the sid.
+def create_equities_df(df, tickers, sharadar_metadata_df):
     """Build the equities metadata DataFrame for asset DB writing.
 
+    The sids and the metadata of all the tickers are computed with a few
+    groupby passes over the prices, instead of a scan per ticker.
+
     Args:
         df: Full prices DataFrame with 'ticker' column.
         tickers: Array of unique ticker symbols.
-        sessions: DatetimeIndex of trading sessions.
         sharadar_metadata_df: Sharadar ticker metadata.
-        show_progress: Whether to display a progress bar.
 
     Returns:
         pd.DataFrame: Equities metadata indexed by sid.
     """
-    equities_df = pd.DataFrame(columns=METADATA_HEADERS)
-    with maybe_show_progress(tickers, show_progress, label='Loading custom pricing data: ') as it:
-        for ticker in it:
-            df_ticker = df[df['ticker'] == ticker]
-            df_ticker = df_ticker.sort_index()
-
-            sid = df_ticker.index.get_level_values('sid')[0]
-
-            sharadar_metadata = sharadar_metadata_df[sharadar_metadata_df['permaticker'] == sid].iloc[0, :]
-
-            asset_name = sharadar_metadata.loc['name']
-
-            # The date when this asset was created.
-            start_date = sharadar_metadata.loc['firstpricedate']
-
-            # The last date we have trade data for this asset.
-            end_date = sharadar_metadata.loc['lastpricedate']
-
-            # The first date we have trade data for this asset.
-            first_traded = start_date
-
-            # The date on which to close any positions in this asset.
-            auto_close_date = end_date + pd.Timedelta(days=1)
-
-            # The canonical name of the exchange, for example 'NYSE' or 'NASDAQ'
-            exchange = sharadar_metadata.loc['exchange']
-            if (exchange is None) or (exchange == 'None'):
-                exchange = 'OTC'
-            if exchange == 'NYSEAERCA':
-                exchange = 'NYSEARCA'
-
-            # Synch to the official exchange calendar, if necessary
-            date_index = df_ticker.index.get_level_values('date')
-            start_date_df = date_index[0]
-            end_date_df = date_index[-1]
-            synch_to_calendar(sessions, start_date_df, end_date_df, df_ticker, df)
-
-            # Add a row to the metadata DataFrame.
-            equities_df.loc[sid] = ticker, asset_name, start_date, end_date, first_traded, auto_close_date, exchange
+    if len(tickers) == 0:
+        return pd.DataFrame(columns=METADATA_HEADERS)
+
+    prices = pd.DataFrame({'ticker': df['ticker'].values,
+                           'date': df.index.get_level_values('date'),
+                           'sid': df.index.get_level_values('sid')})
+    prices = prices.sort_values(['date', 'sid'], kind='stable')
+    # the sid of a ticker is the one of its first price
+    ticker_df = pd.DataFrame({'sid': prices.groupby('ticker', sort=False)['sid'].first()}).reindex(tickers)
+
+    metadata = sharadar_metadata_df.drop_duplicates('permaticker').set_index('permaticker').reindex(ticker_df['sid'])
+
+    # The canonical name of the exchange, for example 'NYSE' or 'NASDAQ'
+    exchange = metadata['exchange'].where(metadata['exchange'].notna() & (metadata['exchange'] != 'None'), 'OTC')
+    exchange = exchange.replace('NYSEAERCA', 'NYSEARCA')
+
+    equities_df = pd.DataFrame({
+        'symbol': ticker_df.index.values,
+        'asset_name': metadata['name'].values,
+        # The date when this asset was created.
+        'start_date': metadata['firstpricedate'].values,
+        # The last date we have trade data for this asset.
+        'end_date': metadata['lastpricedate'].values,
+        # The first date we have trade data for this asset.
+        'first_traded': metadata['firstpricedate'].values,
+        # The date on which to close any positions in this asset.
+        'auto_close_date': (pd.DatetimeIndex(metadata['lastpricedate']) + pd.Timedelta(days=1)).values,
+        'exchange': exchange.values,
+    }, index=ticker_df['sid'].values, columns=METADATA_HEADERS)
+    # a sid with several tickers has the metadata of the last ticker, at the position of the first one
+    sids = pd.unique(equities_df.index)
+    equities_df = equities_df[~equities_df.index.duplicated(keep='last')].reindex(sids)
     return equities_df
 
 
@@ -0,0 +1,84 @@
+"""Pipeline DataSet and loader for the SHARADAR/DAILY metrics.
+
+The daily metrics (market cap, enterprise value and valuation ratios) are
+stored in the fundamentals table of the asset database.
+DailyMetricsLoader loads all the requested metrics of a pipeline chunk with a
+single query, so a windowed factor is a single AdjustedArray load instead of a
+query per pipeline day.
+"""
+import numpy as np
+from zipline.lib.adjusted_array import AdjustedArray
+from zipline.pipeline.data import Column, DataSet
+from zipline.pipeline.domain import US_EQUITIES
+from zipline.pipeline.loaders.base import PipelineLoader
+from zipline.utils.numpy_utils import float64_dtype
+
+
+class SharadarDailyMetrics(DataSet):
+    """
+    :class:`~zipline.pipeline.data.DataSet` containing the SHARADAR/DAILY metrics.
+
+    marketcap and ev are in millions of dollars, as provided by Sharadar.
+    """
+    domain = US_EQUITIES
+
+    marketcap = Column(float64_dtype)
+    ev = Column(float64_dtype)
+    evebit = Column(float64_dtype)
+    evebitda = Column(float64_dtype)
+    pb = Column(float64_dtype)
+    pe = Column(float64_dtype)
+    ps = Column(float64_dtype)
+
+
+def fill_missing_sessions(data):
+    """Fill the sessions without any value with the values of the previous session.
+
+    The DAILY metrics of the last session may not be ingested yet, because
+    Sharadar computes them with a delay. Only a single missing session is
+    filled, like the previous per-day lookup did.
+
+    Args:
+        data: float64 array of shape (num_sessions, num_assets), modified in place.
+
+    Returns:
+        The filled array.
+    """
+    if data.shape[1] == 0:
+        return data
+    empty = np.isnan(data).all(axis=1)
+    for i in np.flatnonzero(empty[1:]) + 1:
+        if not empty[i - 1]:
+            data[i] = data[i - 1]
+    return data
+
+
+class DailyMetricsLoader(PipelineLoader):
+    """PipelineLoader for SharadarDailyMetrics.
+
+    The value of a session is the metric with the same date, as in
+    SQLiteAssetFinder.get_daily_metrics.
+
+    Attributes:
+        _asset_finder: SQLiteAssetFinder of the bundle.
+    """
+    def __init__(self, asset_finder):
+        self._asset_finder = asset_finder
+
+    def load_adjusted_array(self, domain, columns, dates, sids, mask):
+        # load one more session, to fill the first one if it has no values
+        sessions = domain.sessions()
+        start_ix = sessions.searchsorted(dates[0])
+        has_previous = start_ix > 0
+        load_dates = dates.insert(0, sessions[start_ix - 1]) if has_previous else dates
+
+        field_names = sorted({c.name for c in columns})
+        values = self._asset_finder.get_daily_metrics_window(sids, field_names, load_dates)
+
+        out = {}
+        for c in columns:
+            data = fill_missing_sessions(values[c.name])
+            if has_previous:
+                data = data[1:]
+            out[c] = AdjustedArray(data.astype(c.dtype), adjustments={}, missing_value=c.missing_value)
+        return out
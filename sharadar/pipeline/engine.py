@@ -6,15 +6,23 @@ functions, and price/returns data retrieval for use with the Zipline pipeline AP
 
 import datetime
 import os
+from collections import OrderedDict
 from os.path import exists
 
 import click
 import numpy as np
 import pandas as pd
+from sharadar.data.adjustment_factors import AdjustmentFactorReader, ADJUSTED_FIELDS
+from sharadar.data.in_memory import InMemoryBundle
 from sharadar.data.sql_lite_assets import SQLiteAssetFinder
 from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarReader
+from sharadar.data.mmap_daily_pricing import MMapDailyBarReader
+from sharadar.data.sharded_daily_pricing import ShardedDailyBarReader, SHARDS_DIRNAME, shard_years
+from sharadar.pipeline.daily_metrics import SharadarDailyMetrics, DailyMetricsLoader
+from sharadar.pipeline.equity_metadata import SharadarEquityMetadata, EquityMetadataLoader
 from sharadar.util.logger import log
-from sharadar.util.output_dir import SHARADAR_BUNDLE_NAME, SHARADAR_BUNDLE_DIR, get_cache_dir
+from sharadar.pipeline.term_cache import TermCache, bundle_fingerprint
+from sharadar.util.output_dir import SHARADAR_BUNDLE_NAME, SHARADAR_BUNDLE_DIR, get_cache_dir, get_data_dir
 from toolz import groupby
 from zipline.data.adjustments import SQLiteAdjustmentReader
 from zipline.data.bundles.core import BundleData, asset_db_path, adjustment_db_path
@@ -29,6 +37,7 @@ from zipline.pipeline.loaders.equity_pricing_loader import USEquityPricingLoader
 from zipline.pipeline.term import LoadableTerm, Term
 from zipline.utils import paths as pth
 from zipline.utils.date_utils import compute_date_range_chunks
+from zipline.utils.numpy_utils import object_dtype
 from functools import partial
 
 class BundlePipelineEngine(SimplePipelineEngine):
@@ -40,7 +49,7 @@ class BundlePipelineEngine(SimplePipelineEngine):
         """
     
     def __init__(self, get_loader, asset_finder, default_domain=US_EQUITIES, populate_initial_workspace=None,
-                 default_hooks=None):
+                 default_hooks=None, term_cache=None, bundle_dir=None):
         """Initialize the BundlePipelineEngine.
         
                 Args:
@@ -49,8 +58,32 @@ class BundlePipelineEngine(SimplePipelineEngine):
                     default_domain: The default pipeline domain. Defaults to US_EQUITIES.
                     populate_initial_workspace: Optional callable to pre-populate workspace.
                     default_hooks: Optional default pipeline hooks.
+                    term_cache: Optional TermCache. Defaults to the cache directory of the
+                        bundle, keyed on the fingerprint of the bundle data, taken again at
+                        each pipeline run.
+                    bundle_dir: Directory of the bundle read by the loaders, fingerprinted by
+                        the default TermCache. Defaults to the latest Sharadar bundle.
                 """
         super().__init__(get_loader, asset_finder, default_domain, populate_initial_workspace, default_hooks)
+        self._term_cache = term_cache
+        self._owns_term_cache = term_cache is None
+        self._bundle_dir = bundle_dir
+
+    @property
+    def term_cache(self):
+        """The TermCache of the computed terms, created on first use."""
+        if self._term_cache is None:
+            self._term_cache = TermCache(get_cache_dir(), fingerprint=self._fingerprint())
+        return self._term_cache
+
+    def _fingerprint(self):
+        bundle_dir = self._bundle_dir if self._bundle_dir is not None else get_data_dir()
+        return bundle_fingerprint(bundle_dir)
+
+    def _refresh_fingerprint(self):
+        """Fingerprint the bundle again, so that a long-lived engine does not read the terms of a previous ingest."""
+        if self._owns_term_cache and self._term_cache is not None:
+            self._term_cache.fingerprint = self._fingerprint()
 
     def _compute_root_mask(self, domain, start_date, end_date, extra_rows):
 
@@ -65,12 +98,14 @@ class BundlePipelineEngine(SimplePipelineEngine):
                 Returns:
                     pd.DataFrame: Boolean mask of valid assets for each date.
                 """
-        root_mask_filename = "root-%s_%s_%s_%s_%d.pkl" % (
+        root_mask_filename = "root-%s_%s_%s_%s_%d_%s.pkl" % (
             start_date.strftime("%Y-%m-%d"),
             end_date.strftime("%Y-%m-%d"),
             domain.calendar_name,
             domain.country_code,
-            extra_rows
+            extra_rows,
+            # the assets lifetimes change with each ingest
+            self.term_cache.fingerprint[:16]
         )
 
         root_mask_filepath = get_cache_dir() + '/' + root_mask_filename
@@ -100,6 +135,8 @@ class BundlePipelineEngine(SimplePipelineEngine):
         if end_date is None:
             end_date = start_date
 
+        self._refresh_fingerprint()
+
         if hooks is None:
             hooks = [ProgressHooks.with_static_publisher(CliProgressPublisher())]
 
@@ -149,6 +186,7 @@ class BundlePipelineEngine(SimplePipelineEngine):
         --------
         :meth:`zipline.pipeline.engine.PipelineEngine.run_pipeline`
         """
+        self._refresh_fingerprint()
         domain = self.resolve_domain(pipeline)
         ranges = compute_date_range_chunks(
             domain.sessions(),
@@ -227,33 +265,32 @@ class BundlePipelineEngine(SimplePipelineEngine):
         """
         self._validate_compute_chunk_params(graph, dates, sids, workspace)
 
+        # Copy the supplied initial workspace so we don't mutate it in place.
+        workspace = workspace.copy()
+
+        # Check if the terms are in the cache (addition to super class)
+        term_cache = self.term_cache
+        cache_keys = {name: term_cache.key(term, graph.domain, dates, sids) for name, term in graph.outputs.items()}
         cached_out = {}
         for name, term in graph.outputs.items():
-            # Check if a term is in the cache (addition to super class)
-            term_filename = create_term_filename(dates, graph, term)
-            term_filepath = get_cache_dir() + '/' + term_filename
-            if exists(term_filepath):
-                term_data = np.load(term_filepath, allow_pickle=True, fix_imports=True)
-                log.info("load " + term_filename + " from cache")
-                if isinstance(term, CustomClassifier):
-                    label_array = LabelArray(term_data, term.missing_value, categories=term.categories)
-                    cached_out[name] = label_array
-                    workspace[term] = label_array
-                elif isinstance(term, AdjustedArray):
-                    adjusted_array = AdjustedArray(term_data, term.adjustments, term.missing_value)
-                    cached_out[name] = adjusted_array
-                    workspace[term] = adjusted_array
-                else:
-                    cached_out[name] = term_data
-                    workspace[term] = term_data
+            key = cache_keys[name]
+            term_data = term_cache.get(key) if key is not None else None
+            if term_data is None:
+                continue
+            log.info("load %s from cache" % name)
+            if term.dtype == object_dtype:
+                term_data = LabelArray(term_data, term.missing_value, categories=getattr(term, 'categories', None))
+            cached_out[name] = term_data
+            # a term that is also the input of a windowed term needs its extra rows
+            if graph.extra_rows[term] == 0:
+                workspace[term] = term_data
 
         if len(cached_out) == len(graph.outputs):
+            term_cache.flush()
             return cached_out
 
         get_loader = self._get_loader
 
-        # Copy the supplied initial workspace so we don't mutate it in place.
-        workspace = workspace.copy()
         domain = graph.domain
 
         # Many loaders can fetch data more efficiently if we ask them to
@@ -360,64 +397,29 @@ class BundlePipelineEngine(SimplePipelineEngine):
             out[name] = term_values
 
             # Save all terms to cache (addition to super class)
-            term_filename = create_term_filename(dates, graph, term)
-            term_filepath = get_cache_dir() + '/' + term_filename
-            if not exists(term_filepath):
-                log.info("save " + term_filename + " to cache")
+            key = cache_keys[name]
+            if key is not None and name not in cached_out:
+                log.info("save %s to cache" % name)
                 if isinstance(term_values, LabelArray):
-                    np.save(term_filepath, term_values.as_string_array(), allow_pickle=True, fix_imports=True)
+                    term_cache.put(key, term_values.as_string_array(), name)
                 elif isinstance(term_values, AdjustedArray):
-                    np.save(term_filepath, term_values.data, allow_pickle=True, fix_imports=True)
+                    term_cache.put(key, term_values.data, name)
                 elif type(term_values) == np.ndarray:
-                    np.save(term_filepath, term_values, allow_pickle=True, fix_imports=True)
+                    term_cache.put(key, term_values, name)
                 else:
                     log.warn("Cannot save unknown type: %s" % str(type(term_values)))
 
+        term_cache.flush()
+        stats = term_cache.stats()
+        log.info("Pipeline cache: %d hits, %d misses, %d entries, %.1f MB" %
+                 (stats['hits'], stats['misses'], stats['entries'], stats['bytes'] / 1024 ** 2))
         return out
 
 
-def create_term_filename(dates, graph, term):
-    """Create a cache filename for a pipeline term.
-    
-        Args:
-            dates: DatetimeIndex of the computation dates.
-            graph: The pipeline execution graph.
-            term: The pipeline term to create a filename for.
-    
-        Returns:
-            str: A filename string for the cached term data.
-        """
-    return "term-%s_%s_%s_%s.npy" % (
-        dates[0].strftime("%Y-%m-%d"),
-        dates[-1].strftime("%Y-%m-%d"),
-        graph.screen_name,
-        find_term_name(graph, term)
-    )
-
-
-def find_term_name(graph: TermGraph, term: Term):
-    """Find the output name of a term in the execution graph.
-    
-        Args:
-            graph: The pipeline TermGraph containing output mappings.
-            term: The Term to look up.
-    
-        Returns:
-            str: The name associated with the term in the graph outputs.
-    
-        Raises:
-            ValueError: If the term is not found in the graph outputs.
-        """
-    for term_name, term_value in graph.outputs.items():
-        if term_value == term:
-            return term_name
-    raise ValueError("Term not in graph")
-
-
 class BundleLoader:
     """Mixin providing lazy-loaded access to the asset finder and bar reader.
     
-        Caches the SQLiteAssetFinder and SQLiteDailyBarReader instances after
+        Caches the SQLiteAssetFinder and daily bar reader instances after
         first access to avoid repeated initialization.
         """
     
@@ -447,6 +449,20 @@ class BundleLoader:
         return self._bar_reader
 
 
+def bundle_path(bundle_name, timestr, environ=None):
+    """Construct the filesystem path to the directory of a bundle version.
+    
+        Args:
+            bundle_name: Name of the data bundle.
+            timestr: Timestamp directory string for the bundle version.
+            environ: Optional environment dict for path resolution.
+    
+        Returns:
+            str: Absolute path to the bundle directory.
+        """
+    return pth.data_path((bundle_name, timestr), environ=environ)
+
+
 def daily_equity_path(bundle_name, timestr, environ=None):
     """Construct the filesystem path to the daily equity SQLite database.
     
@@ -464,26 +480,175 @@ def daily_equity_path(bundle_name, timestr, environ=None):
     )
 
 
+def daily_equity_mmap_path(bundle_name, timestr, environ=None):
+    """Construct the filesystem path to the columnar daily equity store.
+    
+        Args:
+            bundle_name: Name of the data bundle.
+            timestr: Timestamp directory string for the bundle version.
+            environ: Optional environment dict for path resolution.
+    
+        Returns:
+            str: Absolute path to the prices.mmap directory.
+        """
+    return pth.data_path(
+        (bundle_name, timestr, 'prices.mmap'),
+        environ=environ,
+    )
+
+
+def daily_equity_shards_path(bundle_name, timestr, environ=None):
+    """Construct the filesystem path to the per-year price shards.
+    
+        Args:
+            bundle_name: Name of the data bundle.
+            timestr: Timestamp directory string for the bundle version.
+            environ: Optional environment dict for path resolution.
+    
+        Returns:
+            str: Absolute path to the prices.shards directory.
+        """
+    return pth.data_path(
+        (bundle_name, timestr, SHARDS_DIRNAME),
+        environ=environ,
+    )
+
+
+def primary_daily_equity_path(bundle_name, timestr, environ=None):
+    """Path of the primary price store of a bundle, the one written by every ingest.
+    
+        The per-year price shards once the prices have been sharded, otherwise
+        the SQLite prices database. The columnar store is derived from it.
+    
+        Args:
+            bundle_name: Name of the data bundle.
+            timestr: Timestamp directory string for the bundle version.
+            environ: Optional environment dict for path resolution.
+    
+        Returns:
+            str: Path of the prices.shards directory or of the prices.sqlite file.
+        """
+    shards_path = daily_equity_shards_path(bundle_name, timestr, environ=environ)
+    if len(shard_years(shards_path)) > 0:
+        return shards_path
+    return daily_equity_path(bundle_name, timestr, environ=environ)
+
+
+def daily_bar_reader(bundle_name, timestr, environ=None):
+    """Create the daily bar reader for a bundle.
+    
+        The reader of the primary price store (see primary_daily_equity_path),
+        with float64 prices: it is the one of the DataPortal, the columnar
+        store is only used by the pipeline, see pipeline_bar_reader.
+        This is the only place that picks the price reader of a bundle.
+    
+        Args:
+            bundle_name: Name of the data bundle.
+            timestr: Timestamp directory string for the bundle version.
+            environ: Optional environment dict for path resolution.
+    
+        Returns:
+            ShardedDailyBarReader or SQLiteDailyBarReader.
+        """
+    path = primary_daily_equity_path(bundle_name, timestr, environ=environ)
+    return ShardedDailyBarReader(path) if os.path.isdir(path) else SQLiteDailyBarReader(path)
+
+
+def pipeline_bar_reader(bar_reader, bundle_name, timestr, environ=None):
+    """The reader of the prices loaded by the pipeline (load_raw_arrays).
+    
+        The columnar memory-mapped store is used if it has been built during
+        ingest and its last session is the one of bar_reader, otherwise
+        bar_reader: an ingest without columnar prices leaves the columnar
+        store behind. The columnar store holds float32 prices, it is not used
+        for the prices of the DataPortal (fills, data.current).
+    
+        Args:
+            bar_reader: Daily bar reader of the bundle, see daily_bar_reader.
+            bundle_name: Name of the data bundle.
+            timestr: Timestamp directory string for the bundle version.
+            environ: Optional environment dict for path resolution.
+    
+        Returns:
+            MMapDailyBarReader or bar_reader.
+        """
+    mmap_path = daily_equity_mmap_path(bundle_name, timestr, environ=environ)
+    if exists(os.path.join(mmap_path, 'properties.json')):
+        mmap_reader = MMapDailyBarReader(mmap_path)
+        if mmap_reader.last_session == bar_reader.last_available_dt:
+            return mmap_reader
+        log.warn("The columnar prices of %s end on %s, the prices on %s: the columnar prices are not used." %
+                 (mmap_path, mmap_reader.last_session, bar_reader.last_available_dt))
+    return bar_reader
+
+
+# Number of in-memory copies of the bundle kept by load_sharadar_bundle
+IN_MEMORY_BUNDLES_CACHE_SIZE = 1
+
+# in-memory copies of the bundle, by name, timestr, fingerprint, start, end and sids, least recently used first
+_in_memory_bundles = OrderedDict()
+
+
 # @cached
-def load_sharadar_bundle(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, environ=os.environ):
+def load_sharadar_bundle(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, environ=os.environ,
+                         in_memory=False, start=None, end=None, sids=None):
     """Load the Sharadar data bundle as a BundleData instance.
     
+        With in_memory=True the prices, assets and adjustments databases are
+        copied into memory on the first call, and the following calls with the
+        same arguments return readers of the same copy until the bundle is
+        ingested again. The copy is bounded to the prices between start and
+        end, and to the sids if given. At most IN_MEMORY_BUNDLES_CACHE_SIZE
+        copies are kept, the copies of an older ingest are freed first.
+    
         Args:
             name: Bundle name. Defaults to SHARADAR_BUNDLE_NAME.
             timestr: Bundle directory timestamp. Defaults to SHARADAR_BUNDLE_DIR.
             environ: Environment dict for path resolution. Defaults to os.environ.
+            in_memory: If True, read the bundle from an InMemoryBundle.
+            start: First date of the prices copied in memory, None for all.
+            end: Last date of the prices copied in memory, None for all.
+            sids: Security identifiers copied in memory, None for all.
     
         Returns:
             BundleData: Object containing asset finder, bar reader, and adjustment reader.
         """
+    if in_memory:
+        fingerprint = bundle_fingerprint(bundle_path(name, timestr, environ=environ))
+        key = (name, timestr, fingerprint, start, end,
+               None if sids is None else tuple(sorted(int(x) for x in sids)))
+        bundle = _in_memory_bundles.get(key)
+        if bundle is not None:
+            _in_memory_bundles.move_to_end(key)
+            return bundle.bundle_data()
+
+        # the copies of an older ingest are superseded, the others are freed in LRU order
+        for other in [k for k in _in_memory_bundles if k[:2] == (name, timestr) and k[2] != fingerprint]:
+            _in_memory_bundles.pop(other).close()
+        while _in_memory_bundles and len(_in_memory_bundles) >= IN_MEMORY_BUNDLES_CACHE_SIZE:
+            _, evicted = _in_memory_bundles.popitem(last=False)
+            evicted.close()
+        bundle = _in_memory_bundles[key] = InMemoryBundle(primary_daily_equity_path(name, timestr, environ=environ),
+                                                          asset_db_path(name, timestr, environ=environ),
+                                                          adjustment_db_path(name, timestr, environ=environ),
+                                                          start=start, end=end, sids=sids)
+        return bundle.bundle_data()
+
     return BundleData(
         asset_finder=SQLiteAssetFinder(asset_db_path(name, timestr, environ=environ), ),
         equity_minute_bar_reader=None,
-        equity_daily_bar_reader=SQLiteDailyBarReader(daily_equity_path(name, timestr, environ=environ), ),
+        equity_daily_bar_reader=daily_bar_reader(name, timestr, environ=environ),
         adjustment_reader=SQLiteAdjustmentReader(adjustment_db_path(name, timestr, environ=environ), ),
     )
 
 
+def close_in_memory_bundles():
+    """Free the in-memory copies of the bundle made by load_sharadar_bundle(in_memory=True)."""
+    while _in_memory_bundles:
+        _, bundle = _in_memory_bundles.popitem()
+        bundle.close()
+
+
 # @cached
 def _asset_finder(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, environ=os.environ):
     """Create a SQLiteAssetFinder for the Sharadar bundle.
@@ -501,7 +666,7 @@ def _asset_finder(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, enviro
 
 # @cached
 def _bar_reader(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, environ=os.environ):
-    """Create a SQLiteDailyBarReader for the Sharadar bundle.
+    """Create the daily bar reader for the Sharadar bundle.
     
         Args:
             name: Bundle name. Defaults to SHARADAR_BUNDLE_NAME.
@@ -509,9 +674,34 @@ def _bar_reader(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, environ=
             environ: Environment dict for path resolution. Defaults to os.environ.
     
         Returns:
-            SQLiteDailyBarReader: Daily bar reader connected to the bundle database.
+            ShardedDailyBarReader or SQLiteDailyBarReader: Daily bar reader for the bundle.
         """
-    return SQLiteDailyBarReader(daily_equity_path(name, timestr, environ=environ))
+    return daily_bar_reader(name, timestr, environ=environ)
+
+
+# AdjustmentFactorReader of each adjustments database, shared by prices, history and returns
+_adjustment_factor_readers = {}
+
+
+def _adjustment_factor_reader(name=SHARADAR_BUNDLE_NAME, timestr=SHARADAR_BUNDLE_DIR, environ=os.environ):
+    """The AdjustmentFactorReader for the Sharadar bundle.
+    
+        The reader, with its connection pool, is created once per adjustments
+        database and then shared.
+    
+        Args:
+            name: Bundle name. Defaults to SHARADAR_BUNDLE_NAME.
+            timestr: Bundle directory timestamp. Defaults to SHARADAR_BUNDLE_DIR.
+            environ: Environment dict for path resolution. Defaults to os.environ.
+    
+        Returns:
+            AdjustmentFactorReader: Reader of the adjustment factors written at ingest.
+        """
+    path = adjustment_db_path(name, timestr, environ=environ)
+    reader = _adjustment_factor_readers.get(path)
+    if reader is None:
+        reader = _adjustment_factor_readers.setdefault(path, AdjustmentFactorReader(path))
+    return reader
 
 
 # @cached
@@ -597,11 +787,15 @@ def sids(sids):
     return _asset_finder().retrieve_all(sids)
 
 
-def make_pipeline_engine(bundle=None, start=None, end=None, live=False):
+def make_pipeline_engine(bundle=None, start=None, end=None, live=False, name=SHARADAR_BUNDLE_NAME,
+                         timestr=SHARADAR_BUNDLE_DIR, environ=os.environ):
     """Creates a pipeline engine for the dates in (start, end).
-    Using this allows usage very similar to run_pipeline in Quantopian's env."""
+    Using this allows usage very similar to run_pipeline in Quantopian's env.
+
+    The terms cached by the engine are keyed on the fingerprint of the bundle
+    name/timestr, which must be the one the readers of bundle read."""
     if bundle is None:
-        bundle = load_sharadar_bundle()
+        bundle = load_sharadar_bundle(name, timestr, environ=environ)
 
     if start is None:
         start = bundle.equity_daily_bar_reader.first_trading_day
@@ -610,15 +804,24 @@ def make_pipeline_engine(bundle=None, start=None, end=None, live=False):
         end = pd.Timestamp.today()
 
     # pipeline_loader = USEquityPricingLoader(bundle.equity_daily_bar_reader, bundle.adjustment_reader, SimpleFXRateReader())
-    pipeline_loader = USEquityPricingLoader.without_fx(bundle.equity_daily_bar_reader, bundle.adjustment_reader)
+    pipeline_loader = USEquityPricingLoader.without_fx(pipeline_bar_reader(bundle.equity_daily_bar_reader, name,
+                                                                           timestr, environ=environ),
+                                                       bundle.adjustment_reader)
+    daily_metrics_loader = DailyMetricsLoader(bundle.asset_finder)
+    equity_metadata_loader = EquityMetadataLoader(bundle.asset_finder)
 
     def choose_loader(column):
         if column in USEquityPricing.columns:
             return pipeline_loader
+        if column in SharadarDailyMetrics.columns:
+            return daily_metrics_loader
+        if column in SharadarEquityMetadata.columns:
+            return equity_metadata_loader
         raise ValueError("No PipelineLoader registered for column %s." % column)
 
     bundle.asset_finder.is_live_trading = live
-    spe = BundlePipelineEngine(get_loader=choose_loader, asset_finder=bundle.asset_finder)
+    spe = BundlePipelineEngine(get_loader=choose_loader, asset_finder=bundle.asset_finder,
+                               bundle_dir=bundle_path(name, timestr, environ=environ))
     return spe
 
 
@@ -655,6 +858,10 @@ def to_sids(assets):
 def prices(assets, start, end, field='close', offset=0):
     """
     Get price data for assets between start and end.
+
+    The OHLCV fields are the raw prices multiplied by the adjustment factors
+    written at ingest. Bundles ingested without them, and the 'price' field,
+    go through the history window of a DataPortal.
     """
     start = trading_date(start)
     end = trading_date(end)
@@ -665,6 +872,14 @@ def prices(assets, start, end, field='close', offset=0):
     if offset > 0:
         start = trading_calendar.sessions_window(start, -offset)[0]
 
+    factor_reader = _adjustment_factor_reader()
+    if field in ADJUSTED_FIELDS and factor_reader.has_factors:
+        sessions = trading_calendar.sessions_in_range(start, end)
+        data = factor_reader.load_adjusted_arrays(bundle.equity_daily_bar_reader, [field], start, end,
+                                                  to_sids(assets))[0]
+        df = pd.DataFrame(data, index=sessions, columns=assets)
+        return df if len(assets) > 1 else df.squeeze()
+
     bar_count = trading_calendar.sessions_distance(start, end)
 
     data_portal = DataPortal(bundle.asset_finder,
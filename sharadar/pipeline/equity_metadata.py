@@ -0,0 +1,84 @@
+"""Pipeline DataSet and loader for the categorical metadata of the equities.
+
+The exchange, sector and category of an equity are stored in the
+equity_supplementary_mappings table of the asset database, and change a few
+times in its life. EquityMetadataLoader reads the history of each requested
+field once per pipeline chunk, as intervals of codes, and expands it to the
+LabelArray of all the sessions of the chunk in one pass, so the classifiers
+do not query the database every pipeline day.
+"""
+import numpy as np
+import pandas as pd
+from zipline.lib.adjusted_array import AdjustedArray
+from zipline.pipeline.data import Column, DataSet
+from zipline.pipeline.domain import US_EQUITIES
+from zipline.pipeline.loaders.base import PipelineLoader
+from zipline.utils.numpy_utils import int64_dtype, object_dtype
+
+EXCHANGES = ('BATS', 'INDEX', 'NASDAQ', 'NYSE', 'NYSEARCA', 'NYSEMKT', 'OTC')
+
+SECTORS = ('Basic Materials', 'Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy',
+           'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities')
+
+# The 5th letter of a symbol flagging the equity, see symbol_flags
+SYMBOL_FLAG_LETTERS = {'is_bankruptcy': 'Q', 'is_delinquent': 'E'}
+
+
+class SharadarEquityMetadata(DataSet):
+    """
+    :class:`~zipline.pipeline.data.DataSet` containing the categorical metadata of the equities.
+
+    The categories of a column are in its metadata, the other values are 'NA'.
+    is_bankruptcy and is_delinquent are 1 if the symbol of the equity flags it, 0 otherwise.
+    """
+    domain = US_EQUITIES
+
+    exchange = Column(object_dtype, missing_value='NA', metadata={'categories': EXCHANGES})
+    sector = Column(object_dtype, missing_value='NA', metadata={'categories': SECTORS})
+    category = Column(object_dtype, missing_value='NA')
+    is_bankruptcy = Column(int64_dtype, missing_value=-1)
+    is_delinquent = Column(int64_dtype, missing_value=-1)
+
+
+def symbol_flags(symbols, letter):
+    """1 for the symbols of 5 letters ending with letter, 0 otherwise.
+
+    Args:
+        symbols: Symbols of the equities.
+        letter: The 5th letter, e.g. 'Q' for bankruptcy.
+
+    Returns:
+        numpy.ndarray: int64 flags.
+    """
+    symbols = pd.Series(list(symbols), dtype=object).fillna('')
+    return ((symbols.str.len() == 5) & symbols.str.endswith(letter)).values.astype(np.int64)
+
+
+class EquityMetadataLoader(PipelineLoader):
+    """PipelineLoader for SharadarEquityMetadata.
+
+    The value of a session is the latest one as of the session, as in
+    SQLiteAssetFinder.get_info. The flags of the symbols use the current
+    symbol of the equities, as Equity.symbol.
+
+    Attributes:
+        _asset_finder: SQLiteAssetFinder of the bundle.
+    """
+    def __init__(self, asset_finder):
+        self._asset_finder = asset_finder
+
+    def load_adjusted_array(self, domain, columns, dates, sids, mask):
+        out = {}
+        symbols = None
+        for c in columns:
+            if c.name in SYMBOL_FLAG_LETTERS:
+                if symbols is None:
+                    symbols = [e.symbol for e in self._asset_finder.retrieve_all(sids)]
+                flags = symbol_flags(symbols, SYMBOL_FLAG_LETTERS[c.name])
+                data = np.tile(flags, (len(dates), 1))
+            else:
+                intervals = self._asset_finder.get_info_intervals(sids, c.name, c.metadata.get('categories'),
+                                                                  c.missing_value)
+                data = intervals.label_array(dates)
+            out[c] = AdjustedArray(data, adjustments={}, missing_value=c.missing_value)
+        return out
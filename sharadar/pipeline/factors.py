@@ -9,6 +9,8 @@ trends, market beta, and various financial ratios.
 import numpy as np
 import pandas as pd
 from sharadar.pipeline.engine import BundleLoader, symbol
+from sharadar.pipeline.daily_metrics import SharadarDailyMetrics
+from sharadar.pipeline.equity_metadata import SharadarEquityMetadata, EXCHANGES, SECTORS
 from sharadar.util.numpy_invalid_values_util import nandivide, nanlog, nansubtract, nanmean, nanvar, nanstd
 from zipline.lib.labelarray import LabelArray
 from zipline.pipeline.classifiers import CustomClassifier
@@ -17,7 +19,6 @@ from zipline.pipeline.factors import CustomFactor, DailyReturns
 from zipline.utils.numpy_utils import object_dtype
 from zipline.pipeline.factors import AverageDollarVolume
 from sharadar.pipeline.engine import returns
-from sharadar.util.logger import log
 
 
 
@@ -80,7 +81,9 @@ class AbstractClassifier(CustomClassifier, BundleLoader):
     """Base class for categorical classifiers using Sharadar metadata.
 
     Subclasses specify categories and a metadata field to classify assets into
-    discrete categorical buckets.
+    discrete categorical buckets. A subclass with a SharadarEquityMetadata
+    column as input reads the values loaded for the whole pipeline chunk,
+    otherwise the values are queried every day with get_info.
     """
 
     inputs = []
@@ -96,6 +99,10 @@ class AbstractClassifier(CustomClassifier, BundleLoader):
         return LabelArray(np.full(shape, self.missing_value), self.missing_value, categories=self.categories)
 
     def compute(self, today, assets, out, *arrays):
+        if len(arrays) > 0:
+            # the values of today, in the LabelArray of the chunk
+            out[:] = arrays[0][-1]
+            return
         data = self.asset_finder().get_info(assets, self.field, today)
         out[:] = LabelArray(data, self.missing_value, categories=self.categories)
 
@@ -103,8 +110,10 @@ class AbstractClassifier(CustomClassifier, BundleLoader):
 class Exchange(AbstractClassifier):
     """Classifies assets by their listing stock exchange."""
 
+    inputs = [SharadarEquityMetadata.exchange]
+
     def __init__(self):
-        categories = ['BATS', 'INDEX', 'NASDAQ', 'NYSE', 'NYSEARCA', 'NYSEMKT', 'OTC']
+        categories = list(EXCHANGES)
         field = 'exchange'
         super().__init__(categories, field)
 
@@ -112,169 +121,146 @@ class Exchange(AbstractClassifier):
 class Sector(AbstractClassifier):
     """Classifies assets by their market sector."""
 
+    inputs = [SharadarEquityMetadata.sector]
+
     def __init__(self):
-        categories = ['Basic Materials', 'Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy',
-                      'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities']
+        categories = list(SECTORS)
         field = 'sector'
         super().__init__(categories, field)
 
 
-class IsDomesticCommonStock(CustomClassifier, BundleLoader):
+class IsDomesticCommonStock(CustomClassifier):
     """Filter that returns 1 for domestic common and preferred stocks, 0 otherwise."""
 
-    inputs = []
+    inputs = [SharadarEquityMetadata.category]
     window_length = 1
     dtype = np.int64
     missing_value = 0
 
-    def compute(self, today, assets, out, *arrays):
-        category = self.asset_finder().get_info(assets, 'category', today)
-        out[:] = np.isin(category, ['Domestic Common Stock', 'Domestic Common Stock Primary Class',
-                                    'Domestic Common Stock Secondary Class', 'Domestic Preferred Stock'])
+    def compute(self, today, assets, out, category):
+        out[:] = category[-1].element_of(['Domestic Common Stock', 'Domestic Common Stock Primary Class',
+                                          'Domestic Common Stock Secondary Class', 'Domestic Preferred Stock'])
 
 
-class IsBankruptcy(CustomClassifier, BundleLoader):
+class IsBankruptcy(CustomClassifier):
     """
     The 5th letter "Q" stand for bankruptcy.
     The NASDAQ phased out the usage of Q as of 2016, but other markets may still use "Q" for this purpose.
     """
-    inputs = []
+    inputs = [SharadarEquityMetadata.is_bankruptcy]
     window_length = 1
     dtype = np.int64
     missing_value = -1
 
-    def compute(self, today, assets, out, *arrays):
-        equities = self.asset_finder().retrieve_all(assets)
-        out[:] = [((len(e.symbol) == 5) & e.symbol.endswith('Q')) for e in equities]
+    def compute(self, today, assets, out, is_bankruptcy):
+        out[:] = is_bankruptcy[-1]
 
 
-class IsDelinquent(CustomClassifier, BundleLoader):
+class IsDelinquent(CustomClassifier):
     """
     The 5th letter "E" stand for delinquent in regard to SEC filings.
     The NASDAQ phased out the usage of E as of 2016, but other markets may still use "E" for this purpose.
     """
-    inputs = []
+    inputs = [SharadarEquityMetadata.is_delinquent]
     window_length = 1
     dtype = np.int64
     missing_value = -1
 
-    def compute(self, today, assets, out, *arrays):
-        equities = self.asset_finder().retrieve_all(assets)
-        out[:] = [((len(e.symbol) == 5) & e.symbol.endswith('E')) for e in equities]
-
+    def compute(self, today, assets, out, is_delinquent):
+        out[:] = is_delinquent[-1]
 
-def get_daily_metrics(asset_finder, assets, field, today, n, mult=1):
-    """Fetches daily metric data with fallback to previous day if all NaN.
-
-    Args:
-        asset_finder: AssetFinder instance for data retrieval.
-        assets: Array of asset sids.
-        field: Name of the daily metric field.
-        today: Current trading date.
-        n: Number of rows (window length) to retrieve.
-        mult: Multiplier applied to raw values (default 1).
-
-    Returns:
-        numpy array of metric values for the requested assets.
-    """
-    metric = mult * asset_finder.get_daily_metrics(assets, field, today, n)
-    if np.isnan(metric).all():
-        # If all NaN (not ingested because delay in computation in SEP) then use the data of the previous day
-        log.warn("No data for %s on %s. Use data from previous day." % (field, today.date()))
-        metric = mult * asset_finder.get_daily_metrics(assets, field, today, n + 1)[0, :]
-    return metric
 
-class MarketCap(CustomFactor, BundleLoader):
+class MarketCap(CustomFactor):
     """Market capitalization in dollars (values stored in millions, scaled to full)."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.marketcap]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = get_daily_metrics(self.asset_finder(), assets, 'marketcap', today, self.window_length, 1e6)
+    def compute(self, today, assets, out, marketcap):
+        out[:] = 1e6 * marketcap[-1]
 
     def __str__(self):
         return "MarketCap(%d)" % self.window_length
 
-class EV(CustomFactor, BundleLoader):
+class EV(CustomFactor):
     """Enterprise value in dollars (values stored in millions, scaled to full)."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.ev]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = out[:] = get_daily_metrics(self.asset_finder(), assets, 'ev', today, self.window_length, 1e6)
+    def compute(self, today, assets, out, ev):
+        out[:] = 1e6 * ev[-1]
 
     def __str__(self):
         return "EV(%d)" % self.window_length
 
-class EvEbit(CustomFactor, BundleLoader):
+class EvEbit(CustomFactor):
     """Enterprise value to EBIT ratio."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.evebit]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = get_daily_metrics(self.asset_finder(), assets, 'evebit', today, self.window_length)
+    def compute(self, today, assets, out, evebit):
+        out[:] = evebit[-1]
 
     def __str__(self):
         return "EvEbit(%d)" % self.window_length
 
 
-class EvEbitda(CustomFactor, BundleLoader):
+class EvEbitda(CustomFactor):
     """Enterprise value to EBITDA ratio."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.evebitda]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = get_daily_metrics(self.asset_finder(), assets, 'evebitda', today, self.window_length)
+    def compute(self, today, assets, out, evebitda):
+        out[:] = evebitda[-1]
 
     def __str__(self):
         return "EvEbitda(%d)" % self.window_length
 
 
-class PriceBook(CustomFactor, BundleLoader):
+class PriceBook(CustomFactor):
     """Price-to-book ratio."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.pb]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = get_daily_metrics(self.asset_finder(), assets, 'pb', today, self.window_length)
+    def compute(self, today, assets, out, pb):
+        out[:] = pb[-1]
 
     def __str__(self):
         return "PriceBook(%d)" % self.window_length
 
 
-class PriceEarnings(CustomFactor, BundleLoader):
+class PriceEarnings(CustomFactor):
     """Price-to-earnings ratio."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.pe]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = get_daily_metrics(self.asset_finder(), assets, 'pe', today, self.window_length)
+    def compute(self, today, assets, out, pe):
+        out[:] = pe[-1]
 
     def __str__(self):
         return "PriceEarnings(%d)" % self.window_length
 
 
-class PriceSales(CustomFactor, BundleLoader):
+class PriceSales(CustomFactor):
     """Price-to-sales ratio."""
 
-    inputs = []
+    inputs = [SharadarDailyMetrics.ps]
     window_length = 1
     window_safe = True
 
-    def compute(self, today, assets, out):
-        out[:] = get_daily_metrics(self.asset_finder(), assets, 'ps', today, self.window_length)
+    def compute(self, today, assets, out, ps):
+        out[:] = ps[-1]
 
     def __str__(self):
         return "PriceSales(%d)" % self.window_length
@@ -0,0 +1,365 @@
+"""Content-addressed cache of the pipeline terms computed by BundlePipelineEngine.
+
+The key of a cached term is a hash of its definition (class, source code,
+parameters, window length and inputs, recursively), the domain, the dates,
+the sids and a fingerprint of the bundle data. Changing a factor or
+re-ingesting the bundle therefore never returns stale values.
+
+The cache directory is bounded in size: the least recently used entries are
+evicted. The entries, their size and their last use are stored in an index
+file, together with the hit/miss statistics. The lookups are saved in the
+index once per flush, merged with the index on disk under a lock file, so
+that the processes sharing the cache directory keep each other's entries.
+"""
+import fcntl
+import hashlib
+import inspect
+import json
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import zipline
+from zipline.pipeline.term import Term
+
+from sharadar.util.logger import log
+
+INDEX_FILENAME = 'term-index.json'
+LOCK_FILENAME = 'term-index.lock'
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# files of the bundle directory that are not bundle data
+_NOT_BUNDLE_DATA = {'cache', 'ingest_checkpoints'}
+
+# the attributes of a term that define it, the other ones are state (e.g. the readers of a BundleLoader)
+IDENTITY_ATTRIBUTES = ('params', 'inputs', 'outputs', 'window_length', 'mask', 'domain', 'dtype', 'missing_value')
+
+
+class UncacheableTerm(Exception):
+    """The definition of a term has no stable representation (e.g. an object without a repr)."""
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+_class_digests = {}
+
+
+def _class_digest(cls):
+    """Digest of the source code of a term class and of its non zipline base classes."""
+    digest = _class_digests.get(cls)
+    if digest is None:
+        parts = []
+        for klass in cls.__mro__:
+            if klass.__module__.startswith(('zipline.', 'builtins')):
+                continue
+            try:
+                parts.append(inspect.getsource(klass))
+            except (OSError, TypeError):
+                parts.append(klass.__module__ + '.' + klass.__qualname__)
+        digest = _class_digests[cls] = _sha256('\n'.join(parts))
+    return digest
+
+
+def _describe(value, memo):
+    if isinstance(value, Term):
+        return term_digest(value, memo)
+    if isinstance(value, (tuple, list)):
+        return '(%s)' % ','.join(_describe(v, memo) for v in value)
+    if isinstance(value, dict):
+        return '{%s}' % ','.join('%r:%s' % (k, _describe(value[k], memo)) for k in sorted(value, key=repr))
+    if isinstance(value, np.ndarray):
+        return 'array(%s,%s,%s)' % (value.dtype, value.shape, hashlib.sha256(value.tobytes()).hexdigest())
+    if inspect.isfunction(value) or inspect.isbuiltin(value):
+        # e.g. the transform of zscore or demean
+        return value.__module__ + '.' + value.__qualname__
+    text = repr(value)
+    if ' at 0x' in text:
+        raise UncacheableTerm(text)
+    return text
+
+
+def _identity_names(term):
+    """Names of the attributes of a term that are part of its digest.
+
+    The declared identity, plus the private attributes set by the constructors
+    of the zipline terms (e.g. the method of a Rank or the expression of a
+    NumExprFilter). The private attributes of the other classes are skipped:
+    they are set at compute time, as the readers of a BundleLoader.
+    """
+    state = vars(term)
+    names = [name for name in IDENTITY_ATTRIBUTES if name in state]
+    if type(term).__module__.startswith('zipline.'):
+        names += [name for name in state if name.startswith('_') and not name.startswith('__')]
+    return sorted(names)
+
+
+def term_digest(term, memo=None):
+    """Stable hash of the definition of a term.
+
+    Only the identity of the term is hashed, see _identity_names, so the
+    digest does not change once the term has been computed.
+
+    Args:
+        term: zipline.pipeline.term.Term.
+        memo: Optional dict of the digests of the terms already described.
+
+    Returns:
+        str: Hex digest.
+
+    Raises:
+        UncacheableTerm: If the term has no stable representation.
+    """
+    if memo is None:
+        memo = {}
+    digest = memo.get(term)
+    if digest is None:
+        cls = type(term)
+        parts = [cls.__module__ + '.' + cls.__qualname__, _class_digest(cls)]
+        state = vars(term)
+        for name in _identity_names(term):
+            parts.append('%s=%s' % (name, _describe(state[name], memo)))
+        digest = memo[term] = _sha256('\n'.join(parts))
+    return digest
+
+
+def bundle_fingerprint(bundle_dir):
+    """Fingerprint of the data of a bundle, it changes with every ingest.
+
+    Args:
+        bundle_dir: Directory of the bundle (e.g. .../sharadar/latest).
+
+    Returns:
+        str: Hex digest of the names, sizes and modification times of the bundle files.
+    """
+    parts = []
+    if os.path.isdir(bundle_dir):
+        for name in sorted(os.listdir(bundle_dir)):
+            if name in _NOT_BUNDLE_DATA:
+                continue
+            path = os.path.join(bundle_dir, name)
+            if not os.path.isdir(path):
+                paths = [(name, path)]
+            elif os.path.exists(os.path.join(path, 'properties.json')):
+                # e.g. prices.mmap, the properties are rewritten by each write
+                paths = [(name, os.path.join(path, 'properties.json'))]
+            else:
+                # e.g. prices.shards, the shards and their manifests
+                paths = [(name + '/' + f, os.path.join(path, f)) for f in sorted(os.listdir(path))]
+            for label, filename in paths:
+                st = os.stat(filename)
+                parts.append('%s:%d:%d' % (label, st.st_size, st.st_mtime_ns))
+    return _sha256('\n'.join(parts))
+
+
+class TermCache(object):
+    """Size bounded LRU cache of computed pipeline terms, stored as .npy files.
+
+    Attributes:
+        directory: Cache directory.
+        fingerprint: Fingerprint of the bundle data, part of every key.
+        max_bytes: Maximum total size of the cached files.
+        hits: Number of lookups found in the cache.
+        misses: Number of lookups not found in the cache.
+    """
+    def __init__(self, directory, fingerprint='', max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, INDEX_FILENAME)
+        self._lock_path = os.path.join(directory, LOCK_FILENAME)
+        with self._locked():
+            self._entries, stats = self._load_index()
+        self.hits = stats.get('hits', 0)
+        self.misses = stats.get('misses', 0)
+        # the changes since the last flush
+        self._used = OrderedDict()
+        self._added = {}
+        self._removed = set()
+        self._new_hits = 0
+        self._new_misses = 0
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock of the index, across the processes sharing the cache directory."""
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path):
+            return OrderedDict(), {}
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except ValueError:
+            log.warn("Invalid pipeline cache index %s, the cache is reset." % self._index_path)
+            return OrderedDict(), {}
+        # the entries are stored from the least to the most recently used
+        return OrderedDict((e['key'], e) for e in index['entries']), index['stats']
+
+    def _save_index(self):
+        index = {'entries': list(self._entries.values()), 'stats': {'hits': self.hits, 'misses': self.misses}}
+        with open(self._index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self._index_path + '.tmp', self._index_path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'term-%s.npy' % key)
+
+    def key(self, term, domain, dates, sids):
+        """Key of the values of a term.
+
+        Args:
+            term: The pipeline Term.
+            domain: The pipeline domain.
+            dates: DatetimeIndex of the computed dates.
+            sids: Index of the computed sids.
+
+        Returns:
+            str: Hex digest, None if the term can not be cached.
+        """
+        try:
+            digest = term_digest(term)
+        except UncacheableTerm as e:
+            log.warn("Term %s is not cached: %s" % (term, e))
+            return None
+        dates = pd.DatetimeIndex(dates)
+        return _sha256('\n'.join([
+            digest,
+            repr(domain),
+            hashlib.sha256(dates.asi8.tobytes()).hexdigest(),
+            hashlib.sha256(np.asarray(sids, dtype=np.int64).tobytes()).hexdigest(),
+            self.fingerprint,
+            zipline.__version__,
+        ]))
+
+    def _touch(self, key):
+        self._entries.move_to_end(key)
+        self._used[key] = True
+        self._used.move_to_end(key)
+
+    def _forget(self, key):
+        """Drop an entry whose file is removed."""
+        self._entries.pop(key, None)
+        self._added.pop(key, None)
+        self._used.pop(key, None)
+        self._removed.add(key)
+
+    def get(self, key):
+        """The cached values of the key, None if missing."""
+        values = None
+        if key in self._entries:
+            try:
+                values = np.load(self._path(key), allow_pickle=True)
+            except OSError:
+                # evicted by another process
+                self._forget(key)
+        if values is None:
+            self.misses += 1
+            self._new_misses += 1
+            return None
+        self.hits += 1
+        self._new_hits += 1
+        self._touch(key)
+        return values
+
+    def put(self, key, values, name=''):
+        """Store the values of the key, evicting the least recently used entries if necessary.
+
+        Args:
+            key: Key of the values, see TermCache.key.
+            values: numpy.ndarray to store.
+            name: Optional description of the term, for the index.
+        """
+        path = self._path(key)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, values, allow_pickle=True)
+        os.replace(path + '.tmp', path)
+        self._entries[key] = self._added[key] = {'key': key, 'name': name, 'size': os.path.getsize(path)}
+        self._removed.discard(key)
+        self._touch(key)
+        self._evict()
+
+    def flush(self):
+        """Save the entries and the statistics of the lookups since the last flush in the index.
+
+        The index on disk is read again under the lock, so the entries and
+        the statistics saved by the other processes are kept, and the size
+        bound is applied to all the entries.
+        """
+        if not (self._used or self._added or self._removed or self._new_hits or self._new_misses):
+            return
+        with self._locked():
+            entries, stats = self._load_index()
+            for key in self._removed:
+                entries.pop(key, None)
+            entries.update(self._added)
+            for key in self._used:
+                if key in entries:
+                    entries.move_to_end(key)
+            self._entries = entries
+            self._evict()
+            self.hits = stats.get('hits', 0) + self._new_hits
+            self.misses = stats.get('misses', 0) + self._new_misses
+            self._save_index()
+        self._used.clear()
+        self._added.clear()
+        self._removed.clear()
+        self._new_hits = self._new_misses = 0
+
+    def _evict(self):
+        total = sum(e['size'] for e in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            total -= entry['size']
+            log.info("Evict %s (%s) from the pipeline cache" % (key, entry['name']))
+            self._forget(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def __contains__(self, key):
+        return key in self._entries and os.path.exists(self._path(key))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Hit/miss statistics and size of the cache.
+
+        Returns:
+            dict: hits, misses, hit_rate, entries and bytes.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else float('nan'),
+            'entries': len(self._entries),
+            'bytes': sum(e['size'] for e in self._entries.values()),
+        }
+
+    def clear(self):
+        """Remove all the entries and reset the statistics."""
+        with self._locked():
+            entries, _ = self._load_index()
+            for key in set(entries) | set(self._entries):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._used.clear()
+            self._added.clear()
+            self._removed.clear()
+            self.hits = self.misses = self._new_hits = self._new_misses = 0
+            self._save_index()
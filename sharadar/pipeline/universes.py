@@ -19,11 +19,10 @@ from contextlib import closing
 import numpy as np
 import pandas as pd
 from click import progressbar
-from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarReader
-from sharadar.pipeline.engine import make_pipeline_engine
+from sharadar.pipeline.engine import make_pipeline_engine, daily_bar_reader
 from sharadar.pipeline.factors import Exchange, Sector, IsDomesticCommonStock, MarketCap, Fundamentals, EV
 from sharadar.util.logger import log
-from sharadar.util.output_dir import get_data_dir
+from sharadar.util.output_dir import get_data_dir, SHARADAR_BUNDLE_NAME, SHARADAR_BUNDLE_DIR
 from zipline.pipeline import Pipeline, CustomFilter
 import os
 from zipline.pipeline.data import USEquityPricing
@@ -319,7 +318,7 @@ def update_universe(name, screen):
         screen: Pipeline filter defining universe membership.
     """
     universe_start = pd.Timestamp('1998-10-16')
-    universe_end = SQLiteDailyBarReader().last_available_dt
+    universe_end = daily_bar_reader(SHARADAR_BUNDLE_NAME, SHARADAR_BUNDLE_DIR).last_available_dt
     universe_last_date = UniverseReader().get_last_date(name)
     if not pd.isnull(universe_last_date):
         universe_start = universe_last_date
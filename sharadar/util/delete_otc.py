@@ -29,6 +29,7 @@ try:
         assets_db_cursor.execute("DELETE FROM asset_router WHERE sid = %d" % sid)
         assets_db_cursor.execute("DELETE FROM equities WHERE sid = %d" % sid)
         assets_db_cursor.execute("DELETE FROM equity_supplementary_mappings WHERE sid = %d" % sid)
+        assets_db_cursor.execute("DELETE FROM fundamentals WHERE sid = %d" % sid)
         assets_db_cursor.execute("DELETE FROM equity_symbol_mappings WHERE sid = %d" % sid)
 
         prices_db_cursor.execute("DELETE FROM prices WHERE sid = %d" % sid)
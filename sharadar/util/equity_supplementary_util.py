@@ -1,12 +1,20 @@
 """Equity supplementary data utilities for the Sharadar bundle.
 
 Provides functions to insert and query supplementary equity data
-(company info, fundamentals, daily metrics) in the asset database's
-equity_supplementary_mappings table.
+(company info, fundamentals, daily metrics) in the asset database.
+
+The numeric fundamentals and daily metrics are stored as REAL values in the
+fundamentals table, keyed by the integer id of their field in the
+fundamental_fields dictionary. The free-text data (company info, the text
+columns of SF1) stays in the equity_supplementary_mappings table.
 """
 import pandas as pd
 import numpy as np
 from zipline.utils.cli import maybe_show_progress
+from sharadar.util.logger import log
+
+# Minimum number of rows of a write loaded as a bulk load into a non empty table, see write_supplementary_mappings
+BULK_LOAD_MIN_ROWS = 1000000
 
 
 def value_changed(cursor, sid, field, value):
@@ -84,81 +92,433 @@ def lookup_sid(sharadar_metadata_df, related, ticker):
         return lookup_related_tickers(sharadar_metadata_df, related, ticker)
 
 
-def insert_fundamentals(sharadar_metadata_df, sf1_df, cursor, show_progress=True):
-    """Insert quarterly fundamental data into supplementary mappings.
+# columns of SHARADAR/SF1 not stored as fundamentals (the daily metrics come from SHARADAR/DAILY)
+SF1_EXCLUDED_COLUMNS = ['ticker', 'lastupdated', 'calendardate', 'datekey', 'dimension',
+                        'fiscalperiod', 'siccode', 'ev', 'evebit', 'evebitda', 'marketcap', 'pb', 'pe', 'ps']
+
+DAILY_EXCLUDED_COLUMNS = ['ticker', 'lastupdated', 'date']
+
+# fields of SHARADAR/DAILY
+DAILY_METRIC_FIELDS = ['ev', 'evebit', 'evebitda', 'marketcap', 'pb', 'pe', 'ps']
+
+# suffixes of the SF1 fields, one per dimension
+SF1_DIMENSION_SUFFIXES = ['_arq', '_ary', '_art', '_mrq', '_mry', '_mrt']
+
+# The numeric fields and their values. The primary key is the covering index of
+# the lookups of a field for a set of sids.
+FUNDAMENTALS_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS "fundamental_fields" ('
+    '"field_id" INTEGER PRIMARY KEY, '
+    '"field" TEXT NOT NULL UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS "fundamentals" ('
+    '"sid" INTEGER NOT NULL, '
+    '"field_id" INTEGER NOT NULL, '
+    '"start_date" INTEGER NOT NULL, '
+    '"value" REAL NOT NULL, '
+    'PRIMARY KEY (field_id, sid, start_date)) WITHOUT ROWID',
+    # the TTM sums of the '_arq' fields as of each filing, see write_fundamentals_ttm
+    'CREATE TABLE IF NOT EXISTS "fundamentals_ttm" ('
+    '"field_id" INTEGER NOT NULL, '
+    '"k" INTEGER NOT NULL, '
+    '"sid" INTEGER NOT NULL, '
+    '"start_date" INTEGER NOT NULL, '
+    '"first_date" INTEGER NOT NULL, '
+    '"value" REAL, '
+    'PRIMARY KEY (field_id, k, sid, start_date)) WITHOUT ROWID',
+)
+
+# TTM sums materialized at ingest: k=1 is the last twelve months, k=2 the previous twelve months
+TTM_YEARS = 2
+
+# Number of sids whose TTM sums are computed at once
+TTM_BATCH_SIZE = 1000
+
+
+class SidResolver(object):
+    """Maps tickers to SIDs like lookup_sid, with hashed lookups.
+
+    Built once from the Sharadar metadata: a dict of the direct tickers and an
+    inverted index of the related tickers. A related ticker resolves to the
+    first 'Domestic' or 'Domestic Primary' asset listing it, as in
+    lookup_related_tickers.
+
+    Attributes:
+        sids: dict from ticker to permaticker (SID).
+    """
+    RELATED_CATEGORIES = ['Domestic', 'Domestic Primary']
+
+    def __init__(self, sharadar_metadata_df, related_tickers=None):
+        """
+        Args:
+            sharadar_metadata_df: Sharadar ticker metadata DataFrame, indexed by ticker.
+            related_tickers: Series of related ticker strings (space-delimited),
+                defaults to the 'relatedtickers' of the metadata.
+        """
+        if related_tickers is None:
+            related_tickers = sharadar_metadata_df['relatedtickers'].dropna().astype(str)
+
+        permaticker = sharadar_metadata_df['permaticker']
+        domestic = permaticker[sharadar_metadata_df['category'].isin(self.RELATED_CATEGORIES).values]
+        domestic = domestic[~domestic.index.duplicated()]
+
+        sids = {}
+        for ticker, related in related_tickers.items():
+            if ticker not in domestic.index:
+                continue
+            for related_ticker in related.split():
+                if related_ticker not in sids:
+                    sids[related_ticker] = int(domestic[ticker])
+        # the direct tickers take precedence over the related ones
+        permaticker = permaticker[~permaticker.index.duplicated()]
+        sids.update(zip(permaticker.index, permaticker.astype(np.int64).tolist()))
+        self.sids = sids
+
+    def lookup(self, ticker):
+        """The SID of a ticker, -1 if not found."""
+        return self.sids.get(ticker, -1)
+
+    def map(self, tickers):
+        """Map an array of tickers to their SIDs.
+
+        Args:
+            tickers: Array-like of ticker symbols.
+
+        Returns:
+            numpy.ndarray: int64 SIDs, -1 for the unknown tickers.
+        """
+        codes, uniques = pd.factorize(np.asarray(tickers, dtype=object))
+        unique_sids = np.array([self.sids.get(t, -1) for t in uniques], dtype=np.int64)
+        return unique_sids[codes] if len(codes) > 0 else np.array([], dtype=np.int64)
+
+
+def _to_str(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.map(str)
+    return values.astype(str)
+
+
+def melt_supplementary(df, sids, start_dates, value_columns, field_suffix=None, numeric=False):
+    """Melt a wide SF1/DAILY frame into rows of fields.
+
+    Args:
+        df: Frame with one column per field.
+        sids: SID of each row of df.
+        start_dates: int64 start_date (nanoseconds) of each row of df.
+        value_columns: Columns to store as fields.
+        field_suffix: Optional suffix of each row (e.g. '_arq'), appended to the field name.
+        numeric: If True the values are float64, for the fundamentals table,
+            otherwise text, for equity_supplementary_mappings.
 
-    Processes SF1 data and writes each field/quarter combination as a
-    separate row in equity_supplementary_mappings.
+    Returns:
+        pd.DataFrame: Frame with the columns sid, field, start_date, value.
+        NaN, None and 'None' values are skipped.
+    """
+    sids = np.asarray(sids, dtype=np.int64)
+    start_dates = np.asarray(start_dates, dtype=np.int64)
+    frames = []
+    for column in value_columns:
+        values = df[column]
+        present = (values.notna() & (values.astype(object) != 'None')).values
+        if not present.any():
+            continue
+        field = column if field_suffix is None else column + field_suffix[present]
+        frames.append(pd.DataFrame({'sid': sids[present],
+                                    'field': field,
+                                    'start_date': start_dates[present],
+                                    'value': (values[present].astype(np.float64) if numeric else
+                                              _to_str(values[present])).values}))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['sid', 'field', 'start_date', 'value'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_supplementary_mappings(mappings_df, cursor, batch_size=100000, show_progress=True, bulk=None):
+    """Bulk insert rows into equity_supplementary_mappings.
+
+    The rows are sorted by primary key (sid, field, start_date), so the
+    primary key index is appended to in order. For a bulk load the
+    secondary indexes of the table (e.g. idx_start_date_field) are dropped
+    and rebuilt at the end; an incremental write keeps them, whose rebuild
+    would cost a scan of the whole table. For duplicate keys the last row
+    wins (INSERT OR REPLACE).
 
     Args:
-        sharadar_metadata_df: Sharadar ticker metadata DataFrame.
-        sf1_df: SF1 fundamentals DataFrame from NASDAQ Data Link.
+        mappings_df: Frame with the columns sid, field, start_date and value.
         cursor: SQLite cursor for writing.
+        batch_size: Number of rows per executemany call.
         show_progress: Whether to show a progress bar. Defaults to True.
+        bulk: True for a bulk load, False for an incremental write. If None,
+            the write is a bulk load if the table is empty or mappings_df has
+            at least BULK_LOAD_MIN_ROWS rows.
+    """
+    if len(mappings_df) == 0:
+        return
+    mappings_df = mappings_df.sort_values(['sid', 'field', 'start_date'], kind='stable')
+
+    if bulk is None:
+        bulk = len(mappings_df) >= BULK_LOAD_MIN_ROWS or \
+            cursor.execute("SELECT 1 FROM equity_supplementary_mappings LIMIT 1").fetchone() is None
+    indexes = []
+    if bulk:
+        # the primary key index (sql IS NULL) can not be dropped
+        cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = 'equity_supplementary_mappings' AND sql IS NOT NULL")
+        indexes = cursor.fetchall()
+        for name, _ in indexes:
+            cursor.execute('DROP INDEX "%s"' % name)
+
+    sids = mappings_df['sid'].values.tolist()
+    fields = mappings_df['field'].values.tolist()
+    start_dates = mappings_df['start_date'].values.tolist()
+    values = mappings_df['value'].values.tolist()
+
+    # end_date not used (set -1)
+    sql = "INSERT OR REPLACE INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) VALUES(?, ?, ?, -1, ?)"
+    batches = range(0, len(sids), batch_size)
+    with maybe_show_progress(batches, show_progress, label='Writing supplementary mappings: ') as it:
+        for i in it:
+            j = i + batch_size
+            cursor.executemany(sql, zip(sids[i:j], fields[i:j], start_dates[i:j], values[i:j]))
+
+    for _, index_sql in indexes:
+        cursor.execute(index_sql)
+
+
+def create_fundamentals_tables(cursor):
+    """Create the fundamentals and fundamental_fields tables, if they do not exist."""
+    for statement in FUNDAMENTALS_SCHEMA:
+        cursor.execute(statement)
+
+
+def field_ids(cursor, fields):
+    """The ids of fields in fundamental_fields, the missing fields are added.
+
+    Args:
+        cursor: SQLite cursor of the asset database.
+        fields: Field names.
+
+    Returns:
+        dict: Map from field name to field id.
     """
-    tickers = sf1_df['ticker'].unique()
-    related_tickers = sharadar_metadata_df['relatedtickers'].dropna()
-    # Add a space at the begin and end of relatedtickers, search for ' TICKER '
-    related_tickers = ' ' + related_tickers.astype(str) + ' '
+    fields = [str(f) for f in pd.unique(np.asarray(fields, dtype=object))]
+    cursor.executemany('INSERT OR IGNORE INTO fundamental_fields (field) VALUES (?)', [(f,) for f in fields])
+    cursor.execute('SELECT field, field_id FROM fundamental_fields')
+    ids = dict(cursor.fetchall())
+    return {f: ids[f] for f in fields}
+
 
-    with maybe_show_progress(tickers, show_progress, label='Parsing fundamental data: ') as it:
-        for ticker in it:
-            df_ticker = sf1_df[sf1_df['ticker'] == ticker]
-            df_ticker.set_index('datekey', inplace=True)
-            df_ticker = df_ticker.sort_index(ascending=False)
-            df_ticker = df_ticker.drop(['ticker', 'lastupdated', 'calendardate'], axis=1)
+def migrate_fundamentals(cursor):
+    """Move the numeric fundamentals and daily metrics out of equity_supplementary_mappings.
+
+    The asset databases ingested before the fundamentals table stored them as
+    text. The rows of the SF1 and DAILY fields whose value is a number are
+    moved once, when the field dictionary is still empty: the text fields
+    (e.g. currency_arq) stay in equity_supplementary_mappings.
+
+    Args:
+        cursor: SQLite cursor of the asset database.
 
-            sid = lookup_sid(sharadar_metadata_df, related_tickers, ticker)
+    Returns:
+        int: Number of moved rows.
+    """
+    create_fundamentals_tables(cursor)
+    cursor.execute('SELECT COUNT(*) FROM fundamental_fields')
+    if cursor.fetchone()[0] > 0:
+        return 0
+
+    # the numeric texts are converted by the comparison with a REAL, see the SQLite type affinity
+    numeric_rows = "FROM equity_supplementary_mappings WHERE (field IN (%s) OR substr(field, -4) IN (%s)) " \
+                   "AND CAST(value AS REAL) = value" % (",".join("'%s'" % f for f in DAILY_METRIC_FIELDS),
+                                                        ",".join("'%s'" % s for s in SF1_DIMENSION_SUFFIXES))
+    cursor.execute('INSERT OR IGNORE INTO fundamental_fields (field) SELECT DISTINCT field %s' % numeric_rows)
+    cursor.execute('INSERT OR REPLACE INTO fundamentals (sid, field_id, start_date, value) '
+                   'SELECT m.sid, f.field_id, m.start_date, CAST(m.value AS REAL) '
+                   'FROM equity_supplementary_mappings m JOIN fundamental_fields f ON f.field = m.field '
+                   'WHERE CAST(m.value AS REAL) = m.value')
+    moved = cursor.rowcount
+    cursor.execute('DELETE %s' % numeric_rows)
+    if moved > 0:
+        log.info("Moved %d numeric fundamentals from equity_supplementary_mappings to fundamentals." % moved)
+    return moved
+
+
+def write_fundamentals(fundamentals_df, cursor, batch_size=100000, show_progress=True):
+    """Bulk insert rows into the fundamentals table.
+
+    The field names are interned in fundamental_fields and the rows are
+    sorted by primary key (field_id, sid, start_date). For duplicate keys the
+    last row wins (INSERT OR REPLACE).
 
-            for datekey, row in df_ticker.iterrows():
-                for column in row.index:
-                    if column in ['fiscalperiod', 'siccode', 'dimension', 'ev', 'evebit', 'evebitda', 'marketcap', 'pb', 'pe', 'ps']:
-                        continue
-                    value = row[column]
-                    if type(value) == float and np.isnan(value):
-                        continue
-                    if value is None or value == 'None':
-                        continue
-                    field = column + '_' + row['dimension'].lower()
-                    date = datekey + pd.Timedelta(days=1)
+    Args:
+        fundamentals_df: Frame with the columns sid, field, start_date and the float value.
+        cursor: SQLite cursor for writing.
+        batch_size: Number of rows per executemany call.
+        show_progress: Whether to show a progress bar. Defaults to True.
+    """
+    migrate_fundamentals(cursor)
+    if len(fundamentals_df) == 0:
+        return
+    ids = field_ids(cursor, fundamentals_df['field'].values)
+    fundamentals_df = fundamentals_df.assign(field_id=fundamentals_df['field'].map(ids).astype(np.int64))
+    fundamentals_df = fundamentals_df.sort_values(['field_id', 'sid', 'start_date'], kind='stable')
+
+    sids = fundamentals_df['sid'].values.tolist()
+    fields = fundamentals_df['field_id'].values.tolist()
+    start_dates = fundamentals_df['start_date'].values.tolist()
+    values = fundamentals_df['value'].values.astype(np.float64).tolist()
+
+    sql = "INSERT OR REPLACE INTO fundamentals (sid, field_id, start_date, value) VALUES(?, ?, ?, ?)"
+    batches = range(0, len(sids), batch_size)
+    with maybe_show_progress(batches, show_progress, label='Writing fundamentals: ') as it:
+        for i in it:
+            j = i + batch_size
+            cursor.executemany(sql, zip(sids[i:j], fields[i:j], start_dates[i:j], values[i:j]))
+
+
+def ttm_frame(quarters, k):
+    """The TTM sums of quarterly records as of each record.
+
+    The k-th TTM sum as of a record is the sum of the 4 records from the
+    (4k)-th latest to the (4k-3)-th latest one, the first records of a sid
+    sum the records available, like the SQL SUM of get_fundamentals_ttm.
+
+    Args:
+        quarters: Frame with the columns field_id, sid, start_date and value,
+            sorted by field_id, sid and start_date.
+        k: 1 for the last twelve months, 2 for the previous twelve months...
+
+    Returns:
+        pd.DataFrame: Frame with the columns field_id, k, sid, start_date,
+        first_date (start date of the oldest summed record) and value (NaN
+        without any record to sum).
+    """
+    groups = quarters.groupby(['field_id', 'sid'], sort=False)
+    position = groups.cumcount().values
+    m = 4 * k
+    # sums of the 4 records ending at each record, then of the records m - 4 places before
+    sums = groups['value'].rolling(4, min_periods=1).sum().values
+    shifted = np.full(len(quarters), np.nan)
+    shift = m - 4
+    valid = position >= shift
+    shifted[valid] = sums[np.flatnonzero(valid) - shift]
+    first = np.flatnonzero(valid) - np.minimum(position[valid], m - 1)
+    first_date = quarters['start_date'].values.copy()
+    first_date[valid] = quarters['start_date'].values[first]
+    return pd.DataFrame({'field_id': quarters['field_id'].values,
+                         'k': k,
+                         'sid': quarters['sid'].values,
+                         'start_date': quarters['start_date'].values,
+                         'first_date': first_date,
+                         'value': shifted})
+
+
+def write_fundamentals_ttm(cursor, sids=None, show_progress=True):
+    """Rebuild the TTM sums of the '_arq' fields for k=1..TTM_YEARS.
+
+    The sums of the sids are deleted and computed again from the fundamentals
+    table, since a new quarter changes the sums of the next quarters. The
+    whole table is built if it is empty, e.g. after migrate_fundamentals.
+
+    Args:
+        cursor: SQLite cursor of the asset database.
+        sids: Security identifiers to rebuild, None for all.
+        show_progress: Whether to show a progress bar. Defaults to True.
+
+    Returns:
+        int: Number of rows written.
+    """
+    cursor.execute("SELECT field_id FROM fundamental_fields WHERE substr(field, -4) = '_arq'")
+    arq_ids = [r[0] for r in cursor.fetchall()]
+    cursor.execute("SELECT COUNT(*) FROM (SELECT 1 FROM fundamentals_ttm LIMIT 1)")
+    if sids is None or cursor.fetchone()[0] == 0:
+        cursor.execute("SELECT DISTINCT sid FROM fundamentals WHERE field_id IN (%s)" % ",".join(map(str, arq_ids)))
+        sids = [r[0] for r in cursor.fetchall()]
+        cursor.execute("DELETE FROM fundamentals_ttm")
+    sids = [int(x) for x in pd.unique(np.asarray(sids, dtype=np.int64))]
+    if len(sids) == 0 or len(arq_ids) == 0:
+        return 0
+
+    written = 0
+    sql = "INSERT INTO fundamentals_ttm (field_id, k, sid, start_date, first_date, value) VALUES (?, ?, ?, ?, ?, ?)"
+    batches = range(0, len(sids), TTM_BATCH_SIZE)
+    with maybe_show_progress(batches, show_progress, label='Writing TTM fundamentals: ') as it:
+        for i in it:
+            batch = ",".join(map(str, sids[i:i + TTM_BATCH_SIZE]))
+            cursor.execute("DELETE FROM fundamentals_ttm WHERE sid IN (%s)" % batch)
+            cursor.execute("SELECT field_id, sid, start_date, value FROM fundamentals "
+                           "WHERE field_id IN (%s) AND sid IN (%s) ORDER BY field_id, sid, start_date"
+                           % (",".join(map(str, arq_ids)), batch))
+            quarters = pd.DataFrame(cursor.fetchall(), columns=['field_id', 'sid', 'start_date', 'value'])
+            if len(quarters) == 0:
+                continue
+            for k in range(1, TTM_YEARS + 1):
+                ttm = ttm_frame(quarters, k)
+                values = ttm['value'].astype(object).where(ttm['value'].notna(), None)
+                cursor.executemany(sql, zip(ttm['field_id'].tolist(), ttm['k'].tolist(), ttm['sid'].tolist(),
+                                            ttm['start_date'].tolist(), ttm['first_date'].tolist(),
+                                            values.tolist()))
+                written += len(ttm)
+    return written
+
+
+def _split_numeric(df, value_columns):
+    numeric = [c for c in value_columns if pd.api.types.is_numeric_dtype(df[c])]
+    return numeric, [c for c in value_columns if c not in numeric]
+
+
+def insert_fundamentals(sharadar_metadata_df, sf1_df, cursor, show_progress=True, sid_resolver=None):
+    """Insert quarterly fundamental data.
+
+    Melts the SF1 data into one row per field/quarter combination and bulk
+    writes the numeric columns in the fundamentals table, the text columns
+    (e.g. currency, reportperiod) in equity_supplementary_mappings. The TTM
+    sums of the sids are then rebuilt.
+
+    Args:
+        sharadar_metadata_df: Sharadar ticker metadata DataFrame.
+        sf1_df: SF1 fundamentals DataFrame from NASDAQ Data Link.
+        cursor: SQLite cursor for writing.
+        show_progress: Whether to show a progress bar. Defaults to True.
+        sid_resolver: Optional SidResolver of the metadata.
+    """
+    if sid_resolver is None:
+        sid_resolver = SidResolver(sharadar_metadata_df)
+    sids = sid_resolver.map(sf1_df['ticker'].values)
+    start_dates = (pd.DatetimeIndex(sf1_df['datekey']) + pd.Timedelta(days=1)).asi8
+    field_suffix = ('_' + sf1_df['dimension'].str.lower()).values
+    numeric_columns, text_columns = _split_numeric(sf1_df, [c for c in sf1_df.columns
+                                                            if c not in SF1_EXCLUDED_COLUMNS])
 
-                    # end_date not used (set -1)
-                    sql = "INSERT OR REPLACE INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) VALUES(?, ?, ?, -1, ?)"
-                    cursor.execute(sql, (sid, field, date.value, str(value)))
+    fundamentals_df = melt_supplementary(sf1_df, sids, start_dates, numeric_columns, field_suffix, numeric=True)
+    mappings_df = melt_supplementary(sf1_df, sids, start_dates, text_columns, field_suffix)
+    log.info("Writing %d fundamentals and %d text fields..." % (len(fundamentals_df), len(mappings_df)))
+    write_fundamentals(fundamentals_df, cursor, show_progress=show_progress)
+    write_supplementary_mappings(mappings_df, cursor, show_progress=show_progress)
+    write_fundamentals_ttm(cursor, fundamentals_df['sid'].values, show_progress=show_progress)
 
 
-def insert_daily_metrics(sharadar_metadata_df, daily_df, cursor, show_progress=True):
-    """Insert daily metric data into supplementary mappings.
+def insert_daily_metrics(sharadar_metadata_df, daily_df, cursor, show_progress=True, sid_resolver=None):
+    """Insert daily metric data.
 
-    Processes SHARADAR/DAILY data and writes market cap, P/E, and other
-    daily metrics for each ticker/date combination.
+    Melts the SHARADAR/DAILY data into one row per field/date combination
+    (market cap, P/E, ...) and bulk writes them in the fundamentals table.
 
     Args:
         sharadar_metadata_df: Sharadar ticker metadata DataFrame.
         daily_df: Daily metrics DataFrame from NASDAQ Data Link.
         cursor: SQLite cursor for writing.
         show_progress: Whether to show a progress bar. Defaults to True.
+        sid_resolver: Optional SidResolver of the metadata.
     """
-    tickers = daily_df['ticker'].unique()
-    related_tickers = sharadar_metadata_df['relatedtickers'].dropna()
-    # Add a space at the begin and end of relatedtickers, search for ' TICKER '
-    related_tickers = ' ' + related_tickers.astype(str) + ' '
-
-    with maybe_show_progress(tickers, show_progress, label='Parsing fundamental data: ') as it:
-        for ticker in it:
-            df_ticker = daily_df[daily_df['ticker'] == ticker]
-            df_ticker.set_index('date', inplace=True)
-            df_ticker = df_ticker.sort_index(ascending=False)
-            df_ticker = df_ticker.drop(['ticker', 'lastupdated'], axis=1)
-
-            sid = lookup_sid(sharadar_metadata_df, related_tickers, ticker)
-
-            for date, row in df_ticker.iterrows():
-                for field in row.index:
-                    value = row[field]
-                    if np.isnan(value):
-                        continue
-
-                    # end_date not used (set -1)
-                    sql = "INSERT OR REPLACE INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) VALUES(?, ?, ?, -1, ?)"
-                    cursor.execute(sql, (sid, field, date.value, str(value)))
+    if sid_resolver is None:
+        sid_resolver = SidResolver(sharadar_metadata_df)
+    sids = sid_resolver.map(daily_df['ticker'].values)
+    start_dates = pd.DatetimeIndex(daily_df['date']).asi8
+    numeric_columns, text_columns = _split_numeric(daily_df, [c for c in daily_df.columns
+                                                              if c not in DAILY_EXCLUDED_COLUMNS])
+
+    fundamentals_df = melt_supplementary(daily_df, sids, start_dates, numeric_columns, numeric=True)
+    mappings_df = melt_supplementary(daily_df, sids, start_dates, text_columns)
+    log.info("Writing %d daily metrics..." % (len(fundamentals_df) + len(mappings_df)))
+    write_fundamentals(fundamentals_df, cursor, show_progress=show_progress)
+    write_supplementary_mappings(mappings_df, cursor, show_progress=show_progress)
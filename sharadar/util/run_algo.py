@@ -332,7 +332,8 @@ def create_algo_class(TradingAlgorithmClass, start, end, algofile, algotext, ana
             'script': algotext,
         }
     )
-    algo.engine = make_pipeline_engine(bundle_data, live=isinstance(algo, LiveTradingAlgorithm))
+    algo.engine = make_pipeline_engine(bundle_data, live=isinstance(algo, LiveTradingAlgorithm), name=bundle,
+                                       environ=environ)
     return algo
 
 
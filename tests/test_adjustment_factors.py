@@ -0,0 +1,165 @@
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+import pytest
+from exchange_calendars import get_calendar
+from sqlalchemy import create_engine
+from zipline.assets import AssetDBWriter, AssetFinder
+from zipline.data.adjustments import SQLiteAdjustmentReader
+from zipline.data.data_portal import DataPortal
+
+from sharadar.data.adjustment_factors import AdjustmentFactorReader, write_adjustment_factors
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarWriter, SQLiteDailyBarReader, \
+    SQLiteDailyAdjustmentWriter
+from sharadar.pipeline import engine
+
+
+def _seconds(day):
+    return int(pd.Timestamp(day).value // 10 ** 9)
+
+
+@pytest.fixture
+def calendar():
+    return get_calendar('XNYS', start=pd.Timestamp('2020-01-01'))
+
+
+@pytest.fixture
+def sessions(calendar):
+    return calendar.sessions_in_range('2020-01-02', '2020-02-28')
+
+
+@pytest.fixture
+def bar_reader(tmp_path, calendar, sessions):
+    index = pd.MultiIndex.from_product([sessions, [1, 2]], names=['date', 'sid'])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.random((len(index), 5)) * 10 + 50, index=index,
+                        columns=['open', 'high', 'low', 'close', 'volume'])
+    data['volume'] = np.round(data['volume'] * 1000)
+    # sid 2 does not trade on 2020-01-15
+    data = data.drop((pd.Timestamp('2020-01-15'), 2))
+    filename = str(tmp_path / 'prices.sqlite')
+    SQLiteDailyBarWriter(filename, calendar).write(data)
+    return SQLiteDailyBarReader(filename)
+
+
+@pytest.fixture
+def adjustments_path(tmp_path, bar_reader, calendar):
+    filename = str(tmp_path / 'adjustments.sqlite')
+    writer = SQLiteDailyAdjustmentWriter(filename, bar_reader, None, calendar)
+    splits = pd.DataFrame({
+        'effective_date': pd.to_datetime(['2020-01-21', '2020-02-10', '2020-01-21']),
+        'ratio': [0.5, 0.25, 2.0],
+        'sid': [1, 1, 2],
+    })
+    mergers = pd.DataFrame({'effective_date': pd.to_datetime(['2020-01-21']), 'ratio': [0.9], 'sid': [1]})
+    writer.write(splits=splits, mergers=mergers)
+    # dividend ratios as written by calc_dividend_ratios
+    writer.write_frame('dividends', pd.DataFrame({
+        'sid': [2], 'effective_date': pd.to_datetime(['2020-02-03']), 'ratio': [0.98]}))
+    write_adjustment_factors(filename)
+    return filename
+
+
+@pytest.fixture
+def factor_reader(adjustments_path):
+    return AdjustmentFactorReader(adjustments_path)
+
+
+class TestWriteAdjustmentFactors:
+    def _rows(self, path):
+        with closing(sqlite3.connect(path)) as con:
+            return con.execute("SELECT sid, effective_date, price_factor, volume_factor FROM adjustment_factors "
+                               "ORDER BY sid, effective_date").fetchall()
+
+    def test_cumulative_factors(self, adjustments_path):
+        rows = self._rows(adjustments_path)
+        assert [r[:2] for r in rows] == [(1, _seconds('2020-01-21')), (1, _seconds('2020-02-10')),
+                                         (2, _seconds('2020-01-21')), (2, _seconds('2020-02-03'))]
+        # the split and the merger of sid 1 on the same date, then the later split
+        np.testing.assert_allclose([r[2] for r in rows], [0.5 * 0.9 * 0.25, 0.25, 2.0 * 0.98, 0.98])
+        # the volumes are adjusted by the splits only
+        np.testing.assert_allclose([r[3] for r in rows], [2.0 * 4.0, 4.0, 0.5, 1.0])
+
+    def test_rebuild_replaces_factors(self, adjustments_path):
+        with closing(sqlite3.connect(adjustments_path)) as con, con:
+            con.execute("DELETE FROM splits WHERE sid = 1")
+        write_adjustment_factors(adjustments_path)
+        rows = self._rows(adjustments_path)
+        assert rows[0] == (1, _seconds('2020-01-21'), 0.9, 1.0)
+        assert len(rows) == 3
+
+    def test_adjustment_writer_writes_factors(self, tmp_path):
+        filename = str(tmp_path / 'adjustments.sqlite')
+        splits = pd.DataFrame({'effective_date': pd.to_datetime(['2020-01-21']), 'ratio': [0.5], 'sid': [1]})
+        SQLiteDailyAdjustmentWriter(filename, None, None, None).write(splits=splits)
+        assert self._rows(filename) == [(1, _seconds('2020-01-21'), 0.5, 2.0)]
+
+
+class TestAdjustmentFactorReader:
+    def test_has_factors(self, factor_reader, tmp_path):
+        assert factor_reader.has_factors
+        filename = str(tmp_path / 'empty.sqlite')
+        with closing(sqlite3.connect(filename)) as con:
+            con.execute("CREATE TABLE splits (sid INTEGER)")
+        assert not AdjustmentFactorReader(filename).has_factors
+
+    def test_load_factors(self, factor_reader):
+        dates = pd.to_datetime(['2020-01-17', '2020-01-21', '2020-02-07', '2020-02-10', '2020-02-28'])
+        price_factors, volume_factors = factor_reader.load_factors(dates, [1, 3, 1])
+        expected = [0.5 * 0.9 * 0.25, 0.25, 0.25, 1.0, 1.0]
+        np.testing.assert_allclose(price_factors[:, 0], expected)
+        np.testing.assert_allclose(price_factors[:, 2], expected)
+        np.testing.assert_array_equal(price_factors[:, 1], 1.0)
+        np.testing.assert_allclose(volume_factors[:, 0], [8.0, 4.0, 4.0, 1.0, 1.0])
+
+    @pytest.mark.parametrize('start, end', [
+        ('2020-01-02', '2020-02-28'),
+        ('2020-01-06', '2020-01-21'),
+        ('2020-01-13', '2020-02-07'),
+        ('2020-01-21', '2020-01-21'),
+    ])
+    def test_matches_data_portal_history(self, tmp_path, bar_reader, factor_reader, adjustments_path,
+                                         sessions, start, end):
+        engine = create_engine('sqlite:///' + str(tmp_path / 'assets.sqlite'))
+        equities = pd.DataFrame({'symbol': ['A', 'B'], 'start_date': sessions[0], 'end_date': sessions[-1],
+                                 'exchange': 'NYSE'}, index=[1, 2])
+        AssetDBWriter(engine).write(equities=equities,
+                                    exchanges=pd.DataFrame({'exchange': ['NYSE'], 'country_code': ['US']}))
+        asset_finder = AssetFinder(engine)
+        data_portal = DataPortal(asset_finder, trading_calendar=bar_reader.trading_calendar,
+                                 first_trading_day=sessions[0],
+                                 equity_daily_reader=bar_reader,
+                                 adjustment_reader=SQLiteAdjustmentReader(adjustments_path))
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        for field in ['open', 'close', 'volume']:
+            expected = data_portal.get_history_window(assets=asset_finder.retrieve_all([1, 2]), end_dt=end,
+                                                      bar_count=len(sessions[(sessions >= start) & (sessions <= end)]),
+                                                      frequency='1d', field=field, data_frequency='daily')
+            actual = factor_reader.load_adjusted_arrays(bar_reader, [field], start, end, [1, 2])[0]
+            if field == 'volume':
+                # the DataPortal casts the missing volumes to integers
+                traded = ~np.isnan(bar_reader.load_raw_arrays([field], start, end, [1, 2])[0])
+                np.testing.assert_allclose(actual[traded], expected.values[traded])
+            else:
+                np.testing.assert_allclose(actual, expected.values)
+
+    def test_missing_volume_is_zero(self, factor_reader, bar_reader):
+        day = pd.Timestamp('2020-01-15')
+        volume = factor_reader.load_adjusted_arrays(bar_reader, ['volume', 'close'], day, day, [2])
+        assert volume[0][0, 0] == 0.0
+        assert np.isnan(volume[1][0, 0])
+
+    def test_unknown_field_raises(self, factor_reader, bar_reader):
+        day = pd.Timestamp('2020-01-15')
+        with pytest.raises(ValueError):
+            factor_reader.load_adjusted_arrays(bar_reader, ['sid'], day, day, [1])
+
+
+class TestEngineAdjustmentFactorReader:
+    def test_one_reader_per_bundle(self, tmp_path):
+        environ = {'ZIPLINE_ROOT': str(tmp_path / 'a')}
+        reader = engine._adjustment_factor_reader(environ=environ)
+        assert engine._adjustment_factor_reader(environ=environ) is reader
+        assert engine._adjustment_factor_reader(environ={'ZIPLINE_ROOT': str(tmp_path / 'b')}) is not reader
@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+from contextlib import closing
+
+import pytest
+
+from sharadar.data.connection_pool import SQLiteConnectionPool
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'test db.sqlite')
+    with closing(sqlite3.connect(path)) as con, con:
+        con.execute("CREATE TABLE t (x INTEGER)")
+        con.executemany("INSERT INTO t VALUES (?)", [(1,), (2,), (3,)])
+    return path
+
+
+class TestSQLiteConnectionPool:
+    def test_execute_with_parameters(self, db_path):
+        pool = SQLiteConnectionPool(db_path)
+        assert pool.execute("SELECT x FROM t WHERE x >= ? ORDER BY x", (2,)) == [(2,), (3,)]
+
+    def test_reuses_connections(self, db_path):
+        pool = SQLiteConnectionPool(db_path)
+        with pool.connection() as con1:
+            pass
+        with pool.connection() as con2:
+            assert con2 is con1
+
+    def test_read_only(self, db_path):
+        pool = SQLiteConnectionPool(db_path)
+        with pytest.raises(sqlite3.OperationalError):
+            pool.execute("INSERT INTO t VALUES (4)")
+        # the failed connection is not returned to the pool
+        assert pool._idle == []
+        assert pool.execute("SELECT COUNT(*) FROM t") == [(3,)]
+
+    def test_sees_later_writes(self, db_path):
+        pool = SQLiteConnectionPool(db_path)
+        assert pool.execute("SELECT COUNT(*) FROM t") == [(3,)]
+        with closing(sqlite3.connect(db_path)) as con, con:
+            con.execute("INSERT INTO t VALUES (4)")
+        assert pool.execute("SELECT COUNT(*) FROM t") == [(4,)]
+
+    def test_immutable(self, db_path):
+        pool = SQLiteConnectionPool(db_path, immutable=True)
+        assert pool.execute("SELECT SUM(x) FROM t") == [(6,)]
+
+    def test_concurrent_threads(self, db_path):
+        pool = SQLiteConnectionPool(db_path, max_size=2)
+        barrier = threading.Barrier(4)
+        results = []
+
+        def query():
+            with pool.connection() as con:
+                barrier.wait(timeout=5)
+                results.append(con.execute("SELECT SUM(x) FROM t").fetchone()[0])
+
+        threads = [threading.Thread(target=query) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [6] * 4
+        assert len(pool._idle) == 2
+
+    def test_discards_connections_after_fork(self, db_path):
+        pool = SQLiteConnectionPool(db_path)
+        with pool.connection() as parent_con:
+            pass
+        pool._pid = -1  # as seen from a forked child
+        with pool.connection() as con:
+            assert con is not parent_con
+        parent_con.close()
+
+    def test_close(self, db_path):
+        pool = SQLiteConnectionPool(db_path)
+        pool.execute("SELECT 1")
+        pool.close()
+        assert pool._idle == []
+        assert pool.execute("SELECT 1") == [(1,)]
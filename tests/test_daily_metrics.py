@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from zipline.pipeline.domain import US_EQUITIES
+from sharadar.data.sql_lite_assets import SQLiteAssetFinder
+from sharadar.pipeline.daily_metrics import SharadarDailyMetrics, DailyMetricsLoader, fill_missing_sessions
+from sharadar.util.equity_supplementary_util import migrate_fundamentals
+
+
+@pytest.fixture
+def sessions():
+    return US_EQUITIES.sessions()[US_EQUITIES.sessions().searchsorted(pd.Timestamp('2021-01-04')):][:5]
+
+
+@pytest.fixture
+def metrics_finder(asset_db_engine, sessions):
+    rows = []
+    # no values on the last session, as when SHARADAR/DAILY is not computed yet
+    for i, session in enumerate(sessions[:-1]):
+        for sid in (1, 2):
+            rows.append(dict(sid=sid, field='marketcap', start_date=session.value, value=str(sid * 1000.0 + i)))
+            rows.append(dict(sid=sid, field='pe', start_date=session.value, value=str(sid * 10.0 + i)))
+    with asset_db_engine.connect() as conn:
+        conn.execute(text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                          "VALUES (:sid, :field, :start_date, -1, :value)"), rows)
+        conn.commit()
+    return SQLiteAssetFinder(asset_db_engine)
+
+
+class TestFillMissingSessions:
+    def test_fills_single_missing_session(self):
+        data = np.array([[1.0, 2.0], [np.nan, np.nan], [3.0, np.nan]])
+        np.testing.assert_array_equal(fill_missing_sessions(data), [[1.0, 2.0], [1.0, 2.0], [3.0, np.nan]])
+
+    def test_fills_only_one_session(self):
+        data = np.array([[1.0], [np.nan], [np.nan]])
+        np.testing.assert_array_equal(fill_missing_sessions(data), [[1.0], [1.0], [np.nan]])
+
+
+class TestGetDailyMetricsWindow:
+    def test_values_by_session_and_sid(self, metrics_finder, sessions):
+        result = metrics_finder.get_daily_metrics_window([2, 1, 3], ['marketcap', 'pe'], sessions)
+        assert result['marketcap'].shape == (5, 3)
+        np.testing.assert_array_equal(result['marketcap'][:4, 0], [2000.0, 2001.0, 2002.0, 2003.0])
+        np.testing.assert_array_equal(result['pe'][:4, 1], [10.0, 11.0, 12.0, 13.0])
+        assert np.isnan(result['marketcap'][4]).all()
+        assert np.isnan(result['pe'][:, 2]).all()
+
+    def test_matches_get_daily_metrics(self, metrics_finder, sessions):
+        window = metrics_finder.get_daily_metrics_window([1, 2], ['pe'], sessions[2:3])['pe']
+        np.testing.assert_array_equal(metrics_finder.get_daily_metrics([1, 2], 'pe', sessions[2]), window)
+
+    def test_reads_fundamentals_table(self, metrics_finder, sessions):
+        expected = metrics_finder.get_daily_metrics_window([2, 1], ['marketcap', 'pe', 'ps'], sessions)
+        with metrics_finder.engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            migrate_fundamentals(cursor)
+            # a field still in equity_supplementary_mappings
+            cursor.execute("INSERT INTO equity_supplementary_mappings VALUES (1, 'ps', %d, -1, '2.5')"
+                           % sessions[0].value)
+        # the change of an in-memory database is not detected
+        metrics_finder.clear_point_in_time_cache()
+        actual = metrics_finder.get_daily_metrics_window([2, 1], ['marketcap', 'pe', 'ps'], sessions)
+        assert metrics_finder._field_source('pe')[0] == 'fundamentals'
+        np.testing.assert_array_equal(actual['marketcap'], expected['marketcap'])
+        np.testing.assert_array_equal(actual['pe'], expected['pe'])
+        assert actual['ps'][0, 1] == 2.5
+        assert metrics_finder.last_available_daily_metrics_dt == sessions[3]
+
+
+class TestDailyMetricsLoader:
+    def test_load_adjusted_array(self, metrics_finder, sessions):
+        loader = DailyMetricsLoader(metrics_finder)
+        columns = [SharadarDailyMetrics.marketcap, SharadarDailyMetrics.pe]
+        dates = sessions[1:]
+        sids = pd.Index([1, 2])
+        mask = np.ones((len(dates), len(sids)), dtype=bool)
+        result = loader.load_adjusted_array(US_EQUITIES, columns, dates, sids, mask)
+
+        marketcap = result[SharadarDailyMetrics.marketcap].data
+        assert marketcap.shape == (4, 2)
+        np.testing.assert_array_equal(marketcap[:, 0], [1001.0, 1002.0, 1003.0, 1003.0])
+        np.testing.assert_array_equal(result[SharadarDailyMetrics.pe].data[-1], [13.0, 23.0])
+
+    def test_first_session_filled_from_previous(self, metrics_finder, sessions):
+        loader = DailyMetricsLoader(metrics_finder)
+        dates = sessions[4:]
+        result = loader.load_adjusted_array(US_EQUITIES, [SharadarDailyMetrics.pe], dates, pd.Index([1, 2]),
+                                            np.ones((1, 2), dtype=bool))
+        np.testing.assert_array_equal(result[SharadarDailyMetrics.pe].data, [[13.0, 23.0]])
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from zipline.pipeline.domain import US_EQUITIES
+from sharadar.data.sql_lite_assets import SQLiteAssetFinder
+from sharadar.pipeline.equity_metadata import SharadarEquityMetadata, EquityMetadataLoader, symbol_flags
+
+
+@pytest.fixture
+def sessions():
+    return US_EQUITIES.sessions()[US_EQUITIES.sessions().searchsorted(pd.Timestamp('2021-01-04')):][:5]
+
+
+@pytest.fixture
+def metadata_finder(asset_db_engine, sessions):
+    rows = [(1, 'sector', sessions[0], 'Technology'), (1, 'sector', sessions[2], 'Energy'),
+            (1, 'sector', sessions[3], 'Energy'), (2, 'sector', sessions[0] - pd.Timedelta(days=400), 'Utilities'),
+            (2, 'sector', sessions[1], 'None'), (1, 'category', sessions[0], 'Domestic Common Stock')]
+    with asset_db_engine.connect() as conn:
+        conn.execute(text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                          "VALUES (:sid, :field, :start_date, -1, :value)"),
+                     [dict(sid=sid, field=field, start_date=date.value, value=value)
+                      for sid, field, date, value in rows])
+        conn.commit()
+    return SQLiteAssetFinder(asset_db_engine)
+
+
+class TestSymbolFlags:
+    def test_fifth_letter(self):
+        np.testing.assert_array_equal(symbol_flags(['ABCDQ', 'ABCQ', 'ABCDE', None], 'Q'), [1, 0, 0, 0])
+
+
+class TestEquityMetadataLoader:
+    def test_matches_get_info(self, metadata_finder, sessions):
+        loader = EquityMetadataLoader(metadata_finder)
+        sids = pd.Index([2, 1, 3])
+        columns = [SharadarEquityMetadata.sector, SharadarEquityMetadata.category]
+        result = loader.load_adjusted_array(US_EQUITIES, columns, sessions, sids,
+                                            np.ones((len(sessions), len(sids)), dtype=bool))
+
+        sector = result[SharadarEquityMetadata.sector].data
+        assert sector.shape == (5, 3)
+        assert list(sector.categories[:-1]) == list(SharadarEquityMetadata.sector.metadata['categories'])
+        for i, session in enumerate(sessions):
+            expected = metadata_finder.get_info(sids, 'sector', session)[0]
+            expected = [v if v in sector.categories else 'NA' for v in expected]
+            assert list(sector.as_string_array()[i]) == expected
+        np.testing.assert_array_equal(result[SharadarEquityMetadata.category].data.as_string_array()[:, 1],
+                                      ['Domestic Common Stock'] * 5)
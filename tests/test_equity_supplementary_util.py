@@ -1,6 +1,11 @@
+import sqlite3
+import numpy as np
 import pandas as pd
+import pytest
 from unittest.mock import MagicMock
-from sharadar.util.equity_supplementary_util import value_changed, lookup_sid, lookup_related_tickers
+from sharadar.util.equity_supplementary_util import value_changed, lookup_sid, lookup_related_tickers, \
+    SidResolver, insert_fundamentals, insert_daily_metrics, write_supplementary_mappings, write_fundamentals, \
+    migrate_fundamentals
 
 
 class TestValueChanged:
@@ -60,4 +65,167 @@ class TestLookupRelatedTickers:
         }, index=['GOOG'])
         related = pd.Series([' NOMATCH '], index=['GOOG'])
         result = lookup_related_tickers(metadata_df, related, 'TICKER1')
-        assert result == -1
\ No newline at end of file
+        assert result == -1
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE equity_supplementary_mappings (sid BIGINT NOT NULL, field TEXT NOT NULL, "
+                 "start_date BIGINT NOT NULL, end_date BIGINT NOT NULL, value TEXT NOT NULL, "
+                 "PRIMARY KEY (sid, field, start_date))")
+    yield conn.cursor()
+    conn.close()
+
+
+@pytest.fixture
+def metadata_df():
+    return pd.DataFrame({
+        'permaticker': [100, 200],
+        'category': ['Domestic', 'Domestic'],
+        'relatedtickers': ['OLD', None],
+    }, index=['AAPL', 'MSFT'])
+
+
+def _rows(cursor):
+    cursor.execute("SELECT sid, field, start_date, end_date, value FROM equity_supplementary_mappings "
+                   "ORDER BY sid, field, start_date")
+    return cursor.fetchall()
+
+
+def _fundamentals(cursor):
+    cursor.execute("SELECT sid, field, start_date, value FROM fundamentals JOIN fundamental_fields USING (field_id) "
+                   "ORDER BY sid, field, start_date")
+    return cursor.fetchall()
+
+
+class TestSidResolver:
+    def test_matches_lookup_sid(self):
+        metadata_df = pd.DataFrame({
+            'permaticker': [100, 200, 300, 400],
+            'category': ['Domestic', 'ADR', 'Domestic Primary', 'Domestic'],
+            'relatedtickers': ['OLD1 OLD2', 'OLD3', 'OLD3 OLD4', None],
+        }, index=['AAPL', 'GOOG', 'MSFT', 'IBM'])
+        related = ' ' + metadata_df['relatedtickers'].dropna().astype(str) + ' '
+        resolver = SidResolver(metadata_df, related)
+        for ticker in ['AAPL', 'IBM', 'OLD1', 'OLD2', 'OLD3', 'OLD4', 'NONE']:
+            assert resolver.lookup(ticker) == lookup_sid(metadata_df, related, ticker)
+
+    def test_map(self, metadata_df):
+        resolver = SidResolver(metadata_df)
+        sids = resolver.map(np.array(['MSFT', 'OLD', 'NONE', 'MSFT'], dtype=object))
+        assert sids.dtype == np.int64
+        assert list(sids) == [200, 100, -1, 200]
+        assert len(resolver.map([])) == 0
+
+    def test_related_ticker_is_not_a_pattern(self):
+        metadata_df = pd.DataFrame({'permaticker': [100], 'category': ['Domestic'], 'relatedtickers': ['BRK.B']},
+                                   index=['BRKB'])
+        resolver = SidResolver(metadata_df)
+        assert resolver.lookup('BRK.B') == 100
+        assert resolver.lookup('BRKXB') == -1
+
+
+class TestInsertFundamentals:
+    def test_melts_fields_with_dimension(self, cursor, metadata_df):
+        sf1_df = pd.DataFrame({
+            'ticker': ['AAPL', 'AAPL', 'OLD'],
+            'dimension': ['ARQ', 'MRQ', 'ARQ'],
+            'calendardate': pd.to_datetime(['2020-03-31'] * 3),
+            'datekey': pd.to_datetime(['2020-05-01', '2020-05-01', '2019-05-01']),
+            'reportperiod': pd.to_datetime(['2020-03-28'] * 3),
+            'lastupdated': pd.to_datetime(['2020-05-02'] * 3),
+            'revenue': [10.0, np.nan, 5.0],
+            'currency': ['USD', 'None', None],
+            'marketcap': [1.0, 2.0, 3.0],
+        })
+        insert_fundamentals(metadata_df, sf1_df, cursor, show_progress=False)
+
+        may_2020 = pd.Timestamp('2020-05-02').value
+        may_2019 = pd.Timestamp('2019-05-02').value
+        assert _rows(cursor) == [
+            (100, 'currency_arq', may_2020, -1, 'USD'),
+            (100, 'reportperiod_arq', may_2019, -1, '2020-03-28 00:00:00'),
+            (100, 'reportperiod_arq', may_2020, -1, '2020-03-28 00:00:00'),
+            (100, 'reportperiod_mrq', may_2020, -1, '2020-03-28 00:00:00'),
+        ]
+        assert _fundamentals(cursor) == [
+            (100, 'revenue_arq', may_2019, 5.0),
+            (100, 'revenue_arq', may_2020, 10.0),
+        ]
+        cursor.execute("SELECT k, sid, start_date, first_date, value FROM fundamentals_ttm ORDER BY k, start_date")
+        assert cursor.fetchall() == [(1, 100, may_2019, may_2019, 5.0), (1, 100, may_2020, may_2019, 15.0),
+                                     (2, 100, may_2019, may_2019, None), (2, 100, may_2020, may_2020, None)]
+
+
+class TestInsertDailyMetrics:
+    def test_skips_nan_values(self, cursor, metadata_df):
+        daily_df = pd.DataFrame({
+            'ticker': ['MSFT', 'MSFT'],
+            'date': pd.to_datetime(['2021-01-04', '2021-01-05']),
+            'lastupdated': pd.to_datetime(['2021-01-05', '2021-01-06']),
+            'marketcap': [1500.5, np.nan],
+            'pe': [30.0, 31.0],
+        })
+        insert_daily_metrics(metadata_df, daily_df, cursor, show_progress=False)
+
+        jan_4 = pd.Timestamp('2021-01-04').value
+        jan_5 = pd.Timestamp('2021-01-05').value
+        assert _rows(cursor) == []
+        assert _fundamentals(cursor) == [
+            (200, 'marketcap', jan_4, 1500.5),
+            (200, 'pe', jan_4, 30.0),
+            (200, 'pe', jan_5, 31.0),
+        ]
+
+
+class TestWriteSupplementaryMappings:
+    def test_replaces_and_rebuilds_indexes(self, cursor):
+        cursor.execute("CREATE INDEX ix_field ON equity_supplementary_mappings (field)")
+        df = pd.DataFrame({'sid': [1, 1], 'field': ['pe', 'pe'], 'start_date': [5, 5], 'value': ['1.0', '2.0']})
+        write_supplementary_mappings(df, cursor, batch_size=1, show_progress=False)
+
+        assert _rows(cursor) == [(1, 'pe', 5, -1, '2.0')]
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'ix_field'")
+        assert cursor.fetchall() == [('ix_field',)]
+
+    def test_incremental_write_keeps_indexes(self, cursor):
+        cursor.execute("CREATE INDEX ix_field ON equity_supplementary_mappings (field)")
+        df = pd.DataFrame({'sid': [1], 'field': ['pe'], 'start_date': [5], 'value': ['1.0']})
+        write_supplementary_mappings(df, cursor, show_progress=False)
+        statements = []
+        cursor.connection.set_trace_callback(statements.append)
+        write_supplementary_mappings(df.assign(start_date=6), cursor, show_progress=False)
+        cursor.connection.set_trace_callback(None)
+
+        assert len(_rows(cursor)) == 2
+        assert not any('ix_field' in statement for statement in statements)
+
+
+class TestWriteFundamentals:
+    def test_interns_fields_and_replaces(self, cursor):
+        df = pd.DataFrame({'sid': [1, 2, 1], 'field': ['pe', 'pe', 'pb'], 'start_date': [5, 5, 5],
+                           'value': [1.0, 2.0, 3.0]})
+        write_fundamentals(df, cursor, batch_size=1, show_progress=False)
+        write_fundamentals(df.assign(value=[4.0, 2.0, 3.0]), cursor, show_progress=False)
+
+        assert _fundamentals(cursor) == [(1, 'pb', 5, 3.0), (1, 'pe', 5, 4.0), (2, 'pe', 5, 2.0)]
+        cursor.execute("SELECT field FROM fundamental_fields ORDER BY field_id")
+        assert cursor.fetchall() == [('pe',), ('pb',)]
+
+
+class TestMigrateFundamentals:
+    def test_moves_the_numeric_fields_once(self, cursor):
+        cursor.executemany("INSERT INTO equity_supplementary_mappings VALUES (?, ?, ?, -1, ?)", [
+            (1, 'revenue_arq', 5, '10.0'),
+            (1, 'currency_arq', 5, 'USD'),
+            (1, 'reportperiod_arq', 5, '2020-03-28 00:00:00'),
+            (1, 'marketcap', 5, '1.5e-05'),
+            (1, 'siccode', 5, '3571.0'),
+            (1, 'sector', 5, 'Technology'),
+        ])
+        assert migrate_fundamentals(cursor) == 2
+        assert _fundamentals(cursor) == [(1, 'marketcap', 5, 1.5e-05), (1, 'revenue_arq', 5, 10.0)]
+        assert [r[1] for r in _rows(cursor)] == ['currency_arq', 'reportperiod_arq', 'sector', 'siccode']
+
+        cursor.execute("INSERT INTO equity_supplementary_mappings VALUES (2, 'revenue_arq', 5, -1, '1.0')")
+        assert migrate_fundamentals(cursor) == 0
@@ -0,0 +1,168 @@
+import os
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+import pytest
+from exchange_calendars import get_calendar
+from sqlalchemy import create_engine
+from zipline.assets import AssetDBWriter
+
+from sharadar.data.connection_pool import is_memory_uri
+from sharadar.data.in_memory import InMemoryBundle, InMemoryDatabase
+from sharadar.data.sharded_daily_pricing import shard_prices
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarWriter, SQLiteDailyBarReader, \
+    SQLiteDailyAdjustmentWriter
+from sharadar.pipeline import engine
+
+
+@pytest.fixture
+def bundle_dir(tmp_path):
+    directory = tmp_path / 'data' / 'sharadar' / 'latest'
+    directory.mkdir(parents=True)
+    calendar = get_calendar('XNYS', start=pd.Timestamp('2020-01-01'))
+    sessions = calendar.sessions_in_range('2020-01-02', '2020-03-31')
+    sids = [1, 2, 3]
+    index = pd.MultiIndex.from_product([sessions, sids], names=['date', 'sid'])
+    rng = np.random.default_rng(0)
+    prices = pd.DataFrame(rng.random((len(index), 5)) * 10 + 50, index=index,
+                          columns=['open', 'high', 'low', 'close', 'volume'])
+    SQLiteDailyBarWriter(str(directory / 'prices.sqlite'), calendar).write(prices)
+
+    equities = pd.DataFrame({'symbol': ['A', 'B', 'C'], 'start_date': sessions[0], 'end_date': sessions[-1],
+                             'exchange': 'NYSE'}, index=sids)
+    AssetDBWriter(create_engine('sqlite:///' + str(directory / 'assets-7.sqlite'))).write(
+        equities=equities, exchanges=pd.DataFrame({'exchange': ['NYSE'], 'country_code': ['US']}))
+
+    splits = pd.DataFrame({'effective_date': [sessions[30], sessions[40]], 'ratio': [0.5, 0.25], 'sid': [1, 3]})
+    SQLiteDailyAdjustmentWriter(str(directory / 'adjustments.sqlite'), None, None, None).write(splits=splits)
+    return directory
+
+
+@pytest.fixture
+def paths(bundle_dir):
+    return [str(bundle_dir / name) for name in ['prices.sqlite', 'assets-7.sqlite', 'adjustments.sqlite']]
+
+
+class TestInMemoryDatabase:
+    def test_copy_is_independent_of_the_file(self, paths, tmp_path):
+        database = InMemoryDatabase(paths[0])
+        assert is_memory_uri(database.uri)
+        os.remove(paths[0])
+        with closing(database.connect()) as con:
+            assert con.execute("SELECT COUNT(*) FROM prices").fetchone()[0] == 62 * 3
+        database.close()
+
+    def test_database_is_freed_on_close(self, paths):
+        database = InMemoryDatabase(paths[2])
+        database.close()
+        with closing(database.connect()) as con:
+            assert con.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0
+
+    def test_keep_sids(self, paths):
+        database = InMemoryDatabase(paths[2])
+        size = database.size_bytes
+        # the split of sid 3 and its adjustment factor
+        assert database.keep_sids([1]) == 2
+        database.vacuum()
+        with closing(database.connect()) as con:
+            assert con.execute("SELECT sid FROM splits").fetchall() == [(1,)]
+            assert con.execute("SELECT DISTINCT sid FROM adjustment_factors").fetchall() == [(1,)]
+        assert database.size_bytes <= size
+        database.close()
+
+
+class TestInMemoryBundle:
+    def test_readers_match_the_files(self, paths):
+        bundle = InMemoryBundle(*paths)
+        data = bundle.bundle_data()
+        start, end = pd.Timestamp('2020-01-02'), pd.Timestamp('2020-03-31')
+        expected = SQLiteDailyBarReader(paths[0]).load_raw_arrays(['close', 'volume'], start, end, [1, 2, 3])
+        actual = data.equity_daily_bar_reader.load_raw_arrays(['close', 'volume'], start, end, [1, 2, 3])
+        for a, b in zip(actual, expected):
+            np.testing.assert_array_equal(a, b)
+        assert data.asset_finder.retrieve_asset(2).symbol == 'B'
+        assert len(data.adjustment_reader.get_adjustments_for_sid('splits', 3)) == 1
+        assert bundle.load_time >= 0
+        assert bundle.size_bytes == sum(d.size_bytes for d in bundle.databases)
+        bundle.close()
+
+    def test_slice(self, paths):
+        full = InMemoryBundle(*paths)
+        bundle = InMemoryBundle(*paths, start='2020-02-03', end='2020-02-28', sids=[1, 3])
+        data = bundle.bundle_data()
+        reader = data.equity_daily_bar_reader
+        assert reader.first_trading_day == pd.Timestamp('2020-02-03')
+        assert reader.last_available_dt == pd.Timestamp('2020-02-28')
+        values = reader.get_values([1, 2, 3], pd.Timestamp('2020-02-10'), 'close')
+        assert np.isnan(values[1]) and not np.isnan(values[[0, 2]]).any()
+        assert sorted(a.sid for a in data.asset_finder.retrieve_all(data.asset_finder.sids)) == [1, 3]
+        assert bundle.size_bytes < full.size_bytes
+        bundle.close()
+        full.close()
+
+    def test_reader_answers_from_the_manifest(self, paths, monkeypatch):
+        bundle = InMemoryBundle(*paths, sids=[1, 3])
+        reader = bundle.bundle_data().equity_daily_bar_reader
+        queries = []
+        monkeypatch.setattr(reader, '_query', lambda sql, parameters=(): queries.append(sql))
+        assert reader.manifest.sids.tolist() == [1, 3]
+        assert reader.last_available_dt == pd.Timestamp('2020-03-31')
+        assert reader.trading_calendar.name == 'XNYS'
+        assert reader._exist_sid(3) and not reader._exist_sid(2)
+        assert queries == []
+        bundle.close()
+
+
+class TestLoadSharadarBundleInMemory:
+    def test_loads_once(self, bundle_dir, tmp_path):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        try:
+            first = engine.load_sharadar_bundle(environ=environ, in_memory=True, sids=[2, 1])
+            second = engine.load_sharadar_bundle(environ=environ, in_memory=True, sids=[1, 2])
+            assert len(engine._in_memory_bundles) == 1
+            assert first.equity_daily_bar_reader is not second.equity_daily_bar_reader
+            assert is_memory_uri(second.equity_daily_bar_reader._filename)
+            assert sorted(second.asset_finder.sids) == [1, 2]
+        finally:
+            engine.close_in_memory_bundles()
+        assert len(engine._in_memory_bundles) == 0
+
+    def test_new_ingest_replaces_the_copy(self, bundle_dir, tmp_path):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        day = pd.Timestamp('2020-03-31')
+        try:
+            first = engine.load_sharadar_bundle(environ=environ, in_memory=True)
+            assert first.equity_daily_bar_reader.get_value(1, day, 'close') != 1.0
+            corrected = pd.DataFrame({'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 1.0, 'volume': 1.0},
+                                     index=pd.MultiIndex.from_tuples([(day, 1)], names=['date', 'sid']))
+            calendar = get_calendar('XNYS', start=pd.Timestamp('2020-01-01'))
+            SQLiteDailyBarWriter(str(bundle_dir / 'prices.sqlite'), calendar).write(corrected)
+            second = engine.load_sharadar_bundle(environ=environ, in_memory=True)
+            assert second.equity_daily_bar_reader.get_value(1, day, 'close') == 1.0
+            assert len(engine._in_memory_bundles) == 1
+        finally:
+            engine.close_in_memory_bundles()
+
+    def test_copies_are_bounded(self, bundle_dir, tmp_path, monkeypatch):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        monkeypatch.setattr(engine, 'IN_MEMORY_BUNDLES_CACHE_SIZE', 2)
+        try:
+            for start in ['2020-01-02', '2020-02-03', '2020-01-02', '2020-03-02']:
+                engine.load_sharadar_bundle(environ=environ, in_memory=True, start=start)
+            assert [key[3] for key in engine._in_memory_bundles] == ['2020-01-02', '2020-03-02']
+        finally:
+            engine.close_in_memory_bundles()
+
+    def test_sharded_bundle_loads_the_shards(self, bundle_dir, tmp_path):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        prices = str(bundle_dir / 'prices.sqlite')
+        expected = SQLiteDailyBarReader(prices).get_values([1, 2, 3], pd.Timestamp('2020-03-31'), 'close')
+        shard_prices(prices)
+        os.remove(prices)
+        try:
+            data = engine.load_sharadar_bundle(environ=environ, in_memory=True)
+            np.testing.assert_array_equal(
+                data.equity_daily_bar_reader.get_values([1, 2, 3], pd.Timestamp('2020-03-31'), 'close'), expected)
+        finally:
+            engine.close_in_memory_bundles()
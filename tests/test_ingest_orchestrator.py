@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing
+import pandas as pd
+import pytest
+from exchange_calendars import get_calendar
+from sharadar.loaders.data_source import LocalDataSource
+from sharadar.loaders.ingest_orchestrator import IngestOrchestrator, IngestCheckpoint, Stage
+from sharadar.data.sql_lite_assets import SQLiteAssetFinder
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarReader
+from sharadar.loaders.ingest_sharadar import create_ingest_stages, _ingest
+
+
+class TestIngestOrchestrator:
+    def test_runs_in_dependency_order(self):
+        order = []
+
+        def stage(name, value):
+            def func(*inputs):
+                order.append(name)
+                return value + sum(inputs)
+            return func
+
+        stages = [Stage('c', stage('c', 100), ['a', 'b']), Stage('a', stage('a', 1)), Stage('b', stage('b', 10), ['a'])]
+        results = IngestOrchestrator(stages).run()
+        # the results of a and b are dropped once c is done
+        assert results == {'c': 112}
+        assert order == ['a', 'b', 'c']
+
+    def test_consumed_results_are_dropped(self, tmp_path):
+        checkpoint = IngestCheckpoint(str(tmp_path / 'checkpoints'), key='run')
+        completed = []
+
+        def write(df):
+            completed.append(checkpoint.completed())
+            return len(df)
+
+        stages = [Stage('download', lambda: [1, 2, 3]), Stage('write', write, ['download']),
+                  Stage('report', lambda df, n: n, ['download', 'write'])]
+        assert IngestOrchestrator(stages, checkpoint).run() == {'report': 3}
+        assert completed == [['download']]
+        assert checkpoint.completed() == ['report']
+
+    def test_independent_stages_run_concurrently(self):
+        # both stages must be running at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [Stage('sep', barrier.wait), Stage('sfp', barrier.wait)]
+        IngestOrchestrator(stages, max_workers=2).run()
+
+    def test_unknown_requirement(self):
+        with pytest.raises(ValueError):
+            IngestOrchestrator([Stage('a', lambda x: x, ['missing'])])
+
+    def test_resume_from_failed_stage(self, tmp_path):
+        calls = []
+
+        def download():
+            calls.append('download')
+            return 42
+
+        def fail(x):
+            raise IOError("disk full")
+
+        checkpoint = IngestCheckpoint(str(tmp_path / 'checkpoints'), key='run')
+        with pytest.raises(IOError):
+            IngestOrchestrator([Stage('download', download), Stage('write', fail, ['download'])], checkpoint).run()
+        assert checkpoint.completed() == ['download']
+
+        checkpoint = IngestCheckpoint(str(tmp_path / 'checkpoints'), key='run')
+        results = IngestOrchestrator([Stage('download', download), Stage('write', lambda x: x + 1, ['download'])],
+                                     checkpoint).run()
+        assert results['write'] == 43
+        assert calls == ['download']
+
+    def test_checkpoints_of_another_run_are_discarded(self, tmp_path):
+        directory = str(tmp_path / 'checkpoints')
+        IngestCheckpoint(directory, key='2021-01-04').save('download', 1)
+        assert IngestCheckpoint(directory, key='2021-01-04').completed() == ['download']
+        assert IngestCheckpoint(directory, key='2022-01-03').completed() == []
+
+
+@pytest.fixture
+def local_source(tmp_path):
+    directory = tmp_path / 'tables'
+    directory.mkdir()
+    dates = pd.bdate_range('2021-01-04', '2021-01-08')
+    pd.DataFrame({
+        'table': ['SEP', 'SFP'], 'permaticker': [101, 201], 'ticker': ['AAA', 'SPY'],
+        'name': ['Aaa Inc', 'SPDR S&P 500'], 'exchange': ['NASDAQ', 'NYSEARCA'],
+        'category': ['Domestic Common Stock', 'ETF'], 'relatedtickers': [None, None],
+        'firstpricedate': ['2021-01-04'] * 2, 'lastpricedate': ['2021-01-08'] * 2,
+    }).to_csv(directory / 'TICKERS.csv', index=False)
+    for table, ticker, price in (('SEP', 'AAA', 10.0), ('SFP', 'SPY', 300.0)):
+        pd.DataFrame({'ticker': ticker, 'date': dates, 'open': price, 'high': price, 'low': price, 'close': price,
+                      'volume': 1000.0, 'closeadj': price, 'closeunadj': price / 2, 'lastupdated': dates}) \
+            .to_csv(directory / (table + '.csv'), index=False)
+    pd.DataFrame({'ticker': ['AAA'] * 3, 'dimension': ['ARQ', 'ART', 'MRQ'], 'calendardate': ['2020-09-30'] * 3,
+                  'datekey': ['2021-01-05'] * 3, 'reportperiod': ['2020-09-30'] * 3,
+                  'lastupdated': ['2021-01-06'] * 3, 'revenue': [100.0, 400.0, 100.0]}) \
+        .to_csv(directory / 'SF1.csv', index=False)
+    pd.DataFrame({'ticker': 'AAA', 'date': dates, 'lastupdated': dates, 'marketcap': 4.0, 'pe': 6.0}) \
+        .to_csv(directory / 'DAILY.csv', index=False)
+    pd.DataFrame({'date': ['2021-01-06', '2021-01-07'], 'action': ['dividend', 'split'], 'ticker': ['AAA', 'SPY'],
+                  'name': ['Aaa Inc', 'SPDR S&P 500'], 'value': [0.5, 2.0], 'contraticker': [None, None],
+                  'contraname': [None, None]}).to_csv(directory / 'ACTIONS.csv', index=False)
+    return LocalDataSource(str(directory))
+
+
+class TestLocalDataSource:
+    def test_last_available_date(self, local_source):
+        assert local_source.last_available_date() == '2021-01-08'
+
+    def test_fetch_table_by_date(self, local_source):
+        df = local_source.fetch_table_by_date('SHARADAR/SEP', '2021-01-06', '2021-01-07')
+        assert list(df['date']) == [pd.Timestamp('2021-01-06'), pd.Timestamp('2021-01-07')]
+
+    def test_fetch_sf1_table_date(self, local_source):
+        df = local_source.fetch_sf1_table_date('2021-01-01')
+        assert sorted(df['dimension']) == ['ARQ', 'ART']
+
+
+class TestIngestStages:
+    def test_download_stages_offline(self, local_source, tmp_path):
+        calendar = get_calendar('XNYS', start=pd.Timestamp('2000-01-01'))
+        stages = create_ingest_stages('2021-01-04', calendar, str(tmp_path / 'bundle'), True, False, local_source)
+        names = ['params', 'metadata', 'sid_resolver', 'sep', 'sfp', 'sf1', 'daily', 'prices']
+        results = IngestOrchestrator([s for s in stages if s.name in names]).run()
+
+        prices_df = results['prices']
+        assert sorted(prices_df.index.get_level_values('sid').unique()) == [101, 201]
+        # unadjusted prices
+        assert prices_df.xs(101, level='sid')['close'].iloc[0] == 5.0
+        assert len(results['sf1']) == 3
+        assert len(results['daily']) == 5
+
+    def test_stage_graph(self, local_source, tmp_path):
+        calendar = get_calendar('XNYS', start=pd.Timestamp('2000-01-01'))
+        stages = create_ingest_stages('2021-01-04', calendar, str(tmp_path), True, True, local_source)
+        # validates the requirements
+        IngestOrchestrator(stages)
+        assert 'columnar_prices' in [s.name for s in stages]
+
+
+class TestIngestOffline:
+    def test_ingest_into_new_bundle(self, local_source, tmp_path):
+        calendar = get_calendar('XNYS', start=pd.Timestamp('2000-01-01'))
+        output_dir = str(tmp_path / 'bundle')
+        _ingest('2021-01-04', calendar, output_dir, sanity_check=False, source=local_source, resume=False)
+
+        assert os.path.exists(os.path.join(output_dir, 'ok'))
+        reader = SQLiteDailyBarReader(os.path.join(output_dir, 'prices.sqlite'))
+        assert reader.last_available_dt == pd.Timestamp('2021-01-08')
+        finder = SQLiteAssetFinder(os.path.join(output_dir, 'assets-7.sqlite'))
+        assert [e.symbol for e in finder.retrieve_all([101, 201])] == ['AAA', 'SPY']
+        assert finder.get_fundamentals([101], 'revenue_arq', pd.Timestamp('2021-01-06'))[0, 0] == 100.0
+        assert list(finder.get_info([101, 201], 'category', pd.Timestamp('2021-01-06'))[0]) == \
+            ['Domestic Common Stock', 'ETF']
+        with closing(sqlite3.connect(os.path.join(output_dir, 'adjustments.sqlite'))) as con:
+            assert con.execute("SELECT sid, ratio FROM splits").fetchall() == [(201, 0.5)]
+            assert con.execute("SELECT sid FROM dividends").fetchall() == [(101,)]
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+from exchange_calendars import get_calendar
+from sharadar.loaders.constant import METADATA_HEADERS
+from sharadar.loaders.ingest_sharadar import create_equities_df, synch_to_calendar
+
+
+@pytest.fixture
+def sessions():
+    return get_calendar('XNYS', start=pd.Timestamp('2000-01-01')).sessions_in_range('2021-01-04', '2021-01-15')
+
+
+@pytest.fixture
+def metadata_df():
+    return pd.DataFrame({
+        'permaticker': [101, 102, 103],
+        'name': ['Aaa Inc', 'Bbb Corp', 'Ccc Fund'],
+        'exchange': ['NASDAQ', None, 'NYSEAERCA'],
+        'firstpricedate': pd.to_datetime(['2010-01-04', '2015-06-01', '2021-01-04']),
+        'lastpricedate': pd.to_datetime(['2021-01-15', '2021-01-15', '2021-01-08']),
+    }, index=['AAA', 'BBB', 'CCC'])
+
+
+def _prices(rows):
+    df = pd.DataFrame(rows, columns=['date', 'sid', 'ticker'])
+    df['close'] = 1.0
+    return df.set_index(['date', 'sid']).sort_index()
+
+
+def _ohlcv(sid, ticker, dates, prices):
+    index = pd.MultiIndex.from_arrays([pd.DatetimeIndex(dates), [sid] * len(dates)], names=('date', 'sid'))
+    return pd.DataFrame({'ticker': ticker, 'open': prices, 'high': prices, 'low': prices, 'close': prices,
+                         'volume': 100.0}, index=index)
+
+
+class TestCreateEquitiesDf:
+    def test_metadata(self, sessions, metadata_df):
+        df = _prices([(d, sid, t) for d in sessions[:5] for sid, t in ((101, 'AAA'), (102, 'BBB'), (103, 'CCC'))])
+        equities_df = create_equities_df(df, df['ticker'].unique(), metadata_df)
+
+        assert list(equities_df.columns) == METADATA_HEADERS
+        assert list(equities_df.index) == [101, 102, 103]
+        assert list(equities_df['symbol']) == ['AAA', 'BBB', 'CCC']
+        assert list(equities_df['exchange']) == ['NASDAQ', 'OTC', 'NYSEARCA']
+        assert equities_df.loc[102, 'start_date'] == pd.Timestamp('2015-06-01')
+        assert equities_df.loc[103, 'auto_close_date'] == pd.Timestamp('2021-01-09')
+
+    def test_sid_with_several_tickers(self, sessions, metadata_df):
+        df = _prices([(sessions[0], 101, 'AAA'), (sessions[1], 101, 'AAA.OLD'), (sessions[0], 102, 'BBB')])
+        equities_df = create_equities_df(df, df['ticker'].unique(), metadata_df)
+
+        assert list(equities_df.index) == [101, 102]
+        assert list(equities_df['symbol']) == ['AAA.OLD', 'BBB']
+
+    def test_empty(self, sessions, metadata_df):
+        df = _prices([])
+        equities_df = create_equities_df(df, df['ticker'].unique(), metadata_df)
+        assert len(equities_df) == 0
+
+
+class TestSynchToCalendar:
+    def test_fills_interstitial_sessions(self, sessions):
+        df = pd.concat([_ohlcv(101, 'AAA', [sessions[0], sessions[3]], [1.0, 4.0]),
+                        _ohlcv(102, 'BBB', sessions[1:4], [2.0, 3.0, 4.0])]).sort_index()
+        synched, synthesized = synch_to_calendar(sessions, df)
+
+        aaa = synched.xs(101, level='sid')
+        assert list(aaa.index) == list(sessions[:4])
+        assert list(aaa['close']) == [1.0, 1.0, 1.0, 4.0]
+        assert list(aaa['volume']) == [100.0, 0.0, 0.0, 100.0]
+        assert (aaa['ticker'] == 'AAA').all()
+        assert len(synched.xs(102, level='sid')) == 3
+        assert synthesized.to_dict() == {101: 2}
+        assert synched.index.is_monotonic_increasing
+
+    def test_live_range_is_not_extended(self, sessions):
+        df = _ohlcv(101, 'AAA', sessions[2:4], [1.0, 2.0])
+        synched, synthesized = synch_to_calendar(sessions, df)
+        assert synched.equals(df)
+        assert len(synthesized) == 0
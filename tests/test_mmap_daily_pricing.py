@@ -0,0 +1,198 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from exchange_calendars import get_calendar
+from zipline.data.bar_reader import NoDataBeforeDate
+
+from sharadar.data.mmap_daily_pricing import MMapDailyBarWriter, MMapDailyBarReader
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarWriter, SQLiteDailyBarReader
+from sharadar.pipeline import engine
+
+
+@pytest.fixture
+def calendar():
+    return get_calendar('XNYS', start=pd.Timestamp('2020-01-01'))
+
+
+@pytest.fixture
+def rootdir(tmp_path):
+    return str(tmp_path / 'prices.mmap')
+
+
+@pytest.fixture
+def sample_data():
+    """Create sample OHLCV data as a MultiIndex DataFrame."""
+    dates = pd.to_datetime(['2020-01-02', '2020-01-03', '2020-01-06'])
+    sids = [1, 2]
+    index = pd.MultiIndex.from_product([dates, sids], names=['date', 'sid'])
+    data = pd.DataFrame({
+        'open':   [10.0, 20.0, 11.0, 21.0, 12.0, 22.0],
+        'high':   [15.0, 25.0, 16.0, 26.0, 17.0, 27.0],
+        'low':    [9.0,  19.0, 10.0, 20.0, 11.0, 21.0],
+        'close':  [14.0, 24.0, 15.0, 25.0, 16.0, 26.0],
+        'volume': [100.0, 200.0, 110.0, 210.0, 120.0, 220.0],
+    }, index=index)
+    return data
+
+
+@pytest.fixture
+def reader(rootdir, calendar, sample_data):
+    MMapDailyBarWriter(rootdir, calendar).write(sample_data)
+    return MMapDailyBarReader(rootdir)
+
+
+class TestMMapDailyBarWriter:
+    def test_write_validates_dataframe(self, rootdir, calendar):
+        with pytest.raises(ValueError, match="data must be an instance of DataFrame"):
+            MMapDailyBarWriter(rootdir, calendar).write("not a dataframe")
+
+    def test_incremental_write_merges_and_replaces(self, rootdir, calendar, sample_data):
+        writer = MMapDailyBarWriter(rootdir, calendar)
+        writer.write(sample_data)
+        index = pd.MultiIndex.from_tuples([(pd.Timestamp('2020-01-06'), 1), (pd.Timestamp('2020-01-07'), 3)],
+                                          names=['date', 'sid'])
+        update = pd.DataFrame({'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': 99.0, 'volume': 5.0}, index=index)
+        writer.write(update)
+
+        reader = MMapDailyBarReader(rootdir)
+        assert reader.last_available_dt == pd.Timestamp('2020-01-07')
+        assert reader.get_value(1, pd.Timestamp('2020-01-06'), 'close') == 99.0
+        assert reader.get_value(2, pd.Timestamp('2020-01-06'), 'close') == 26.0
+        assert reader.get_value(3, pd.Timestamp('2020-01-07'), 'volume') == 5.0
+
+    def test_write_from_sqlite(self, tmp_path, rootdir, calendar, sample_data):
+        db_path = str(tmp_path / 'prices.sqlite')
+        SQLiteDailyBarWriter(db_path, calendar).write(sample_data)
+        MMapDailyBarWriter(rootdir, calendar).write_from_sqlite(db_path)
+        reader = MMapDailyBarReader(rootdir)
+        assert reader.get_value(2, pd.Timestamp('2020-01-03'), 'open') == 21.0
+        assert len(reader.sessions) == 3
+
+    def test_write_from_sqlite_databases_in_chunks(self, tmp_path, rootdir, calendar, sample_data):
+        dates = sample_data.index.get_level_values('date')
+        paths = [str(tmp_path / 'prices-1.sqlite'), str(tmp_path / 'prices-2.sqlite')]
+        SQLiteDailyBarWriter(paths[0], calendar).write(sample_data[dates < '2020-01-06'])
+        SQLiteDailyBarWriter(paths[1], calendar).write(sample_data[dates == '2020-01-06'])
+        MMapDailyBarWriter(rootdir, calendar).write(sample_data.iloc[:1] * 0)
+        MMapDailyBarWriter(rootdir, calendar).write_from_sqlite(paths, chunksize=1)
+
+        other = str(tmp_path / 'other.mmap')
+        MMapDailyBarWriter(other, calendar).write(sample_data)
+        start, end = pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-06')
+        for a, b in zip(MMapDailyBarReader(rootdir).load_raw_arrays(['open', 'volume'], start, end, [1, 2]),
+                        MMapDailyBarReader(other).load_raw_arrays(['open', 'volume'], start, end, [1, 2])):
+            np.testing.assert_array_equal(a, b)
+
+    def _lattices(self, rootdir):
+        return sorted(name for name in os.listdir(rootdir) if name.startswith('lattice-'))
+
+    def _bars(self, sample_data, day, sids):
+        index = pd.MultiIndex.from_product([[pd.Timestamp(day)], sids], names=['date', 'sid'])
+        return pd.DataFrame(sample_data.iloc[:len(sids)].values, index=index, columns=sample_data.columns)
+
+    def test_new_sessions_are_appended_in_place(self, rootdir, calendar, sample_data):
+        writer = MMapDailyBarWriter(rootdir, calendar)
+        writer.write(sample_data)
+        lattices = self._lattices(rootdir)
+        # 2020-01-07 is not written
+        writer.write(self._bars(sample_data, '2020-01-08', [2]))
+        assert self._lattices(rootdir) == lattices
+        reader = MMapDailyBarReader(rootdir)
+        assert reader.last_session == pd.Timestamp('2020-01-08')
+        close, volume = reader.load_raw_arrays(['close', 'volume'], pd.Timestamp('2020-01-06'),
+                                               pd.Timestamp('2020-01-08'), [1, 2])
+        np.testing.assert_array_equal(close, [[16.0, 26.0], [np.nan, np.nan], [np.nan, 14.0]])
+        np.testing.assert_array_equal(volume, [[120, 220], [0, 0], [0, 100]])
+
+    def test_new_sids_rebuild_the_store(self, tmp_path, rootdir, calendar, sample_data):
+        writer = MMapDailyBarWriter(rootdir, calendar)
+        writer.write(sample_data)
+        reader = MMapDailyBarReader(rootdir)
+        assert reader.get_value(1, pd.Timestamp('2020-01-02'), 'close') == 14.0
+        writer.write(self._bars(sample_data * 2, '2020-01-02', [1, 3]))
+        # the open reader keeps the files of its store
+        assert reader.get_value(1, pd.Timestamp('2020-01-02'), 'close') == 14.0
+        assert MMapDailyBarReader(rootdir).get_value(1, pd.Timestamp('2020-01-02'), 'close') == 28.0
+        assert MMapDailyBarReader(rootdir).get_value(3, pd.Timestamp('2020-01-02'), 'close') == 48.0
+        assert MMapDailyBarReader(rootdir).last_session == pd.Timestamp('2020-01-06')
+        writer.write(self._bars(sample_data, '2020-01-02', [4]))
+        # the current lattice and the previous one
+        assert len(self._lattices(rootdir)) == 2
+        assert os.listdir(str(tmp_path)) == ['prices.mmap']
+
+
+class TestMMapDailyBarReader:
+    def test_get_value(self, reader):
+        assert reader.get_value(1, pd.Timestamp('2020-01-02'), 'close') == 14.0
+        assert reader.get_value(2, pd.Timestamp('2020-01-03'), 'volume') == 210.0
+
+    def test_get_value_nonexistent_sid_raises_key_error(self, reader):
+        with pytest.raises(KeyError):
+            reader.get_value(999, pd.Timestamp('2020-01-02'), 'close')
+
+    def test_get_value_no_data_before_date(self, reader):
+        with pytest.raises(NoDataBeforeDate):
+            reader.get_value(1, pd.Timestamp('2019-01-01'), 'close')
+
+    def test_load_raw_arrays_contiguous_is_view(self, reader):
+        arrays = reader.load_raw_arrays(['open', 'close'], pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-06'),
+                                        [1, 2])
+        assert arrays[0].shape == (3, 2)
+        assert arrays[0][0, 0] == 10.0
+        assert arrays[1][2, 1] == 26.0
+        assert isinstance(arrays[1].base, np.memmap) or isinstance(arrays[1], np.memmap)
+
+    def test_load_raw_arrays_missing_sid_and_sessions(self, reader):
+        arrays = reader.load_raw_arrays(['close', 'volume'], pd.Timestamp('2020-01-03'), pd.Timestamp('2020-01-08'),
+                                        [2, 999])
+        close, volume = arrays
+        assert close.shape == (4, 2)
+        assert close[0, 0] == 25.0
+        assert np.all(np.isnan(close[:, 1]))
+        assert np.all(np.isnan(close[2:, 0]))
+        assert np.all(volume[:, 1] == 0)
+
+    def test_get_last_traded_dt(self, reader):
+        assert reader.get_last_traded_dt(1, pd.Timestamp('2020-01-02')) == pd.Timestamp('2020-01-02')
+        assert reader.get_last_traded_dt(1, pd.Timestamp('2020-01-08')) == pd.Timestamp('2020-01-06')
+        assert reader.get_last_traded_dt(1, pd.Timestamp('2019-12-31')) is pd.NaT
+        with pytest.raises(KeyError):
+            reader.get_last_traded_dt(999, pd.Timestamp('2020-01-02'))
+
+    def test_calendar_and_sessions(self, reader):
+        assert reader.trading_calendar.name == 'XNYS'
+        assert reader.first_trading_day == pd.Timestamp('2020-01-02')
+        assert reader.last_available_dt == pd.Timestamp('2020-01-06')
+        assert len(reader.sessions) == 3
+
+
+class TestDailyBarReaderRouting:
+    def test_stale_store_is_not_used(self, tmp_path, calendar, sample_data):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        bundle_dir = tmp_path / 'data' / 'sharadar' / 'latest'
+        bundle_dir.mkdir(parents=True)
+        dates = sample_data.index.get_level_values('date')
+        prices = SQLiteDailyBarWriter(str(bundle_dir / 'prices.sqlite'), calendar)
+        prices.write(sample_data[dates < '2020-01-06'])
+        MMapDailyBarWriter(str(bundle_dir / 'prices.mmap'), calendar).write(sample_data[dates < '2020-01-06'])
+        reader = engine.daily_bar_reader('sharadar', 'latest', environ=environ)
+        assert isinstance(engine.pipeline_bar_reader(reader, 'sharadar', 'latest', environ=environ),
+                          MMapDailyBarReader)
+        # an ingest without the columnar prices
+        prices.write(sample_data[dates == '2020-01-06'])
+        reader = engine.daily_bar_reader('sharadar', 'latest', environ=environ)
+        assert engine.pipeline_bar_reader(reader, 'sharadar', 'latest', environ=environ) is reader
+        assert reader.last_available_dt == pd.Timestamp('2020-01-06')
+
+    def test_data_portal_reads_float64_prices(self, tmp_path, calendar, sample_data):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        bundle_dir = tmp_path / 'data' / 'sharadar' / 'latest'
+        bundle_dir.mkdir(parents=True)
+        sample_data['close'] = 123.45
+        SQLiteDailyBarWriter(str(bundle_dir / 'prices.sqlite'), calendar).write(sample_data)
+        MMapDailyBarWriter(str(bundle_dir / 'prices.mmap'), calendar).write(sample_data)
+        reader = engine.daily_bar_reader('sharadar', 'latest', environ=environ)
+        assert isinstance(reader, SQLiteDailyBarReader)
+        assert reader.get_value(1, pd.Timestamp('2020-01-03'), 'close') == 123.45
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from sharadar.data.point_in_time import PointInTimeArrays, CategoricalIntervals
+
+
+def _pit():
+    # sid 1: three quarters, sid 2: one quarter, sid 3: no data
+    sid_values = [1, 1, 1, 2]
+    dates = pd.to_datetime(['2020-05-01', '2020-02-01', '2020-08-01', '2020-03-01'])
+    values = [20.0, 10.0, 30.0, 5.0]
+    return PointInTimeArrays([1, 2, 3], sid_values, dates.values.view(np.int64), values)
+
+
+class TestPointInTimeArrays:
+    def test_len(self):
+        assert len(_pit()) == 4
+
+    def test_latest_values(self):
+        values = _pit().latest_values(pd.Timestamp('2020-06-01'))
+        np.testing.assert_array_equal(values, [20.0, 5.0, np.nan])
+
+    def test_nth_latest_values(self):
+        values = _pit().latest_values(pd.Timestamp('2020-09-01'), n=3)
+        np.testing.assert_array_equal(values, [10.0, np.nan, np.nan])
+
+    def test_latest_values_max_age(self):
+        max_age = pd.Timedelta(days=60).value
+        values = _pit().latest_values(pd.Timestamp('2020-06-01'), max_age=max_age)
+        np.testing.assert_array_equal(values, [20.0, np.nan, np.nan])
+
+    def test_latest_dates(self):
+        dates = _pit().latest_dates(pd.Timestamp('2020-06-01'))
+        assert dates[0] == pd.Timestamp('2020-05-01').value
+        assert np.isnan(dates[2])
+
+    def test_sum_latest_values(self):
+        values = _pit().sum_latest_values(pd.Timestamp('2020-09-01'), 1, 4)
+        np.testing.assert_array_equal(values, [60.0, 5.0, np.nan])
+
+    def test_sum_latest_values_counts_the_records_once(self, monkeypatch):
+        pit = _pit()
+        calls = []
+        available = pit._available
+        monkeypatch.setattr(pit, '_available', lambda day: calls.append(day) or available(day))
+        pit.sum_latest_values(pd.Timestamp('2020-09-01'), 1, 4)
+        assert len(calls) == 1
+
+    def test_window_values(self):
+        window = _pit().window_values(pd.Timestamp('2020-09-01'), 2, min_date=pd.Timestamp('2020-04-01'))
+        assert window.shape == (2, 3)
+        np.testing.assert_array_equal(window[:, 0], [30.0, 20.0])
+        assert np.isnan(window[:, 1]).all()
+
+    def test_from_frame_coerces_values(self):
+        df = pd.DataFrame({'sid': [1, 1], 'start_date': [1, 2], 'value': ['1.5', 'None']})
+        pit = PointInTimeArrays.from_frame([1], df)
+        assert np.isnan(pit.latest_values(pd.Timestamp(3)))[0]
+        assert pit.latest_values(pd.Timestamp(3), n=2)[0] == 1.5
+
+
+def _intervals():
+    # sid 1 changes sector once, sid 2 has an unknown value, sid 3 no data
+    sid_values = [1, 1, 1, 2, 9]
+    dates = pd.to_datetime(['2020-01-01', '2020-04-01', '2020-02-01', '2020-03-01', '2020-01-01'])
+    values = ['Energy', 'Technology', 'Energy', 'Bogus', 'Energy']
+    return CategoricalIntervals([1, 2, 3], sid_values, dates.values.view(np.int64), values,
+                                categories=['Energy', 'Technology'])
+
+
+class TestCategoricalIntervals:
+    def test_merges_equal_values(self):
+        intervals = _intervals()
+        assert len(intervals) == 3
+        assert list(intervals.categories) == ['Energy', 'Technology', 'NA']
+        assert intervals.ends[0] == pd.Timestamp('2020-04-01').value
+
+    def test_label_array(self):
+        dates = pd.to_datetime(['2019-12-31', '2020-01-01', '2020-03-31', '2020-04-01', '2021-01-04'])
+        labels = _intervals().label_array(dates)
+        assert labels.shape == (5, 3)
+        np.testing.assert_array_equal(labels.as_string_array(), [['NA', 'NA', 'NA'],
+                                                                 ['Energy', 'NA', 'NA'],
+                                                                 ['Energy', 'NA', 'NA'],
+                                                                 ['Technology', 'NA', 'NA'],
+                                                                 ['Technology', 'NA', 'NA']])
+
+    def test_categories_of_the_values(self):
+        intervals = CategoricalIntervals([1], [1], [0], ['ADR'])
+        assert list(intervals.categories) == ['ADR', 'NA']
+        assert intervals.label_array(pd.to_datetime(['2020-01-01']).values).as_string_array()[0, 0] == 'ADR'
@@ -0,0 +1,175 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from exchange_calendars import get_calendar
+from zipline.data.bar_reader import NoDataBeforeDate
+
+from sharadar.data.in_memory import InMemoryDatabase, slice_prices
+from sharadar.data.prices_manifest import change_counter
+from sharadar.data.sharded_daily_pricing import ShardedDailyBarReader, ShardedDailyBarWriter, shard_prices, \
+    shard_path, shard_years
+from sharadar.data.sql_lite_daily_pricing import SQLiteDailyBarWriter, SQLiteDailyBarReader
+from sharadar.pipeline import engine
+
+
+@pytest.fixture
+def calendar():
+    return get_calendar('XNYS', start=pd.Timestamp('2019-01-01'))
+
+
+@pytest.fixture
+def prices(calendar):
+    sessions = calendar.sessions_in_range('2019-12-02', '2021-01-29')
+    index = pd.MultiIndex.from_product([sessions, [1, 2, 3]], names=['date', 'sid'])
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.random((len(index), 5)) * 10 + 50, index=index,
+                      columns=['open', 'high', 'low', 'close', 'volume'])
+    # sid 3 stops trading in 2020, sid 2 does not trade on the first session of 2020
+    dates = df.index.get_level_values('date')
+    sids = df.index.get_level_values('sid')
+    return df[~((sids == 3) & (dates > pd.Timestamp('2020-06-30'))) &
+              ~((sids == 2) & (dates == pd.Timestamp('2020-01-02')))]
+
+
+@pytest.fixture(params=[1, 2])
+def source(request, tmp_path, calendar, prices):
+    filename = str(tmp_path / 'prices.sqlite')
+    SQLiteDailyBarWriter(filename, calendar, schema_version=request.param).write(prices)
+    return filename
+
+
+@pytest.fixture
+def readers(source):
+    return SQLiteDailyBarReader(source), ShardedDailyBarReader(shard_prices(source))
+
+
+class TestShardPrices:
+    def test_one_shard_per_year(self, source, tmp_path):
+        directory = shard_prices(source)
+        assert directory == str(tmp_path / 'prices.shards')
+        assert shard_years(directory) == [2019, 2020, 2021]
+        assert SQLiteDailyBarReader(shard_path(directory, 2021)).schema_version == 2
+        with pytest.raises(ValueError):
+            shard_prices(source)
+
+
+class TestShardedDailyBarReader:
+    def test_properties(self, readers):
+        expected, actual = readers
+        assert actual.first_trading_day == expected.first_trading_day
+        assert actual.last_available_dt == expected.last_available_dt
+        assert actual.trading_calendar.name == 'XNYS'
+        assert actual.sessions.equals(expected.sessions)
+
+    @pytest.mark.parametrize('start, end', [
+        ('2019-12-02', '2021-01-29'),
+        ('2019-12-20', '2020-01-10'),
+        ('2020-03-02', '2020-03-31'),
+    ])
+    def test_load_raw_arrays(self, readers, start, end):
+        expected, actual = readers
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        for a, b in zip(actual.load_raw_arrays(['close', 'volume'], start, end, [3, 1, 2]),
+                        expected.load_raw_arrays(['close', 'volume'], start, end, [3, 1, 2])):
+            np.testing.assert_array_equal(a, b)
+
+    def test_get_value(self, readers):
+        expected, actual = readers
+        day = pd.Timestamp('2020-01-03')
+        assert actual.get_value(2, day, 'close') == expected.get_value(2, day, 'close')
+        with pytest.raises(NoDataBeforeDate):
+            actual.get_value(2, pd.Timestamp('2020-01-02'), 'close')
+        # sid 3 has no price in the shard of 2021
+        with pytest.raises(NoDataBeforeDate):
+            actual.get_value(3, pd.Timestamp('2021-01-04'), 'close')
+        with pytest.raises(KeyError):
+            actual.get_value(4, day, 'close')
+        with pytest.raises(ValueError):
+            actual.get_value(1, day, 'sid')
+
+    def test_get_value_miss_reads_the_other_shards_once(self, readers, monkeypatch):
+        _, actual = readers
+        calls = []
+        exist_sid = SQLiteDailyBarReader._exist_sid
+        monkeypatch.setattr(SQLiteDailyBarReader, '_exist_sid',
+                            lambda self, sid: calls.append(self._filename) or exist_sid(self, sid))
+        day = pd.Timestamp('2020-01-03')
+        with pytest.raises(KeyError):
+            actual.get_value(4, day, 'close')
+        del calls[:]
+        for _ in range(3):
+            with pytest.raises(KeyError):
+                actual.get_value(4, day, 'close')
+        # the shard of the day and the last shard, which can still be written
+        assert sorted(set(calls)) == sorted({actual._shard(2020)._filename, actual._shard(2021)._filename})
+        assert len(calls) == 6
+
+    def test_get_values(self, readers):
+        expected, actual = readers
+        day = pd.Timestamp('2021-01-04')
+        np.testing.assert_array_equal(actual.get_values([1, 2, 3], day, 'open'),
+                                      expected.get_values([1, 2, 3], day, 'open'))
+        assert np.isnan(actual.get_values([1], pd.Timestamp('2022-01-03'), 'open')).all()
+
+    def test_get_previous_values_across_years(self, readers):
+        expected, actual = readers
+        sids = [1, 2, 1, 3, 3]
+        dts = pd.to_datetime(['2020-01-02', '2020-01-03', '2021-01-04', '2020-03-02', '2021-01-04'])
+        np.testing.assert_array_equal(actual.get_previous_values(sids, dts, 'close'),
+                                      expected.get_previous_values(sids, dts, 'close'))
+        assert not np.isnan(actual.get_previous_values([1], dts[:1], 'close')).any()
+
+    def test_get_last_traded_dt(self, readers):
+        expected, actual = readers
+        for sid, day in [(1, '2021-01-15'), (3, '2021-01-15'), (2, '2020-01-02'), (1, '2019-11-29')]:
+            day = pd.Timestamp(day)
+            a, b = actual.get_last_traded_dt(sid, day), expected.get_last_traded_dt(sid, day)
+            assert (a is pd.NaT and b is pd.NaT) or a == b
+        assert actual.get_last_traded_dt(3, pd.Timestamp('2021-01-15')) == pd.Timestamp('2020-06-30')
+        with pytest.raises(KeyError):
+            actual.get_last_traded_dt(4, pd.Timestamp('2021-01-15'))
+
+
+class TestShardedDailyBarWriter:
+    def test_writes_only_the_years_of_the_rows(self, tmp_path, calendar, prices):
+        directory = str(tmp_path / 'prices.shards')
+        writer = ShardedDailyBarWriter(directory, calendar)
+        writer.write(prices)
+        counter = change_counter(shard_path(directory, 2019))
+
+        new_day = pd.Timestamp('2021-02-01')
+        update = pd.DataFrame([[1.0, 2.0, 0.5, 1.5, 100.0]], columns=['open', 'high', 'low', 'close', 'volume'],
+                              index=pd.MultiIndex.from_tuples([(new_day, 1)], names=['date', 'sid']))
+        writer.write(update)
+        assert change_counter(shard_path(directory, 2019)) == counter
+        reader = ShardedDailyBarReader(directory, immutable=True)
+        assert reader.last_available_dt == new_day
+        assert reader.get_value(1, new_day, 'close') == 1.5
+
+
+class TestInMemoryShards:
+    def test_merges_the_shards_of_the_dates(self, source):
+        start, end = pd.Timestamp('2020-06-01'), pd.Timestamp('2021-01-29')
+        database = InMemoryDatabase.from_shards(shard_prices(source), start)
+        slice_prices(database, start)
+        reader = SQLiteDailyBarReader(database.uri)
+        assert (reader.first_trading_day, reader.last_available_dt) == (start, end)
+        for a, b in zip(reader.load_raw_arrays(['close', 'volume'], start, end, [1, 2, 3]),
+                        SQLiteDailyBarReader(source).load_raw_arrays(['close', 'volume'], start, end, [1, 2, 3])):
+            np.testing.assert_array_equal(a, b)
+        database.close()
+        with pytest.raises(ValueError):
+            InMemoryDatabase.from_shards(os.path.dirname(source) + '/prices.shards', '2022-01-03')
+
+
+class TestDailyBarReaderRouting:
+    def test_uses_shards(self, tmp_path, source):
+        environ = {'ZIPLINE_ROOT': str(tmp_path)}
+        bundle_dir = os.path.join(str(tmp_path), 'data', 'sharadar', 'latest')
+        os.makedirs(bundle_dir)
+        os.rename(source, os.path.join(bundle_dir, 'prices.sqlite'))
+        assert isinstance(engine.daily_bar_reader('sharadar', 'latest', environ=environ), SQLiteDailyBarReader)
+        shard_prices(os.path.join(bundle_dir, 'prices.sqlite'))
+        assert isinstance(engine.daily_bar_reader('sharadar', 'latest', environ=environ), ShardedDailyBarReader)
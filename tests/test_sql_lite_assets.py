@@ -1,7 +1,11 @@
+import numpy as np
 import pytest
 import pandas as pd
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.exc import OperationalError
+from zipline.assets.asset_db_schema import ASSET_DB_VERSION, metadata as asset_metadata
 from sharadar.data.sql_lite_assets import SQLiteAssetDBWriter, SQLiteAssetFinder
+from sharadar.util.equity_supplementary_util import migrate_fundamentals, write_fundamentals_ttm
 
 
 @pytest.fixture
@@ -37,6 +41,238 @@ class TestSQLiteAssetFinder:
         assert 'ROW_NUMBER' in sql
 
 
+@pytest.fixture
+def fundamentals_finder(asset_finder):
+    quarters = pd.date_range('2019-01-15', periods=8, freq='3MS')
+    rows = []
+    for sid in (1, 2):
+        for i, date in enumerate(quarters):
+            rows.append((sid, 'revenue_arq', date.value, str(float(sid * 100 + i))))
+    with asset_finder.engine.connect() as conn:
+        conn.execute(text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                          "VALUES (:sid, :field, :start_date, -1, :value)"),
+                     [dict(sid=r[0], field=r[1], start_date=r[2], value=r[3]) for r in rows])
+        conn.commit()
+    return asset_finder
+
+
+@pytest.fixture
+def file_finder(tmp_path):
+    # a database file, whose change counter is read by the finder
+    engine = create_engine('sqlite:///' + str(tmp_path / 'assets.sqlite'))
+    asset_metadata.create_all(engine)
+    with engine.connect() as conn:
+        conn.execute(asset_metadata.tables['version_info'].insert().values(version=ASSET_DB_VERSION))
+        conn.commit()
+    return SQLiteAssetFinder(engine)
+
+
+class TestPointInTimeCache:
+    def _both(self, finder, method, *args, **kwargs):
+        cached = getattr(finder, method)(*args, **kwargs)
+        finder.point_in_time_cache_size = 0
+        uncached = getattr(finder, method)(*args, **kwargs)
+        finder.point_in_time_cache_size = 32
+        return np.asarray(cached, dtype=float), np.asarray(uncached, dtype=float)
+
+    def test_get_fundamentals_matches_sql(self, fundamentals_finder):
+        for n in (1, 2):
+            cached, uncached = self._both(fundamentals_finder, 'get_fundamentals', [1, 2, 3], 'revenue_arq',
+                                          pd.Timestamp('2020-06-01'), n=n)
+            np.testing.assert_array_equal(cached, uncached)
+
+    def test_get_fundamentals_ttm_matches_sql(self, fundamentals_finder):
+        cached, uncached = self._both(fundamentals_finder, 'get_fundamentals_ttm', [1, 2, 3], 'revenue',
+                                      pd.Timestamp('2020-12-01'), k=1)
+        np.testing.assert_array_equal(cached, uncached)
+
+    def test_get_datekey_matches_sql(self, fundamentals_finder):
+        cached, uncached = self._both(fundamentals_finder, 'get_datekey', [1, 2], pd.Timestamp('2020-06-01'), 1)
+        np.testing.assert_array_equal(cached, uncached)
+
+    def test_window_matches_sql(self, fundamentals_finder):
+        # 6 quarters are filed by 2020-06-01, none by 2018-06-01, and sid 3 has none
+        for day, window_length in [(pd.Timestamp('2020-06-01'), 2), (pd.Timestamp('2020-06-01'), 10),
+                                   (pd.Timestamp('2018-06-01'), 4)]:
+            cached, uncached = self._both(fundamentals_finder, 'get_fundamentals_df_window_length', [1, 2, 3],
+                                          'revenue_arq', day, window_length)
+            assert uncached.shape == (window_length, 3)
+            np.testing.assert_array_equal(cached, uncached)
+
+    def test_history_is_loaded_once(self, fundamentals_finder):
+        for day in pd.date_range('2020-01-01', periods=5):
+            fundamentals_finder.get_fundamentals([1, 2], 'revenue_arq', day)
+        assert len(fundamentals_finder._point_in_time_cache) == 1
+
+    def test_cache_bypassed_in_live_trading(self, fundamentals_finder):
+        fundamentals_finder.is_live_trading = True
+        fundamentals_finder.get_fundamentals([1, 2], 'revenue_arq', pd.Timestamp('2020-06-01'))
+        assert len(fundamentals_finder._point_in_time_cache) == 0
+
+    def test_cache_is_keyed_on_the_sids(self, fundamentals_finder):
+        day = pd.Timestamp('2020-06-01')
+        fundamentals_finder.get_fundamentals([1, 2], 'revenue_arq', day)
+        values = fundamentals_finder.get_fundamentals([2, 1], 'revenue_arq', day)
+        assert [key[1] for key in fundamentals_finder._point_in_time_cache] == [
+            np.array([1, 2], dtype=np.int64).tobytes(), np.array([2, 1], dtype=np.int64).tobytes()]
+        np.testing.assert_array_equal(values, [[205.0, 105.0]])
+
+    def test_cache_is_dropped_when_the_database_changes(self, file_finder):
+        engine = file_finder.engine
+        finder = file_finder
+        insert = text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                      "VALUES (1, 'revenue_arq', :start_date, -1, :value)")
+        with engine.connect() as conn:
+            conn.execute(insert, dict(start_date=pd.Timestamp('2020-01-15').value, value='1.0'))
+            conn.commit()
+        day = pd.Timestamp('2020-06-01')
+        np.testing.assert_array_equal(finder.get_fundamentals([1], 'revenue_arq', day), [[1.0]])
+
+        with engine.connect() as conn:
+            conn.execute(insert, dict(start_date=pd.Timestamp('2020-04-15').value, value='2.0'))
+            conn.commit()
+        np.testing.assert_array_equal(finder.get_fundamentals([1], 'revenue_arq', day), [[2.0]])
+
+
+class TestFieldIds:
+    def _count_lookups(self, finder):
+        statements = []
+        event.listen(finder.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        return lambda: len([x for x in statements if 'fundamental_fields' in x])
+
+    def test_missing_fields_are_looked_up_once(self, fundamentals_finder):
+        with fundamentals_finder.engine.begin() as conn:
+            migrate_fundamentals(conn.connection.cursor())
+        lookups = self._count_lookups(fundamentals_finder)
+        for _ in range(3):
+            assert fundamentals_finder._field_id('revenue_arq') is not None
+            assert fundamentals_finder._field_id('sector') is None
+            assert fundamentals_finder._field_id('category') is None
+        assert lookups() == 3
+
+    def test_missing_fields_are_reloaded_when_the_database_changes(self, file_finder):
+        assert file_finder._field_id('revenue_arq') is None
+        with file_finder.engine.begin() as conn:
+            conn.execute(text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                              "VALUES (1, 'revenue_arq', 0, -1, '1.0')"))
+            migrate_fundamentals(conn.connection.cursor())
+        assert file_finder._field_id('revenue_arq') is not None
+
+
+class TestNumericFundamentals:
+    def _results(self, finder):
+        day = pd.Timestamp('2020-06-01')
+        return [finder.get_fundamentals([1, 2, 3], 'revenue_arq', day, n=2),
+                finder.get_fundamentals_ttm([1, 2, 3], 'revenue', pd.Timestamp('2020-12-01'), k=1),
+                finder.get_fundamentals_df_window_length([1, 2], 'revenue_arq', day, window_length=2),
+                finder.get_datekey([1, 2], day, 1),
+                [finder.last_available_fundamentals_dt.value]]
+
+    def test_matches_supplementary_mappings(self, fundamentals_finder):
+        fundamentals_finder.point_in_time_cache_size = 0
+        expected = self._results(fundamentals_finder)
+        with fundamentals_finder.engine.begin() as conn:
+            assert migrate_fundamentals(conn.connection.cursor()) == 16
+        finder = SQLiteAssetFinder(fundamentals_finder.engine)
+        finder.point_in_time_cache_size = 0
+        assert finder._field_source('revenue_arq')[0] == 'fundamentals'
+        for actual, values in zip(self._results(finder), expected):
+            np.testing.assert_array_equal(np.asarray(actual, dtype=float), np.asarray(values, dtype=float))
+
+    def test_text_fields_stay_in_supplementary_mappings(self, fundamentals_finder):
+        with fundamentals_finder.engine.begin() as conn:
+            conn.execute(text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                              "VALUES (1, 'sector', 0, -1, 'Technology')"))
+            migrate_fundamentals(conn.connection.cursor())
+        info = fundamentals_finder.get_info([1, 2], 'sector', pd.Timestamp('2020-06-01'))
+        assert list(info[0]) == ['Technology', 'NA']
+
+
+@pytest.fixture
+def filings_finder(asset_finder):
+    # irregular filings: sid 3 stops filing for years, sid 4 files once
+    rng = np.random.default_rng(0)
+    rows = []
+    for sid, dates in [(1, pd.date_range('2012-02-01', periods=30, freq='3MS')),
+                       (2, pd.date_range('2015-05-10', periods=9, freq='95D')),
+                       (3, pd.date_range('2008-01-15', periods=6, freq='3MS').append(
+                           pd.date_range('2016-01-15', periods=5, freq='3MS'))),
+                       (4, pd.DatetimeIndex(['2017-03-01']))]:
+        for date in dates:
+            for field in ('revenue_arq', 'assets_art'):
+                rows.append(dict(sid=sid, field=field, start_date=date.value, value=str(rng.integers(-50, 100))))
+    with asset_finder.engine.connect() as conn:
+        conn.execute(text("INSERT INTO equity_supplementary_mappings (sid, field, start_date, end_date, value) "
+                          "VALUES (:sid, :field, :start_date, -1, :value)"), rows)
+        conn.commit()
+    asset_finder.point_in_time_cache_size = 0
+    return asset_finder
+
+
+class TestMaterializedTTM:
+    dates = pd.date_range('2008-06-01', '2020-01-01', freq='7MS')
+
+    def _ttm(self, finder, k):
+        return [np.asarray(finder.get_fundamentals_ttm([1, 2, 3, 4, 5], 'revenue', day, k=k), dtype=float)
+                for day in self.dates]
+
+    def _nth(self, finder, n):
+        return [np.asarray(finder.get_fundamentals([1, 2, 3, 4, 5], 'assets_art', day, n=n), dtype=float)
+                for day in self.dates]
+
+    def test_matches_the_window_queries(self, filings_finder):
+        expected = {k: self._ttm(filings_finder, k) for k in (1, 2, 3)}
+        expected_nth = {n: self._nth(filings_finder, n) for n in (1, 5)}
+        with filings_finder.engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            migrate_fundamentals(cursor)
+            assert write_fundamentals_ttm(cursor, show_progress=False) == 2 * 51
+        finder = SQLiteAssetFinder(filings_finder.engine)
+        finder.point_in_time_cache_size = 0
+        assert finder._has_ttm()
+        for k in (1, 2, 3):
+            for actual, values in zip(self._ttm(finder, k), expected[k]):
+                np.testing.assert_array_equal(actual, values)
+        for n in (1, 5):
+            for actual, values in zip(self._nth(finder, n), expected_nth[n]):
+                np.testing.assert_array_equal(actual, values)
+
+    def test_rebuilds_the_sids(self, filings_finder):
+        with filings_finder.engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            migrate_fundamentals(cursor)
+            write_fundamentals_ttm(cursor, show_progress=False)
+            cursor.execute("UPDATE fundamentals SET value = 1000 WHERE sid = 4")
+            assert write_fundamentals_ttm(cursor, [4, 4], show_progress=False) == 2
+        values = filings_finder.get_fundamentals_ttm([4], 'revenue', pd.Timestamp('2017-06-01'))
+        np.testing.assert_array_equal(values, [[1000.0]])
+
+
+class TestSidSets:
+    def _temp_tables(self, finder):
+        with finder.engine.connect() as conn:
+            return conn.execute(text("SELECT name FROM sqlite_temp_master WHERE type = 'table'")).fetchall()
+
+    def test_registered_once_per_set(self, filings_finder):
+        for day in pd.date_range('2016-01-01', periods=5, freq='MS'):
+            filings_finder.get_fundamentals([1, 2, 3], 'revenue_arq', day)
+            filings_finder.get_datekey([1, 2, 3], day, 1)
+        assert len(self._temp_tables(filings_finder)) == 1
+        with filings_finder.engine.connect() as conn:
+            table = filings_finder._sid_set(conn, [1, 2, 3])
+            assert conn.execute(text("SELECT sid FROM %s ORDER BY sid" % table)).fetchall() == [(1,), (2,), (3,)]
+
+    def test_least_recently_used_sets_are_dropped(self, filings_finder, monkeypatch):
+        monkeypatch.setattr('sharadar.data.sql_lite_assets.SID_SETS_PER_CONNECTION', 2)
+        day = pd.Timestamp('2016-06-01')
+        expected = filings_finder.get_fundamentals([1, 2, 3, 4], 'revenue_arq', day)
+        for sids in ([1], [2], [1, 2, 3, 4]):
+            filings_finder.get_fundamentals(sids, 'revenue_arq', day)
+        assert len(self._temp_tables(filings_finder)) == 2
+        np.testing.assert_array_equal(filings_finder.get_fundamentals([1, 2, 3, 4], 'revenue_arq', day), expected)
+
+
 def test_asset_db_writer_retries_when_database_is_locked(tmp_path, monkeypatch):
     writer = SQLiteAssetDBWriter(str(tmp_path / 'assets.sqlite'), lock_retry_count=2, lock_retry_delay=0)
     begin_calls = {'count': 0}
@@ -1,3 +1,4 @@
+import os
 import sqlite3
 from contextlib import closing
 
@@ -6,9 +7,14 @@ import pandas as pd
 import pytest
 from exchange_calendars import get_calendar
 
+from sharadar.data import sql_lite_daily_pricing
+from sharadar.data.prices_manifest import PricesManifest, manifest_path
 from sharadar.data.sql_lite_daily_pricing import (
     SQLiteDailyBarWriter,
     SQLiteDailyBarReader,
+    SQLiteDailyAdjustmentWriter,
+    migrate_prices,
+    prices_schema_version,
 )
 
 
@@ -38,9 +44,14 @@ def sample_data():
     return data
 
 
+@pytest.fixture(params=[1, 2], ids=['v1', 'v2'])
+def schema_version(request):
+    return request.param
+
+
 @pytest.fixture
-def writer(db_path, calendar):
-    return SQLiteDailyBarWriter(db_path, calendar)
+def writer(db_path, calendar, schema_version):
+    return SQLiteDailyBarWriter(db_path, calendar, schema_version=schema_version)
 
 
 @pytest.fixture
@@ -93,6 +104,61 @@ class TestSQLiteDailyBarWriter:
         # Should still be 6 rows (replaced, not duplicated)
         assert count == 6
 
+    def test_write_rebuilds_indexes(self, writer, sample_data, db_path, schema_version):
+        writer.write(sample_data)
+        with closing(sqlite3.connect(db_path)) as con:
+            cur = con.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='prices'")
+            indexes = {row[0] for row in cur.fetchall()}
+        expected = {'ix_prices_date', 'ix_prices_sid'} if schema_version == 1 else {'ix_prices_date'}
+        assert expected <= indexes
+
+    def test_incremental_write_keeps_indexes(self, writer, sample_data, db_path, monkeypatch):
+        writer.write(sample_data)
+        statements = []
+        connect = sqlite3.connect
+
+        def traced_connect(*args, **kwargs):
+            con = connect(*args, **kwargs)
+            con.set_trace_callback(statements.append)
+            return con
+
+        monkeypatch.setattr(sqlite3, 'connect', traced_connect)
+        writer.write(sample_data.iloc[:2])
+        assert not any('ix_prices' in statement for statement in statements)
+        writer.write(sample_data.iloc[:2], bulk=True)
+        assert any('DROP INDEX IF EXISTS "ix_prices_date"' in statement for statement in statements)
+
+    def test_write_stores_date_format(self, writer, sample_data, db_path, schema_version):
+        writer.write(sample_data)
+        with closing(sqlite3.connect(db_path)) as con:
+            cur = con.cursor()
+            cur.execute("SELECT MIN(date), typeof(sid) FROM prices")
+            result = cur.fetchone()
+        if schema_version == 1:
+            assert result == ('2020-01-02 00:00:00', 'integer')
+        else:
+            assert result == (pd.Timestamp('2020-01-02').value, 'integer')
+
+    def test_new_database_uses_v2_schema(self, db_path, calendar):
+        SQLiteDailyBarWriter(db_path, calendar)
+        with closing(sqlite3.connect(db_path)) as con:
+            assert prices_schema_version(con) == 2
+
+    def test_existing_database_keeps_its_schema(self, writer, db_path, calendar, schema_version):
+        assert SQLiteDailyBarWriter(db_path, calendar)._schema_version == schema_version
+        with pytest.raises(ValueError, match="migrate-prices"):
+            SQLiteDailyBarWriter(db_path, calendar, schema_version=3 - schema_version)
+
+    def test_write_skips_nan_rows(self, writer, sample_data, db_path):
+        sample_data.iloc[0, 0] = np.nan
+        writer.write(sample_data)
+        with closing(sqlite3.connect(db_path)) as con:
+            cur = con.cursor()
+            cur.execute("SELECT COUNT(sid) FROM prices")
+            count = cur.fetchone()[0]
+        assert count == 5
+
     def test_write_validates_dataframe(self, writer):
         with pytest.raises(ValueError, match="data must be an instance of DataFrame"):
             writer.write("not a dataframe")
@@ -171,6 +237,25 @@ class TestSQLiteDailyBarReader:
         assert arrays[0].shape == (2, 1)
         assert np.all(np.isnan(arrays[0]))
 
+    def test_load_raw_arrays_field_order_and_sid_order(self, reader):
+        volume, close, open_ = reader.load_raw_arrays(
+            ['volume', 'close', 'open'],
+            pd.Timestamp('2020-01-03'),
+            pd.Timestamp('2020-01-06'),
+            [2, 999, 1, 2],
+        )
+        np.testing.assert_array_equal(close, [[25.0, np.nan, 15.0, 25.0], [26.0, np.nan, 16.0, 26.0]])
+        np.testing.assert_array_equal(volume[:, 0], [210.0, 220.0])
+        np.testing.assert_array_equal(open_[:, 2], [11.0, 12.0])
+
+    def test_load_raw_arrays_drops_non_session_rows(self, reader, writer, sample_data):
+        saturday = sample_data.loc[pd.Timestamp('2020-01-03')].copy()
+        saturday.index = pd.MultiIndex.from_product([pd.to_datetime(['2020-01-04']), saturday.index],
+                                                    names=['date', 'sid'])
+        writer.write(saturday)
+        arrays = reader.load_raw_arrays(['close'], pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-06'), [1])
+        np.testing.assert_array_equal(arrays[0][:, 0], [14.0, 15.0, 16.0])
+
     def test_get_last_traded_dt(self, reader):
         dt = reader.get_last_traded_dt(1, pd.Timestamp('2020-01-02'))
         assert dt == pd.Timestamp('2020-01-02')
@@ -201,10 +286,288 @@ class TestSQLiteDailyBarReader:
         cal = reader.trading_calendar
         assert cal.name == 'XNYS'
 
+    def test_get_values(self, reader):
+        values = reader.get_values([2, 3, 1], pd.Timestamp('2020-01-03'), 'close')
+        np.testing.assert_array_equal(values, [25.0, np.nan, 15.0])
+
+    def test_get_values_session_without_data(self, reader):
+        values = reader.get_values([1, 2], pd.Timestamp('2020-01-07'), 'open')
+        assert np.isnan(values).all()
+
+    def test_get_previous_values(self, reader):
+        sids = [1, 2, 1, 3, 2, 1]
+        # the session before a weekend date is the friday, the first session has no previous session
+        dts = pd.to_datetime(['2020-01-03', '2020-01-06', '2020-01-05', '2020-01-06', '2020-01-02', '2020-01-07'])
+        values = reader.get_previous_values(sids, dts, 'close')
+        np.testing.assert_array_equal(values, [14.0, 25.0, 15.0, np.nan, np.nan, 16.0])
+
+    def test_get_previous_values_in_batches(self, reader, monkeypatch):
+        monkeypatch.setattr('sharadar.data.sql_lite_daily_pricing.PREVIOUS_VALUES_BATCH_SIZE', 2)
+        dts = pd.to_datetime(['2020-01-03', '2020-01-03', '2020-01-06', '2020-01-06', '2020-01-07'])
+        values = reader.get_previous_values([1, 2, 1, 2, 2], dts, 'volume')
+        np.testing.assert_array_equal(values, [100.0, 200.0, 110.0, 210.0, 220.0])
+
+    def test_get_previous_values_empty(self, reader):
+        assert len(reader.get_previous_values([], pd.DatetimeIndex([]), 'close')) == 0
+
+    def test_session_cache_is_bounded_lru(self, populated_db):
+        reader = SQLiteDailyBarReader(filename=populated_db, session_cache_size=2)
+        for day in ['2020-01-02', '2020-01-03', '2020-01-02', '2020-01-06']:
+            reader.get_value(1, pd.Timestamp(day), 'close')
+        assert list(reader._session_snapshots) == [reader._date_key('2020-01-02'), reader._date_key('2020-01-06')]
+
+    def test_rewritten_session_is_read_again(self, reader, writer, sample_data):
+        day = pd.Timestamp('2020-01-02')
+        assert reader.get_value(1, day, 'close') == 14.0
+        corrected = sample_data.loc[[day]].copy()
+        corrected['close'] = 20.0
+        writer.write(corrected)
+        assert reader.get_value(1, day, 'close') == 20.0
+        assert reader.load_raw_arrays(['close'], day, day, [1])[0][0, 0] == 20.0
+
+    def test_get_value_unknown_field_raises(self, reader):
+        with pytest.raises(ValueError):
+            reader.get_value(1, pd.Timestamp('2020-01-02'), 'close; DROP TABLE prices')
+
+    def test_sees_data_written_after_first_query(self, reader, writer, sample_data):
+        assert reader.last_available_dt == pd.Timestamp('2020-01-06')
+        later = sample_data.loc[pd.Timestamp('2020-01-06')].copy()
+        later.index = pd.MultiIndex.from_product([pd.to_datetime(['2020-01-07']), later.index],
+                                                 names=['date', 'sid'])
+        writer.write(later)
+        assert reader.last_available_dt == pd.Timestamp('2020-01-07')
+
 
 class TestSQLiteDailyBarReaderEmpty:
     def test_last_available_dt_empty_db(self, db_path, calendar):
         # Create schema but no data
         SQLiteDailyBarWriter(db_path, calendar)
         reader = SQLiteDailyBarReader(filename=db_path)
-        assert reader.last_available_dt is pd.NaT
\ No newline at end of file
+        assert reader.last_available_dt is pd.NaT
+
+class TestMigratePrices:
+    @pytest.fixture
+    def v1_db(self, db_path, calendar, sample_data):
+        SQLiteDailyBarWriter(db_path, calendar, schema_version=1).write(sample_data)
+        return db_path
+
+    def _dump(self, path):
+        reader = SQLiteDailyBarReader(filename=path)
+        arrays = reader.load_raw_arrays(['open', 'close', 'volume'], pd.Timestamp('2020-01-02'),
+                                        pd.Timestamp('2020-01-06'), [1, 2])
+        return reader.schema_version, arrays, reader.last_available_dt, reader.trading_calendar.name
+
+    def test_migrate_in_place(self, v1_db):
+        version, before, last_dt, calendar_name = self._dump(v1_db)
+        assert version == 1
+        migrate_prices(v1_db)
+        version, after, migrated_last_dt, migrated_calendar_name = self._dump(v1_db)
+        assert version == 2
+        for b, a in zip(before, after):
+            np.testing.assert_array_equal(b, a)
+        assert (migrated_last_dt, migrated_calendar_name) == (last_dt, calendar_name)
+        with closing(sqlite3.connect(v1_db)) as con:
+            sql = con.execute("SELECT sql FROM sqlite_master WHERE name='prices'").fetchone()[0]
+        assert 'WITHOUT ROWID' in sql
+
+    def test_migrate_to_new_file(self, v1_db, tmp_path):
+        output = str(tmp_path / 'prices_v2.sqlite')
+        migrate_prices(v1_db, output)
+        assert self._dump(v1_db)[0] == 1
+        assert self._dump(output)[0] == 2
+        with pytest.raises(ValueError, match="already exists"):
+            migrate_prices(v1_db, output)
+
+    def test_migrated_database_is_writable(self, v1_db, calendar, sample_data):
+        migrate_prices(v1_db)
+        modified = sample_data.copy()
+        modified['close'] = 999.0
+        SQLiteDailyBarWriter(v1_db, calendar).write(modified)
+        reader = SQLiteDailyBarReader(filename=v1_db)
+        assert reader.get_value(1, pd.Timestamp('2020-01-03'), 'close') == 999.0
+
+    def test_migrate_v2_is_noop(self, populated_db, schema_version):
+        migrate_prices(populated_db)
+        assert self._dump(populated_db)[0] == 2
+
+
+class TestPricesManifest:
+    @pytest.fixture
+    def gap_db(self, writer, sample_data, db_path):
+        # sid 1 does not trade on 2020-01-03
+        writer.write(sample_data.drop((pd.Timestamp('2020-01-03'), 1)))
+        return db_path
+
+    def test_writer_saves_manifest(self, reader, populated_db, calendar):
+        manifest = PricesManifest.load(populated_db)
+        assert manifest is not None
+        assert manifest.calendar_name == calendar.name
+        assert manifest.sids.tolist() == [1, 2]
+        assert manifest.traded_range(2) == (pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-06'))
+        assert reader.manifest is not None
+
+    def test_incremental_update_matches_database(self, writer, sample_data, populated_db):
+        later = sample_data.loc[pd.Timestamp('2020-01-06')].copy()
+        later.index = pd.MultiIndex.from_product([pd.to_datetime(['2020-01-07']), [2, 3]], names=['date', 'sid'])
+        writer.write(later)
+        manifest = PricesManifest.load(populated_db)
+        expected = PricesManifest.from_database(populated_db)
+        np.testing.assert_array_equal(manifest.sids, expected.sids)
+        np.testing.assert_array_equal(manifest.first_traded, expected.first_traded)
+        np.testing.assert_array_equal(manifest.last_traded, expected.last_traded)
+
+    def test_stale_manifest_is_ignored(self, reader, populated_db):
+        assert reader.last_available_dt == pd.Timestamp('2020-01-06')
+        with closing(sqlite3.connect(populated_db)) as con, con:
+            con.execute("DELETE FROM prices WHERE date >= ?",
+                        (reader._date_key(pd.Timestamp('2020-01-06')),))
+        assert PricesManifest.load(populated_db) is None
+        assert reader.manifest is None
+        assert reader.last_available_dt == pd.Timestamp('2020-01-03')
+
+    @pytest.mark.parametrize('with_manifest', [True, False])
+    def test_get_last_traded_dt_on_or_before(self, gap_db, with_manifest):
+        if not with_manifest:
+            os.remove(manifest_path(gap_db))
+        reader = SQLiteDailyBarReader(filename=gap_db)
+        assert (reader.manifest is not None) == with_manifest
+        assert reader.get_last_traded_dt(1, pd.Timestamp('2020-01-03')) == pd.Timestamp('2020-01-02')
+        assert reader.get_last_traded_dt(1, pd.Timestamp('2020-01-10')) == pd.Timestamp('2020-01-06')
+        assert reader.get_last_traded_dt(2, pd.Timestamp('2020-01-03')) == pd.Timestamp('2020-01-03')
+        assert reader.get_last_traded_dt(1, pd.Timestamp('2020-01-01')) is pd.NaT
+        with pytest.raises(KeyError):
+            reader.get_last_traded_dt(999, pd.Timestamp('2020-01-03'))
+
+    def test_change_counter_is_read_once_per_lookup(self, reader, monkeypatch):
+        reads = []
+        counter = sql_lite_daily_pricing.change_counter
+        monkeypatch.setattr(sql_lite_daily_pricing, 'change_counter', lambda f: reads.append(f) or counter(f))
+        day = pd.Timestamp('2020-01-03')
+        reader.load_raw_arrays(['close'], day, day, [1, 2])
+        assert reader.trading_calendar.name == 'XNYS'
+        assert reader._exist_sid(1)
+        assert reads == []
+        with pytest.raises(KeyError):
+            reader.get_value(999, day, 'close')
+        assert len(reads) == 1
+
+    def test_missing_manifest_is_loaded_once(self, populated_db, monkeypatch):
+        os.remove(manifest_path(populated_db))
+        reader = SQLiteDailyBarReader(filename=populated_db)
+        loads = []
+        load = PricesManifest.load
+        monkeypatch.setattr(PricesManifest, 'load', lambda f: loads.append(f) or load(f))
+        for day in ['2020-01-02', '2020-01-03', '2020-01-06']:
+            reader.get_last_traded_dt(1, pd.Timestamp(day))
+            reader.trading_calendar
+        assert reader.manifest is None
+        assert len(loads) == 1
+
+    def test_trading_calendar_is_built_once(self, reader):
+        assert reader.trading_calendar is reader.trading_calendar
+
+    def test_migrate_prices_saves_manifest(self, db_path, calendar, sample_data):
+        SQLiteDailyBarWriter(db_path, calendar, schema_version=1).write(sample_data)
+        migrate_prices(db_path)
+        manifest = PricesManifest.load(db_path)
+        assert manifest is not None
+        assert manifest.last_session == pd.Timestamp('2020-01-06')
+
+
+class TestSQLiteDailyAdjustmentWriter:
+    @pytest.fixture
+    def adjustments_path(self, tmp_path):
+        return str(tmp_path / 'adjustments.sqlite')
+
+    @pytest.fixture
+    def adjustment_writer(self, adjustments_path):
+        return SQLiteDailyAdjustmentWriter(adjustments_path, None, None, None)
+
+    @pytest.fixture
+    def splits(self):
+        return pd.DataFrame({
+            'effective_date': pd.to_datetime(['2020-01-02', '2020-01-03']),
+            'ratio': [0.5, 0.25],
+            'sid': [1, 2],
+        })
+
+    def _rows(self, path, sql):
+        with closing(sqlite3.connect(path)) as con:
+            return con.execute(sql).fetchall()
+
+    def test_write_splits(self, adjustment_writer, adjustments_path, splits):
+        adjustment_writer.write(splits=splits)
+        rows = self._rows(adjustments_path, 'SELECT "index", effective_date, ratio, sid FROM splits ORDER BY sid')
+        assert rows == [(0, 1577923200, 0.5, 1), (1, 1578009600, 0.25, 2)]
+
+    def test_columns_are_matched_by_name(self, adjustment_writer, adjustments_path, splits):
+        # calc_dividend_ratios returns the columns in the order sid, effective_date, ratio
+        adjustment_writer.write_frame('dividends', splits[['sid', 'effective_date', 'ratio']])
+        rows = self._rows(adjustments_path, "SELECT effective_date, ratio, sid, typeof(sid) FROM dividends ORDER BY sid")
+        assert rows == [(1577923200, 0.5, 1, 'integer'), (1578009600, 0.25, 2, 'integer')]
+
+    def test_write_replaces_on_conflict(self, adjustment_writer, adjustments_path, splits):
+        adjustment_writer.write(splits=splits)
+        splits['ratio'] = 0.1
+        adjustment_writer.write(splits=splits)
+        assert self._rows(adjustments_path, "SELECT ratio FROM splits") == [(0.1,), (0.1,)]
+
+    def test_write_skips_nan_rows(self, adjustment_writer, adjustments_path, splits):
+        splits.loc[0, 'ratio'] = np.nan
+        adjustment_writer.write(splits=splits)
+        assert self._rows(adjustments_path, "SELECT sid FROM splits") == [(2,)]
+
+    def test_write_dividend_payouts_date_index(self, adjustment_writer, adjustments_path):
+        dividends = pd.DataFrame({'amount': [0.1], 'sid': [1]}, index=pd.to_datetime(['2020-01-02']))
+        for column in ['record_date', 'declared_date', 'pay_date', 'ex_date']:
+            dividends[column] = dividends.index
+        adjustment_writer._write_dividends(dividends)
+        rows = self._rows(adjustments_path, "SELECT date, amount, sid, ex_date FROM dividend_payouts")
+        assert rows == [('2020-01-02 00:00:00', 0.1, 1, 1577923200)]
+
+    def test_write_empty_frame(self, adjustment_writer, adjustments_path):
+        adjustment_writer.write(splits=None, mergers=pd.DataFrame())
+        assert self._rows(adjustments_path, "SELECT COUNT(*) FROM splits") == [(0,)]
+
+    def test_write_validates_dtypes(self, adjustment_writer, splits):
+        splits['ratio'] = splits['ratio'].astype(str)
+        with pytest.raises(TypeError):
+            adjustment_writer.write(splits=splits)
+
+    @pytest.fixture
+    def dividend_writer(self, adjustments_path, reader):
+        return SQLiteDailyAdjustmentWriter(adjustments_path, reader, None, None)
+
+    def _dividends(self, sids, ex_dates, amounts):
+        dividends = pd.DataFrame({'amount': amounts, 'sid': sids}, index=pd.to_datetime(ex_dates))
+        for column in ['record_date', 'declared_date', 'pay_date', 'ex_date']:
+            dividends[column] = dividends.index
+        return dividends
+
+    def test_calc_dividend_ratios(self, dividend_writer):
+        # the ex_date after the last session uses the close of the last session
+        dividends = self._dividends([1, 2, 2], ['2020-01-06', '2020-01-03', '2020-01-08'], [1.5, 2.4, 5.2])
+        ratios = dividend_writer.calc_dividend_ratios(dividends)
+        assert ratios.sid.tolist() == [1, 2, 2]
+        assert ratios.effective_date.tolist() == dividends.ex_date.tolist()
+        np.testing.assert_allclose(ratios.ratio.values, [0.9, 0.9, 0.8])
+
+    def test_calc_dividend_ratios_adjusts_previous_close(self, dividend_writer, splits):
+        # the split of sid 1 on 2020-01-06 halves the close of 2020-01-02
+        splits['effective_date'] = pd.to_datetime(['2020-01-06', '2020-01-06'])
+        dividend_writer.write(splits=splits)
+        ratios = dividend_writer.calc_dividend_ratios(self._dividends([1], ['2020-01-03'], [0.7]))
+        np.testing.assert_allclose(ratios.ratio.values, [0.9])
+
+    def test_calc_dividend_ratios_skips_processed_dividends(self, dividend_writer, adjustments_path):
+        dividend_writer.write(dividends=self._dividends([1], ['2020-01-06'], [1.5]))
+        dividends = self._dividends([1, 2], ['2020-01-06', '2020-01-06'], [3.0, 2.5])
+        ratios = dividend_writer.calc_dividend_ratios(dividends)
+        assert ratios.sid.tolist() == [2]
+        np.testing.assert_allclose(ratios.ratio.values, [0.9])
+        assert dividend_writer.calc_dividend_ratios(dividends.iloc[:1]).empty
+
+        dividend_writer.write(dividends=dividends)
+        rows = self._rows(adjustments_path, "SELECT sid, ratio FROM dividends ORDER BY sid")
+        assert [r[0] for r in rows] == [1, 2]
+        np.testing.assert_allclose([r[1] for r in rows], [0.9, 0.9])
@@ -0,0 +1,223 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from zipline.assets import AssetDBWriter
+from zipline.pipeline import Pipeline
+from zipline.pipeline.domain import US_EQUITIES
+from zipline.pipeline.factors import CustomFactor, SimpleMovingAverage, Returns
+from zipline.pipeline.data import USEquityPricing
+
+from sharadar.data.sql_lite_assets import SQLiteAssetFinder
+from sharadar.pipeline import engine
+from sharadar.pipeline.term_cache import TermCache, term_digest, bundle_fingerprint
+
+DATES = pd.date_range('2021-01-04', periods=3)
+SIDS = pd.Index([1, 2, 3])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return TermCache(str(tmp_path / 'cache'), fingerprint='abc')
+
+
+class SidFactor(CustomFactor, engine.BundleLoader):
+    inputs = []
+    window_length = 1
+
+    def compute(self, today, assets, out):
+        # sets the asset finder of the BundleLoader on the term
+        self.asset_finder()
+        out[:] = assets
+
+
+class TestTermDigest:
+    def test_equal_terms_same_digest(self):
+        sma1 = SimpleMovingAverage(inputs=[USEquityPricing.close], window_length=10)
+        sma2 = SimpleMovingAverage(inputs=[USEquityPricing.close], window_length=10)
+        assert term_digest(sma1) == term_digest(sma2)
+
+    def test_digest_changes_with_parameters(self):
+        sma10 = SimpleMovingAverage(inputs=[USEquityPricing.close], window_length=10)
+        sma20 = SimpleMovingAverage(inputs=[USEquityPricing.close], window_length=20)
+        sma_open = SimpleMovingAverage(inputs=[USEquityPricing.open], window_length=10)
+        assert len({term_digest(sma10), term_digest(sma20), term_digest(sma_open)}) == 3
+
+    def test_digest_changes_with_inputs_recursively(self):
+        r5 = Returns(window_length=5)
+        r10 = Returns(window_length=10)
+        assert term_digest(r5.rank()) != term_digest(r10.rank())
+        assert term_digest(r5.rank()) != term_digest(r5.rank(ascending=False))
+        assert term_digest(r5.zscore()) == term_digest(r5.zscore())
+        assert term_digest(r5.zscore()) != term_digest(r5.demean())
+
+    def test_digest_ignores_loaded_readers(self):
+        factor = SidFactor()
+        before = term_digest(factor)
+        factor._asset_finder = object()
+        factor._bar_reader = object()
+        assert term_digest(factor) == before
+
+
+class TestTermCache:
+    def test_key_depends_on_dates_sids_and_fingerprint(self, cache, tmp_path):
+        term = Returns(window_length=5)
+        key = cache.key(term, US_EQUITIES, DATES, SIDS)
+        assert key == cache.key(term, US_EQUITIES, DATES, SIDS)
+        assert key != cache.key(term, US_EQUITIES, DATES[1:], SIDS)
+        assert key != cache.key(term, US_EQUITIES, DATES, SIDS[1:])
+        other = TermCache(str(tmp_path / 'cache'), fingerprint='def')
+        assert key != other.key(term, US_EQUITIES, DATES, SIDS)
+
+    def test_get_put(self, cache):
+        values = np.arange(9.0).reshape(3, 3)
+        assert cache.get('k') is None
+        cache.put('k', values, 'returns')
+        np.testing.assert_array_equal(cache.get('k'), values)
+        assert 'k' in cache
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+        assert stats['hit_rate'] == 0.5
+
+    def test_index_persists(self, cache):
+        cache.put('k', np.ones(3))
+        cache.get('k')
+        cache.flush()
+        reopened = TermCache(cache.directory, fingerprint='abc')
+        assert 'k' in reopened
+        assert reopened.stats()['hits'] == 1
+
+    def test_get_does_not_write_the_index(self, cache):
+        cache.put('k', np.ones(3))
+        cache.flush()
+        index = os.path.join(cache.directory, 'term-index.json')
+        mtime = os.stat(index).st_mtime_ns
+        os.utime(index, ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+        cache.get('k')
+        cache.get('missing')
+        assert os.stat(index).st_mtime_ns == mtime - 10 ** 9
+        cache.flush()
+        assert os.stat(index).st_mtime_ns != mtime - 10 ** 9
+
+    def test_flush_merges_the_index_of_other_processes(self, cache):
+        other = TermCache(cache.directory, fingerprint='abc')
+        cache.put('a', np.ones(3))
+        other.put('b', np.ones(3))
+        cache.get('a')
+        other.get('b')
+        cache.flush()
+        other.flush()
+        reopened = TermCache(cache.directory, fingerprint='abc')
+        assert 'a' in reopened and 'b' in reopened
+        assert reopened.hits == 2
+
+    def test_file_removed_by_other_process_is_a_miss(self, cache):
+        cache.put('k', np.ones(3))
+        cache.flush()
+        other = TermCache(cache.directory, fingerprint='abc')
+        cache.clear()
+        assert other.get('k') is None
+        assert 'k' not in other
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        values = np.ones(1000)
+        size = TermCache(str(tmp_path / 'probe'))
+        size.put('probe', values)
+        cache = TermCache(str(tmp_path / 'cache'), max_bytes=int(2.5 * size.stats()['bytes']))
+        cache.put('a', values)
+        cache.put('b', values)
+        cache.get('a')
+        cache.put('c', values)
+        assert 'a' in cache and 'c' in cache
+        assert 'b' not in cache
+        assert not os.path.exists(cache._path('b'))
+
+    def test_clear(self, cache):
+        cache.put('k', np.ones(3))
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.get('k') is None
+
+
+class TestBundleFingerprint:
+    def test_changes_with_bundle_files(self, tmp_path):
+        (tmp_path / 'assets-7.sqlite').write_bytes(b'1')
+        (tmp_path / 'cache').mkdir()
+        before = bundle_fingerprint(str(tmp_path))
+        (tmp_path / 'cache' / 'term.npy').write_bytes(b'1')
+        assert bundle_fingerprint(str(tmp_path)) == before
+        (tmp_path / 'assets-7.sqlite').write_bytes(b'12')
+        assert bundle_fingerprint(str(tmp_path)) != before
+
+
+class TestEngineCache:
+    def _engine(self, tmp_path, monkeypatch, **kwargs):
+        monkeypatch.setenv('ZIPLINE_ROOT', str(tmp_path / 'zipline'))
+        sessions = US_EQUITIES.sessions()
+        sessions = sessions[(sessions >= '2020-01-02') & (sessions <= '2020-03-31')]
+        assets = create_engine('sqlite:///' + str(tmp_path / 'assets.sqlite'))
+        equities = pd.DataFrame({'symbol': ['A', 'B'], 'start_date': sessions[0], 'end_date': sessions[-1],
+                                 'exchange': 'NYSE'}, index=[1, 2])
+        AssetDBWriter(assets).write(equities=equities,
+                                    exchanges=pd.DataFrame({'exchange': ['NYSE'], 'country_code': ['US']}))
+        finder = SQLiteAssetFinder(assets)
+        monkeypatch.setattr(engine, '_asset_finder', lambda: finder)
+        return engine.BundlePipelineEngine(get_loader=None, asset_finder=finder, **kwargs), sessions
+
+    def test_second_run_hits_every_chunk(self, tmp_path, monkeypatch, cache):
+        pipeline_engine, sessions = self._engine(tmp_path, monkeypatch, term_cache=cache)
+        pipeline = Pipeline(columns={'sid': SidFactor()})
+
+        # two chunks of the factor and the screen: the readers set on the term by the
+        # first chunk must not make the second one uncacheable
+        first = pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[29], chunksize=5, hooks=[])
+        assert (cache.hits, len(cache)) == (0, 4)
+        second = pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[29], chunksize=5, hooks=[])
+        assert cache.hits == 4
+        pd.testing.assert_frame_equal(first, second)
+        assert len(first) == 20
+        assert TermCache(cache.directory).hits == 4
+
+    def test_cached_terms_do_not_change_the_workspace(self, tmp_path, monkeypatch, cache):
+        pipeline_engine, sessions = self._engine(tmp_path, monkeypatch, term_cache=cache)
+        pipeline = Pipeline(columns={'sid': SidFactor()})
+        pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[24], chunksize=5, hooks=[])
+
+        workspaces = []
+        compute_chunk = pipeline_engine.compute_chunk
+
+        def spy(graph, dates, sids, workspace, **kwargs):
+            before = dict(workspace)
+            out = compute_chunk(graph, dates, sids, workspace, **kwargs)
+            workspaces.append((before, workspace))
+            return out
+
+        monkeypatch.setattr(pipeline_engine, 'compute_chunk', spy)
+        pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[24], chunksize=5, hooks=[])
+        assert cache.hits == 2
+        assert [before == after for before, after in workspaces] == [True]
+
+    def test_new_ingest_misses_the_cache(self, tmp_path, monkeypatch):
+        bundle_dir = tmp_path / 'bundle'
+        bundle_dir.mkdir()
+        (bundle_dir / 'assets-7.sqlite').write_bytes(b'1')
+        pipeline_engine, sessions = self._engine(tmp_path, monkeypatch, bundle_dir=str(bundle_dir))
+        pipeline = Pipeline(columns={'sid': SidFactor()})
+        pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[24], chunksize=5, hooks=[])
+        pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[24], chunksize=5, hooks=[])
+        cache = pipeline_engine.term_cache
+        assert cache.hits == 2
+
+        (bundle_dir / 'assets-7.sqlite').write_bytes(b'12')
+        pipeline_engine.run_pipeline(pipeline, sessions[20], sessions[24], chunksize=5, hooks=[])
+        assert cache.hits == 2
+        assert cache.fingerprint == bundle_fingerprint(str(bundle_dir))
+
+    def test_changes_with_price_shards(self, tmp_path):
+        (tmp_path / 'prices.shards').mkdir()
+        (tmp_path / 'prices.shards' / 'prices-2020.sqlite').write_bytes(b'1')
+        before = bundle_fingerprint(str(tmp_path))
+        (tmp_path / 'prices.shards' / 'prices-2020.sqlite.manifest.json').write_bytes(b'{}')
+        assert bundle_fingerprint(str(tmp_path)) != before